@@ -1,23 +1,23 @@
 # main.py
 import os
-import json
+import csv
 import logging
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import threading
-import queue
-from pathlib import Path
-import re
+from collections import deque
 import sys
 import importlib
 import inspect
 import shutil
 import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 from PIL import Image, ImageTk
-import sqlite3
+from renamer_core import (
+    DatabaseManager, FilenameTemplate, RenamedFilesManager,
+    Settings, FileMonitor, RenameService, RenamePlanItem, ReportExporter,
+    HistoryMaintenance
+)
 
 # Версия программы
 VERSION = "3.9.5"
@@ -31,162 +31,21 @@ except ImportError:
     logging.error("Библиотека tksheet не установлена. Отчет будет ограничен в функциях.")
 
 class QueueHandler(logging.Handler):
-    """Кастомный обработчик логов для отправки сообщений в очередь"""
+    """Кастомный обработчик логов для отправки сообщений в очередь
+    
+    Очередь - deque: append и popleft атомарны, рабочие потоки не ждут
+    поток GUI. В очередь кладется пара (уровень, текст).
+    """
     
     def __init__(self, log_queue):
         super().__init__()
         self.log_queue = log_queue
     
     def emit(self, record):
-        self.log_queue.put(self.format(record))
-
-class DatabaseManager:
-    """Менеджер базы данных для хранения истории переименований"""
-    
-    def __init__(self, db_file="rename_history.db"):
-        self.db_file = db_file
-        self.init_database()
-    
-    def init_database(self):
-        """Инициализация базы данных"""
-        try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            # Создаем таблицу для истории переименований
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS rename_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT NOT NULL,
-                    create_date TEXT NOT NULL,
-                    route TEXT NOT NULL,
-                    original_name TEXT NOT NULL,
-                    new_name TEXT NOT NULL,
-                    file_path TEXT NOT NULL
-                )
-            ''')
-            
-            # Создаем индекс для быстрого поиска по дате
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_date 
-                ON rename_history(create_date)
-            ''')
-            
-            # Создаем индекс для быстрого поиска по маршруту
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_route 
-                ON rename_history(route)
-            ''')
-            
-            conn.commit()
-            conn.close()
-            logging.info("База данных инициализирована успешно")
-            
-        except Exception as e:
-            logging.error(f"Ошибка инициализации базы данных: {e}")
-    
-    def add_record(self, timestamp, route, original_name, new_name, file_path):
-        """Добавление записи в базу данных"""
         try:
-            create_date = datetime.now().strftime("%Y-%m-%d")
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO rename_history 
-                (timestamp, create_date, route, original_name, new_name, file_path)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (timestamp, create_date, route, original_name, new_name, file_path))
-            
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка добавления записи в базу данных: {e}")
-            return False
-    
-    def get_records_by_date(self, target_date=None):
-        """Получение записей за определенную дату"""
-        try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            if target_date:
-                cursor.execute('''
-                    SELECT * FROM rename_history 
-                    WHERE create_date = ? 
-                    ORDER BY timestamp DESC
-                ''', (target_date,))
-            else:
-                cursor.execute('''
-                    SELECT * FROM rename_history 
-                    ORDER BY timestamp DESC
-                ''')
-            
-            records = cursor.fetchall()
-            conn.close()
-            
-            # Преобразуем в список словарей
-            columns = ['id', 'timestamp', 'create_date', 'route', 'original_name', 'new_name', 'file_path']
-            result = []
-            for record in records:
-                result.append(dict(zip(columns, record)))
-            
-            return result
-        except Exception as e:
-            logging.error(f"Ошибка получения записей из базы данных: {e}")
-            return []
-    
-    def get_all_dates(self):
-        """Получение всех уникальных дат из базы данных"""
-        try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT DISTINCT create_date FROM rename_history 
-                ORDER BY create_date DESC
-            ''')
-            
-            dates = [row[0] for row in cursor.fetchall()]
-            conn.close()
-            return dates
-        except Exception as e:
-            logging.error(f"Ошибка получения дат из базы данных: {e}")
-            return []
-    
-    def clear_records_by_date(self, target_date):
-        """Удаление записей за определенную дату"""
-        try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                DELETE FROM rename_history 
-                WHERE create_date = ?
-            ''', (target_date,))
-            
-            conn.commit()
-            conn.close()
-            return cursor.rowcount
-        except Exception as e:
-            logging.error(f"Ошибка удаления записей из базы данных: {e}")
-            return 0
-    
-    def clear_all_records(self):
-        """Удаление всех записей"""
-        try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM rename_history')
-            
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка очистки базы данных: {e}")
-            return False
+            self.log_queue.append((record.levelno, self.format(record)))
+        except Exception:
+            self.handleError(record)
 
 class TemplateBuilderDialog:
     """Диалоговое окно для визуального построения шаблона"""
@@ -323,15 +182,7 @@ class TemplateBuilderDialog:
     
     def format_date_by_format(self, date_obj, date_format):
         """Форматирует дату по выбранному формату"""
-        format_mapping = {
-            "ДДММГГГГ": date_obj.strftime("%d%m%Y"),
-            "ДДММГГ": date_obj.strftime("%d%m%y"),
-            "ГГГГММДД": date_obj.strftime("%Y%m%d"),
-            "ДД.ММ.ГГГГ": date_obj.strftime("%d.%m.%Y"),
-            "ДД.ММ.ГГ": date_obj.strftime("%d.%m.%y"),
-            "ГГГГ.ММ.ДД": date_obj.strftime("%Y.%m.%d")
-        }
-        return format_mapping.get(date_format, date_obj.strftime("%Y%m%d"))
+        return FilenameTemplate.format_date(date_obj, date_format)
     
     def create_variable_group(self, parent, title, variables):
         """Создание группы переменных"""
@@ -392,24 +243,15 @@ class TemplateBuilderDialog:
         try:
             template = self.template_text.get("1.0", tk.END).strip()
             
-            # Заменяем переменные на примеры значений
-            preview = template
-            preview = preview.replace("{project}", self.settings.settings["project"])
-            preview = preview.replace("{CN}", self.settings.settings["cn_type"])
-            preview = preview.replace("{route}", self.settings.settings["route"])
-            
-            # Форматируем дату по выбранному формату
-            date_format = self.settings.settings.get("date_format", "ГГГГММДД")
-            formatted_date = self.format_date_by_format(datetime.now(), date_format)
-            preview = preview.replace("{date}", formatted_date)
-            
-            preview = preview.replace("{counter}", "001")
-            preview = preview.replace("{extension}", "jpg")
-            preview = preview.replace("{1}", self.settings.settings["var1"])
-            preview = preview.replace("{2}", self.settings.settings["var2"])
-            preview = preview.replace("{3}", self.settings.settings["var3"])
+            compiled = FilenameTemplate.from_settings(template, self.settings.settings)
+            if compiled.unknown_placeholders:
+                self.preview_var.set(
+                    f"Неизвестные переменные: {', '.join(compiled.unknown_placeholders)}"
+                )
+                return
             
-            self.preview_var.set(f"Пример: {preview}")
+            # Подставляем примеры значений номера и расширения
+            self.preview_var.set(f"Пример: {compiled.render('001', 'jpg')}")
         except Exception as e:
             self.preview_var.set(f"Ошибка в шаблоне: {e}")
     
@@ -431,188 +273,15 @@ class TemplateBuilderDialog:
             self.result_template = template
             self.dialog.destroy()
 
-class RenamedFilesManager:
-    """Менеджер для хранения информации о переименованных файлах"""
-    
-    def __init__(self, history_file="renamed_files.json"):
-        self.history_file = history_file
-        self.renamed_files = set()
-        self.load_history()
-    
-    def load_history(self):
-        """Загрузка истории переименований из файла"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.renamed_files = set(data.get("renamed_files", []))
-                logging.info(f"Загружена история переименований: {len(self.renamed_files)} файлов")
-        except Exception as e:
-            logging.error(f"Ошибка загрузки истории переименований: {e}")
-            self.renamed_files = set()
-    
-    def save_history(self):
-        """Сохранение истории переименований в файл"""
-        try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump({"renamed_files": list(self.renamed_files)}, f, 
-                         ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"Ошибка сохранения истории переименований: {e}")
-    
-    def add_renamed_file(self, filepath):
-        """Добавление файла в историю переименований"""
-        file_key = self._get_file_key(filepath)
-        self.renamed_files.add(file_key)
-        self.save_history()
-    
-    def is_file_renamed(self, filepath):
-        """Проверка, был ли файл уже переименован программой"""
-        file_key = self._get_file_key(filepath)
-        return file_key in self.renamed_files
-    
-    def _get_file_key(self, filepath):
-        """Создание уникального ключа для файла"""
-        try:
-            # Используем комбинацию имени файла и времени создания
-            stat = os.stat(filepath)
-            return f"{Path(filepath).name}_{stat.st_ctime}"
-        except:
-            return filepath
-
-class Settings:
-    """Класс для работы с настройками"""
-    def __init__(self, filename="settings.json"):
-        self.filename = filename
-        self.default_settings = {
-            "project": "Проект1",
-            "cn_type": "VK",
-            "route": "M2.1",
-            "number_format": "01",
-            "date_format": "ГГГГММДД",
-            "var1": "Значение1",
-            "var2": "Значение2",
-            "var3": "Значение3",
-            "folder": r"C:\video\violations",
-            "extensions": "png,jpg,jpeg",
-            "template": "{project}_{date}_{route}_{counter}_{CN}",
-            "monitoring_enabled": True,
-            "rename_only_today": True,
-            "folder_history": [
-                r"C:\video\violations",
-                r"C:\temp\files",
-                r"D:\projects\images"
-            ],
-            "template_history": [
-                "{project}_{date}_{route}_{counter}_{CN}",
-                "{project}_{CN}_{date}_{counter}",
-                "{route}_{date}_{counter}_{project}"
-            ],
-            "enabled_plugins": ["example_plugin"],
-            "combobox_values": {
-                "project": ["Проект1", "Проект2"],
-                "cn_type": ["VK", "Другой"],
-                "route": ["M2.1", "M2.2", "M2.3"],
-                "number_format": ["1", "01", "001"],
-                "date_format": ["ДДММГГГГ", "ДДММГГ", "ГГГГММДД", "ДД.ММ.ГГГГ", "ДД.ММ.ГГ", "ГГГГ.ММ.ДД"],
-                "var1": ["Значение1", "Значение2"],
-                "var2": ["Значение1", "Значение2"],
-                "var3": ["Значение1", "Значение2"]
-            },
-            "report_route_history": [],
-            "column_order": ["number", "create_time", "route", "new_name"],
-            "column_visibility": {
-                "number": True,
-                "create_time": True,
-                "route": True,
-                "new_name": True
-            }
-        }
-        self.load_settings()
-    
-    def load_settings(self):
-        """Загрузка настроек из файла"""
-        try:
-            if os.path.exists(self.filename):
-                with open(self.filename, 'r', encoding='utf-8') as f:
-                    loaded_settings = json.load(f)
-                    # Объединяем с настройками по умолчанию для совместимости
-                    # Обеспечиваем обратную совместимость: если есть старый tl_type, копируем его в cn_type
-                    if "tl_type" in loaded_settings and "cn_type" not in loaded_settings:
-                        loaded_settings["cn_type"] = loaded_settings["tl_type"]
-                    
-                    # Обновляем шаблоны в истории для обратной совместимости
-                    if "template_history" in loaded_settings:
-                        for i, template in enumerate(loaded_settings["template_history"]):
-                            if "{TL}" in template:
-                                loaded_settings["template_history"][i] = template.replace("{TL}", "{CN}")
-                    
-                    # Обновляем основной шаблон для обратной совместимости
-                    if "template" in loaded_settings and "{TL}" in loaded_settings["template"]:
-                        loaded_settings["template"] = loaded_settings["template"].replace("{TL}", "{CN}")
-                    
-                    # Добавляем новые поля если их нет
-                    if "report_route_history" not in loaded_settings:
-                        loaded_settings["report_route_history"] = []
-                    
-                    if "column_order" not in loaded_settings:
-                        loaded_settings["column_order"] = self.default_settings["column_order"]
-                    
-                    if "column_visibility" not in loaded_settings:
-                        loaded_settings["column_visibility"] = self.default_settings["column_visibility"]
-                    
-                    self.settings = {**self.default_settings, **loaded_settings}
-            else:
-                self.settings = self.default_settings
-                self.save_settings()
-        except Exception as e:
-            logging.error(f"Ошибка загрузки настроек: {e}")
-            self.settings = self.default_settings
-    
-    def save_settings(self):
-        """Сохранение настроек в файл"""
-        try:
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(self.settings, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"Ошибка сохранения настроек: {e}")
-    
-    def update_setting(self, key, value):
-        """Обновление значения настройки"""
-        self.settings[key] = value
-        self.save_settings()
-    
-    def add_to_folder_history(self, folder):
-        """Добавление папки в историю"""
-        if folder and folder not in self.settings["folder_history"]:
-            self.settings["folder_history"].insert(0, folder)
-            # Ограничиваем историю 10 элементами
-            self.settings["folder_history"] = self.settings["folder_history"][:10]
-            self.save_settings()
+class BasePlugin:
+    """Базовый класс для всех плагинов
     
-    def add_to_template_history(self, template):
-        """Добавление шаблона в историю"""
-        if template and template not in self.settings["template_history"]:
-            self.settings["template_history"].insert(0, template)
-            # Ограничиваем историю 10 элементами
-            self.settings["template_history"] = self.settings["template_history"][:10]
-            self.save_settings()
+    Настройки плагин меняет только через self.settings.update_setting(ключ,
+    значение), а не записью в self.settings.settings напрямую.
+    """
     
-    def add_to_route_history(self, route):
-        """Добавление маршрута в историю для отчета"""
-        if route and route not in self.settings["report_route_history"]:
-            self.settings["report_route_history"].append(route)
-            self.save_settings()
-    
-    def add_to_combobox_values(self, key, value):
-        """Добавление значения в список значений комбобокса"""
-        if key in self.settings["combobox_values"]:
-            if value and value not in self.settings["combobox_values"][key]:
-                self.settings["combobox_values"][key].append(value)
-                self.save_settings()
-
-class BasePlugin:
-    """Базовый класс для всех плагинов"""
+    # Ядро переименования (RenameService), выставляется менеджером плагинов
+    rename_service = None
     
     def __init__(self, settings, root):
         self.settings = settings
@@ -629,9 +298,10 @@ class BasePlugin:
 class PluginManager:
     """Менеджер плагинов для загрузки дополнительных вкладки"""
     
-    def __init__(self, settings, root):
+    def __init__(self, settings, root, rename_service=None):
         self.settings = settings
         self.root = root
+        self.rename_service = rename_service
         self.plugins = {}
         self.plugin_tabs = {}
     
@@ -676,6 +346,7 @@ class PluginManager:
                     
                     if plugin_class:
                         plugin_instance = plugin_class(self.settings, self.root)
+                        plugin_instance.rename_service = self.rename_service
                         self.plugins[plugin_name] = plugin_instance
                         logging.info(f"Плагин загружен: {plugin_name}")
                     else:
@@ -697,81 +368,38 @@ class PluginManager:
             except Exception as e:
                 logging.error(f"Ошибка создания вкладки для плагина {plugin_name}: {e}")
 
-class FileMonitor:
-    """Класс для мониторинга файлов"""
-    def __init__(self, settings, rename_callback):
-        self.settings = settings
-        self.rename_callback = rename_callback
-        self.observer = None
-        self.event_handler = None
-        self.is_monitoring = False
-    
-    def start_monitoring(self):
-        """Запуск мониторинга"""
-        if self.is_monitoring:
-            return
-        
-        folder = self.settings.settings["folder"]
-        
-        if not os.path.exists(folder):
-            logging.error(f"Папка не существует: {folder}")
-            return False
-        
-        try:
-            self.event_handler = FileHandler(self.settings, self.rename_callback)
-            self.observer = Observer()
-            self.observer.schedule(self.event_handler, folder, recursive=False)
-            self.observer.start()
-            self.is_monitoring = True
-            logging.info(f"Мониторинг запущен: {folder}")
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка запуска мониторинга: {e}")
-            return False
-    
-    def stop_monitoring(self):
-        """Остановка мониторинга"""
-        if self.observer and self.is_monitoring:
-            try:
-                self.observer.stop()
-                self.observer.join()
-                self.is_monitoring = False
-                logging.info("Мониторинг остановлен")
-            except Exception as e:
-                logging.error(f"Ошибка остановки мониторинга: {e}")
-
-class FileHandler(FileSystemEventHandler):
-    """Обработчик событий файловой системы"""
-    def __init__(self, settings, rename_callback):
-        self.settings = settings
-        self.rename_callback = rename_callback
-    
-    def on_created(self, event):
-        """Обработка создания файла с проверкой расширения"""
-        if not event.is_directory:
-            # Проверяем, включен ли мониторинг
-            if self.settings.settings.get("monitoring_enabled", True):
-                # Проверяем расширение файла
-                file_ext = Path(event.src_path).suffix.lower().lstrip('.')
-                extensions = [ext.strip().lower() for ext in self.settings.settings["extensions"].split(",")]
-                
-                if file_ext in extensions:
-                    # Добавляем небольшую задержку для гарантии, что файл полностью создан
-                    threading.Timer(1.0, lambda: self.safe_rename_callback(event.src_path)).start()
-                else:
-                    logging.info(f"Файл {event.src_path} пропущен - расширение {file_ext} не в списке разрешенных")
-    
-    def safe_rename_callback(self, filepath):
-        """Безопасный вызов callback с обработкой исключений"""
-        try:
-            self.rename_callback([filepath])
-        except Exception as e:
-            logging.error(f"Критическая ошибка в обработчике переименования: {e}")
-            # Не падаем, а просто логируем ошибку
-
 class RenamerApp:
     """Главное приложение"""
     
+    # Количество строк отчета, подгружаемых из базы за один раз
+    REPORT_PAGE_SIZE = 500
+    
+    # Способы наблюдения за папками (настройка observer_mode)
+    OBSERVER_MODES = {
+        "auto": "Авто (опрос для сетевых дисков)",
+        "native": "События ОС",
+        "polling": "Опрос папки"
+    }
+    # Интервал обновления таблицы отчета новыми записями (мс, ~30 кадров/с)
+    REPORT_FLUSH_INTERVAL = 33
+    
+    # Окно лога: интервал вывода (мс), время разбора очереди за такт (с)
+    # и число хранимых сообщений
+    LOG_FLUSH_INTERVAL = 100
+    LOG_DRAIN_TIME = 0.02
+    LOG_MAX_LINES = 1000
+    
+    # Наибольшее число результатов поиска по истории
+    SEARCH_LIMIT = 500
+    
+    # Периоды вкладки статистики: название -> число дней (None - вся история)
+    STATS_PERIODS = {
+        "7 дней": 7,
+        "30 дней": 30,
+        "Год": 365,
+        "Все время": None
+    }
+    
     def __init__(self, root):
         self.root = root
         self.root.title(f"EGOK Renamer v{VERSION}")
@@ -784,19 +412,25 @@ class RenamerApp:
         self.developer_info = "Разработчик: @xDream_Master"
         
         self.settings = Settings()
-        self.renamed_files_manager = RenamedFilesManager()
         self.db_manager = DatabaseManager()
+        self.renamed_files_manager = RenamedFilesManager(
+            self.db_manager,
+            max_age_days=self.settings.settings.get("renamed_files_max_age_days", 30),
+            use_fingerprint=self.settings.settings.get("file_fingerprint", False)
+        )
         self.monitor = None
-        self.log_queue = queue.Queue()
+        self.log_queue = deque()
         self.widgets = {}
-        self.log_line_counter = 0
-        self.rename_history = []
+        # Кольцевой буфер числа строк выведенных сообщений (для обрезки лога)
+        self.log_line_counts = deque()
         self.current_route_filter = "Все"
         self.current_date_filter = None
         
-        # Данные для отчета
+        # Данные для отчета (загруженные страницы с учетом фильтров)
         self.report_data = []
-        self.filtered_report_data = []
+        self.report_total = 0
+        self.pending_report_entries = []
+        self.report_flush_scheduled = False
         
         # Заголовки колонок (УДАЛЕНА КОЛОНКА "Исходное имя файла")
         self.column_headers = ["№", "Время создания", "Маршрут", "Новое имя файла"]
@@ -808,11 +442,22 @@ class RenamerApp:
         # Порядок колонок
         self.column_order = self.settings.settings["column_order"]
         
-        # Блокировка для безопасного доступа к общим ресурсам
-        self.rename_lock = threading.Lock()
+        # Ядро переименования (счетчики, шаблон, запись в историю)
+        self.rename_service = RenameService(
+            self.settings, self.db_manager, self.renamed_files_manager,
+            on_renamed=self.on_files_renamed,
+            on_history_changed=self.on_history_changed
+        )
+        
+        # Завершение пачек, прерванных сбоем при прошлом запуске
+        self.rename_service.recover_journal()
+        
+        # Фоновый перенос старой истории в архив и освобождение места в базе
+        self.history_maintenance = HistoryMaintenance(self.db_manager, self.settings)
+        self.history_maintenance.start()
         
         # Инициализация менеджера плагинов
-        self.plugin_manager = PluginManager(self.settings, self.root)
+        self.plugin_manager = PluginManager(self.settings, self.root, self.rename_service)
         
         self.setup_logging()
         self.create_widgets()
@@ -822,6 +467,9 @@ class RenamerApp:
         # Загрузка истории переименований из базы данных
         self.load_report_history()
         
+        # Сверка индекса счетчиков с папкой и историей
+        self.reconcile_counters()
+        
         # Запуск мониторинга если включен
         if self.settings.settings.get("monitoring_enabled", True):
             self.start_monitoring()
@@ -969,10 +617,127 @@ class RenamerApp:
         # Создаем содержимое вкладки ЭГОК с новой структурой
         self.create_egok_tab(self.egok_tab)
         
+        # Вкладка статистики (обновляется при открытии)
+        self.stats_tab = ttk.Frame(self.notebook)
+        self.notebook.add(self.stats_tab, text="Статистика")
+        self.create_stats_tab(self.stats_tab)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_notebook_tab_changed)
+        
         # Загружаем и создаем вкладки плагинов
         self.plugin_manager.load_plugins()
         self.plugin_manager.create_plugin_tabs(self.notebook)
     
+    def create_stats_tab(self, parent):
+        """Создание вкладки статистики переименований (из сводных таблиц базы)"""
+        controls_frame = ttk.Frame(parent)
+        controls_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        ttk.Label(controls_frame, text="Период:").pack(side=tk.LEFT, padx=2)
+        self.stats_period_var = tk.StringVar(value="30 дней")
+        period_cb = ttk.Combobox(controls_frame, textvariable=self.stats_period_var,
+                                 values=list(self.STATS_PERIODS), state="readonly", width=12)
+        period_cb.pack(side=tk.LEFT, padx=2)
+        period_cb.bind("<<ComboboxSelected>>", lambda e: self.load_stats())
+        
+        ttk.Label(controls_frame, text="Маршрут:").pack(side=tk.LEFT, padx=2)
+        self.stats_route_var = tk.StringVar(value="Все")
+        self.stats_route_cb = ttk.Combobox(
+            controls_frame, textvariable=self.stats_route_var, state="readonly", width=15,
+            values=["Все"] + self.settings.settings.get("report_route_history", [])
+        )
+        self.stats_route_cb.pack(side=tk.LEFT, padx=2)
+        self.stats_route_cb.bind("<<ComboboxSelected>>", lambda e: self.load_stats())
+        
+        ttk.Button(controls_frame, text="Обновить", command=self.load_stats).pack(side=tk.LEFT, padx=5)
+        
+        self.stats_total_label = ttk.Label(controls_frame, text="")
+        self.stats_total_label.pack(side=tk.RIGHT, padx=5)
+        
+        # График по дням
+        days_frame = ttk.LabelFrame(parent, text="По дням")
+        days_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.stats_canvas = tk.Canvas(days_frame, background="white", height=220)
+        self.stats_canvas.pack(fill=tk.BOTH, expand=True)
+        self.stats_canvas.bind("<Configure>", lambda e: self.draw_stats_chart())
+        
+        # Таблицы по маршрутам и по часам
+        tables_frame = ttk.Frame(parent)
+        tables_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        
+        self.stats_tables = {}
+        for key, title, column in (("routes", "По маршрутам", "Маршрут"), ("hours", "По часам", "Час")):
+            frame = ttk.LabelFrame(tables_frame, text=title)
+            frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=2)
+            tree = ttk.Treeview(frame, columns=("key", "count"), show="headings", height=10)
+            tree.heading("key", text=column)
+            tree.heading("count", text="Переименовано")
+            tree.column("count", anchor=tk.E)
+            scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+            tree.configure(yscrollcommand=scrollbar.set)
+            tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            self.stats_tables[key] = tree
+        
+        self.stats_summary = None
+    
+    def load_stats(self):
+        """Загрузка статистики за выбранный период в фоновом потоке"""
+        days = self.STATS_PERIODS.get(self.stats_period_var.get())
+        date_from = (date.today() - timedelta(days=days - 1)).isoformat() if days else None
+        route = None if self.stats_route_var.get() == "Все" else self.stats_route_var.get()
+        
+        def load():
+            summary = self.db_manager.get_summary(date_from=date_from, route=route)
+            self.root.after(0, lambda: self.show_stats(summary))
+        
+        self.stats_route_cb['values'] = ["Все"] + self.settings.settings.get("report_route_history", [])
+        threading.Thread(target=load, daemon=True).start()
+    
+    def show_stats(self, summary):
+        """Вывод статистики на вкладку"""
+        self.stats_summary = summary
+        self.stats_total_label.config(text=f"Всего за период: {summary['total']}")
+        
+        for key, tree in self.stats_tables.items():
+            tree.delete(*tree.get_children())
+            for name, count in summary[key]:
+                tree.insert("", tk.END, values=(f"{name:02d}:00" if key == "hours" else name, count))
+        
+        self.draw_stats_chart()
+    
+    def draw_stats_chart(self):
+        """Столбчатая диаграмма переименований по дням"""
+        canvas = self.stats_canvas
+        canvas.delete("all")
+        if not self.stats_summary or not self.stats_summary["days"]:
+            canvas.create_text(canvas.winfo_width() // 2, canvas.winfo_height() // 2,
+                               text="Нет данных за период", fill="gray")
+            return
+        
+        days = self.stats_summary["days"]
+        width = max(canvas.winfo_width(), 100)
+        height = max(canvas.winfo_height(), 100)
+        margin = 30
+        max_count = max(count for _, count in days) or 1
+        bar_width = (width - 2 * margin) / len(days)
+        # Подписи дат - не чаще чем раз в 70 пикселей
+        label_step = max(1, int(70 // bar_width) + 1)
+        
+        for i, (day, count) in enumerate(days):
+            x0 = margin + i * bar_width
+            bar_height = (height - 2 * margin) * count / max_count
+            canvas.create_rectangle(x0 + 1, height - margin - bar_height,
+                                    x0 + max(bar_width - 1, 2), height - margin,
+                                    fill="steelblue", outline="")
+            if i % label_step == 0:
+                canvas.create_text(x0 + bar_width / 2, height - margin + 10, text=day[5:], font=("Arial", 8))
+        canvas.create_text(margin, margin / 2, text=f"макс. {max_count}", anchor=tk.W, font=("Arial", 8))
+    
+    def on_notebook_tab_changed(self, event):
+        """Открыта вкладка статистики - перечитываем сводки"""
+        if self.notebook.select() == str(self.stats_tab):
+            self.load_stats()
+    
     def create_egok_tab(self, parent):
         """Создание основной вкладки ЭГОК с новой структурой"""
         # Создаем PanedWindow для разделения на левую и правую часть
@@ -1101,6 +866,7 @@ class RenamerApp:
         folder_cb.bind('<FocusOut>', lambda e: self.on_folder_selected())
         
         ttk.Button(folder_frame, text="Обзор", command=self.browse_folder).pack(side=tk.LEFT)
+        ttk.Button(folder_frame, text="Папки...", command=self.show_watch_profiles_dialog).pack(side=tk.LEFT, padx=2)
         
         # Расширения файлов
         ext_frame = ttk.Frame(rename_frame)
@@ -1153,6 +919,42 @@ class RenamerApp:
             variable=self.rename_only_today_var
         )
         rename_only_today_cb.pack(anchor=tk.W)
+        
+        # Опция переименовывать файлы, появившиеся пока мониторинг был выключен
+        self.catch_up_on_start_var = tk.BooleanVar(value=self.settings.settings.get("catch_up_on_start", True))
+        self.widgets["catch_up_on_start_var"] = self.catch_up_on_start_var
+        
+        ttk.Checkbutton(
+            today_only_frame,
+            text="Переименовывать файлы, появившиеся пока мониторинг был выключен",
+            variable=self.catch_up_on_start_var
+        ).pack(anchor=tk.W)
+        
+        # Опция следить за подпапками основной папки
+        self.recursive_watch_var = tk.BooleanVar(value=self.settings.settings.get("recursive_watch", False))
+        self.widgets["recursive_watch_var"] = self.recursive_watch_var
+        
+        ttk.Checkbutton(
+            today_only_frame,
+            text="Следить также за подпапками",
+            variable=self.recursive_watch_var
+        ).pack(anchor=tk.W)
+        
+        # Способ наблюдения: события ОС или опрос папки (сетевые диски, кардридеры)
+        observer_frame = ttk.Frame(rename_frame)
+        observer_frame.pack(fill=tk.X, pady=2)
+        ttk.Label(observer_frame, text="Наблюдение:").pack(side=tk.LEFT)
+        
+        current_mode = self.settings.settings.get("observer_mode", "auto")
+        observer_mode_var = tk.StringVar(value=self.OBSERVER_MODES.get(current_mode, self.OBSERVER_MODES["auto"]))
+        self.widgets["observer_mode_var"] = observer_mode_var
+        ttk.Combobox(
+            observer_frame,
+            textvariable=observer_mode_var,
+            values=list(self.OBSERVER_MODES.values()),
+            state="readonly",
+            width=32
+        ).pack(side=tk.LEFT, padx=5)
     
     def open_template_builder(self):
         """Открытие конструктора шаблонов"""
@@ -1208,6 +1010,7 @@ class RenamerApp:
         ttk.Button(report_controls_frame, text="Копировать все", command=self.copy_all_files).pack(side=tk.LEFT, padx=2)
         ttk.Button(report_controls_frame, text="Очистить отчет", command=self.clear_report).pack(side=tk.LEFT, padx=2)
         ttk.Button(report_controls_frame, text="Экспорт в файл", command=self.export_report).pack(side=tk.LEFT, padx=2)
+        ttk.Button(report_controls_frame, text="Предпросмотр", command=self.show_rename_preview).pack(side=tk.LEFT, padx=2)
         
         # Фильтр по маршруту и дате
         filter_frame = ttk.Frame(report_controls_frame)
@@ -1259,6 +1062,20 @@ class RenamerApp:
         # Кнопка обновления списка дат
         ttk.Button(date_filter_frame, text="Обновить", command=self.update_date_filter).pack(side=tk.LEFT, padx=2)
         
+        # Поиск по истории: исходное имя по новому и наоборот
+        search_frame = ttk.Frame(report_frame)
+        search_frame.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(search_frame, text="Поиск:").pack(side=tk.LEFT, padx=2)
+        self.search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        search_entry.bind("<Return>", lambda e: self.search_history())
+        ttk.Button(search_frame, text="Найти", command=self.search_history).pack(side=tk.LEFT, padx=2)
+        
+        # Количество показанных записей (строки подгружаются при прокрутке)
+        self.report_count_var = tk.StringVar(value="")
+        ttk.Label(report_frame, textvariable=self.report_count_var, foreground="gray").pack(side=tk.BOTTOM, anchor=tk.E, padx=5)
+        
         # Фрейм для таблицы отчета
         table_frame = ttk.Frame(report_frame)
         table_frame.pack(fill=tk.BOTH, expand=True)
@@ -1271,6 +1088,9 @@ class RenamerApp:
         
         # Применяем настройки видимости колонок
         self.apply_column_visibility()
+        
+        # Следим за прокруткой для подгрузки страниц отчета
+        self.root.after(300, self.check_report_scroll)
     
     def create_sheet_table(self, parent):
         """Создание продвинутой таблицы с улучшенным выделением как в Excel"""
@@ -1401,6 +1221,9 @@ class RenamerApp:
         # Дополнительные функции
         self.enhanced_context_menu.add_command(label="Экспорт выделенного", command=self.export_selected)
         self.enhanced_context_menu.add_command(label="Очистить отчет", command=self.clear_report)
+        self.enhanced_context_menu.add_separator()
+        self.enhanced_context_menu.add_command(label="Отменить последнюю пачку", command=self.undo_last_batch)
+        self.enhanced_context_menu.add_command(label="Отменить по фильтру", command=self.undo_filtered)
         
         logging.info("Улучшенное контекстное меню создано")
     
@@ -1436,6 +1259,9 @@ class RenamerApp:
         self.report_context_menu.add_command(label="Копировать всю таблицу", command=self.copy_all_files)
         self.report_context_menu.add_separator()
         self.report_context_menu.add_command(label="Очистить отчет", command=self.clear_report)
+        self.report_context_menu.add_separator()
+        self.report_context_menu.add_command(label="Отменить последнюю пачку", command=self.undo_last_batch)
+        self.report_context_menu.add_command(label="Отменить по фильтру", command=self.undo_filtered)
         
         # Привязываем контекстное меню
         self.report_tree.bind("<Button-3>", self.show_report_context_menu)
@@ -1553,27 +1379,23 @@ class RenamerApp:
             )
             
             if file_path:
-                # Получаем выделенные данные
-                data_to_export = []
+                # Данные таблицы читаются один раз, а не по ячейке
+                sheet_data = self.report_sheet.get_sheet_data()
                 
-                # Собираем строки с данными
+                # Собираем выделенные столбцы по строкам
                 rows_data = {}
                 for row, col in selected:
-                    if row not in rows_data:
-                        rows_data[row] = {}
-                    cell_value = self.report_sheet.get_cell_data(row, col)
-                    rows_data[row][col] = cell_value if cell_value is not None else ""
+                    rows_data.setdefault(row, set()).add(col)
                 
-                # Сортируем по строкам и столбцам
-                for row in sorted(rows_data.keys()):
-                    row_data = []
-                    for col in sorted(rows_data[row].keys()):
-                        row_data.append(str(rows_data[row][col]))
-                    data_to_export.append(",".join(row_data))
-                
-                # Записываем в файл
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("\n".join(data_to_export))
+                # Записываем в файл, строки и столбцы по порядку
+                with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f)
+                    for row in sorted(rows_data):
+                        values = sheet_data[row] if row < len(sheet_data) else []
+                        writer.writerow([
+                            values[col] if col < len(values) and values[col] is not None else ""
+                            for col in sorted(rows_data[row])
+                        ])
                 
                 messagebox.showinfo("Успех", f"Данные экспортированы в:\n{file_path}")
                 
@@ -1767,81 +1589,103 @@ class RenamerApp:
             raise
     
     def clear_report(self):
-        """Очистить отчет"""
-        if messagebox.askyesno("Подтверждение", "Очистить отчет о переименованных файлах?"):
+        """Очистить отчет (записи переносятся в архив по месяцам)"""
+        if messagebox.askyesno("Подтверждение", "Очистить отчет о переименованных файлах?\n"
+                               f"Записи будут перенесены в архив: {self.db_manager.archive_dir}"):
+            self.report_data = []
             if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
-                self.report_sheet.set_sheet_data([])
-                self.report_data = []
+                self.report_sheet.set_sheet_data(self.report_data)
             elif hasattr(self, 'report_tree'):
                 for item in self.report_tree.get_children():
                     self.report_tree.delete(item)
+            self.report_total = 0
+            self.update_report_count_label()
             
-            self.rename_history.clear()
             # Сбрасываем фильтры
             self.route_filter_var.set("Все")
             self.date_filter_var.set("Все даты")
             self.current_route_filter = "Все"
             self.current_date_filter = None
             
-            # Очищаем базу данных
-            self.db_manager.clear_all_records()
-            
-            logging.info("Отчет о переименованных файлах очищен")
+            # Переносим историю в архив и очищаем базу в фоне. Переименования на
+            # это время ждут: запись, добавленная между переносом и очисткой,
+            # была бы удалена без копии в архиве
+            def clear_history():
+                with self.rename_service.rename_lock:
+                    self.db_manager.archive_records()
+                    self.db_manager.clear_all_records(keep_summaries=True)
+                self.reconcile_counters()
+                self.history_maintenance.wake()
+                self.root.after(0, self.update_date_filter)
+                logging.info("Отчет о переименованных файлах очищен")
+            
+            threading.Thread(target=clear_history, daemon=True).start()
+    
+    def undo_last_batch(self):
+        """Отмена последней пачки переименований"""
+        if messagebox.askyesno("Подтверждение", "Вернуть исходные имена файлам последней пачки?"):
+            threading.Thread(target=self.rename_service.undo_last_batch, daemon=True).start()
+    
+    def undo_filtered(self):
+        """Отмена всех переименований по текущему фильтру отчета (маршрут и дата)"""
+        route, target_date = self.get_report_filter()
+        if not route and not target_date:
+            messagebox.showwarning("Внимание", "Выберите маршрут или дату в фильтре отчета")
+            return
+        
+        count = self.db_manager.count_records(route, target_date)
+        description = ", ".join(part for part in (
+            f"маршрут {route}" if route else "", f"дата {target_date}" if target_date else ""
+        ) if part)
+        if messagebox.askyesno("Подтверждение",
+                               f"Вернуть исходные имена {count} файлам ({description})?"):
+            threading.Thread(target=self.rename_service.undo, args=(route, target_date), daemon=True).start()
+    
+    def on_history_changed(self):
+        """История изменена (отмена переименований) - перечитываем отчет из потока GUI"""
+        def reload():
+            self.update_date_filter()
+            self.load_report_history()
+        self.root.after(0, reload)
     
     def export_report(self):
-        """Экспорт отчета в файл"""
-        if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
-            data = self.report_sheet.get_sheet_data()
-            if not data or len(data) == 0:
-                messagebox.showwarning("Внимание", "В отчете нет данных для экспорта")
-                return
-        elif hasattr(self, 'report_tree'):
-            all_items = self.report_tree.get_children()
-            if not all_items:
-                messagebox.showwarning("Внимание", "В отчете нет данных для экспорта")
-                return
-        else:
-            messagebox.showwarning("Внимание", "Отчет не инициализирован")
+        """Экспорт отчета в файл (CSV, Excel или Parquet)
+        
+        Выгружаются все записи по текущим фильтрам прямо из базы, а не
+        только подгруженные в таблицу. Экспорт идет в фоновом потоке.
+        """
+        route, target_date = self.get_report_filter()
+        if not self.db_manager.count_records(route, target_date):
+            messagebox.showwarning("Внимание", "В отчете нет данных для экспорта")
             return
         
+        filetypes = [
+            (f"{ReportExporter.FORMATS[fmt][0]} files", f"*{ReportExporter.FORMATS[fmt][1]}")
+            for fmt in ReportExporter.available_formats()
+        ]
         file_path = filedialog.asksaveasfilename(
-            defaultextension=".txt",
-            filetypes=[("Text files", "*.txt"), ("CSV files", "*.csv"), ("All files", "*.*")],
+            defaultextension=".csv",
+            filetypes=filetypes + [("All files", "*.*")],
             title="Экспорт отчета"
         )
+        if not file_path:
+            return
         
-        if file_path:
+        def run_export():
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write("Отчет о переименованных файлах\n")
-                    f.write("=" * 80 + "\n")
-                    f.write(f"Создан: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-                    f.write(f"Фильтр по маршруту: {self.current_route_filter}\n")
-                    f.write(f"Фильтр по дате: {self.current_date_filter or 'Все даты'}\n")
-                    f.write("=" * 80 + "\n")
-                    f.write("№\tВремя\tМаршрут\tНовое имя\n")  # УДАЛЕНА КОЛОНКА "Исходное имя"
-                    f.write("-" * 80 + "\n")
-                    
-                    if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
-                        # Экспорт данных из tksheet
-                        for row in self.report_sheet.get_sheet_data():
-                            if row and any(cell is not None for cell in row):
-                                f.write(f"{row[0] or ''}\t{row[1] or ''}\t{row[2] or ''}\t{row[3] or ''}\n")  # УДАЛЕНА КОЛОНКА
-                    else:
-                        # Экспорт данных из Treeview
-                        for item in self.report_tree.get_children():
-                            values = self.report_tree.item(item, "values")
-                            if values and len(values) > 3:  # Теперь 4 колонки вместо 5
-                                f.write(f"{values[0]}\t{values[1]}\t{values[2]}\t{values[3]}\n")  # УДАЛЕНА КОЛОНКА
-                
-                messagebox.showinfo("Успех", f"Отчет экспортирован в файл:\n{file_path}")
-                logging.info(f"Отчет экспортирован в файл: {file_path}")
+                rows = ReportExporter(self.db_manager).export(file_path, route=route, target_date=target_date)
+                self.root.after(0, lambda: messagebox.showinfo(
+                    "Успех", f"Отчет экспортирован в файл ({rows} записей):\n{file_path}"))
             except Exception as e:
                 logging.error(f"Ошибка экспорта отчета: {e}")
-                messagebox.showerror("Ошибка", f"Ошибка экспорта отчета: {e}")
+                self.root.after(0, lambda: messagebox.showerror("Ошибка", f"Ошибка экспорта отчета: {e}"))
+        
+        logging.info(f"Экспорт отчета: маршрут={self.current_route_filter}, "
+                     f"дата={self.current_date_filter or 'Все даты'}")
+        threading.Thread(target=run_export, daemon=True).start()
     
-    def add_to_report(self, original_name, new_name, filepath, create_time=None):
-        """Добавление записи в отчет о переименовании"""
+    def add_to_report(self, original_name, new_name, filepath, create_time=None, route=None):
+        """Добавление записи в отчет о переименовании (запись в БД делает rename_files)"""
         # Если время не передано, пытаемся получить из файла
         if create_time is None:
             try:
@@ -1850,48 +1694,86 @@ class RenamerApp:
                 logging.error(f"Ошибка получения времени создания файла {filepath}: {e}")
                 create_time = datetime.now().strftime('%H:%M:%S')
         
-        # Получаем текущий маршрут из настроек
-        route = self.settings.settings["route"]
-        
-        # Добавляем маршрут в историю для фильтра
-        if route not in self.settings.settings.get("report_route_history", []):
-            self.settings.add_to_route_history(route)
-            # Обновляем комбобокс фильтра
-            self.update_route_filter_combobox()
+        # Маршрут на момент переименования, иначе текущий из настроек
+        if route is None:
+            route = self.settings.settings["route"]
         
-        # Номер строки
-        number = len(self.rename_history) + 1
+        self.add_batch_to_report([(original_name, new_name, create_time, route)])
+    
+    def add_batch_to_report(self, entries):
+        """Постановка пачки записей в очередь отчета
         
-        # Добавляем в историю
-        self.rename_history.append({
-            "number": number,
-            "create_time": create_time,
-            "route": route,
-            "new_name": new_name
-        })
+        entries - список кортежей (исходное имя, новое имя, время создания, маршрут).
+        Таблица обновляется не чаще одного раза за REPORT_FLUSH_INTERVAL мс,
+        сколько бы пачек ни пришло за это время.
+        """
+        if not entries:
+            return
         
-        # Создаем строку данных (УДАЛЕНА КОЛОНКА "original_name")
-        row_data = [number, create_time, route, new_name]
+        for entry in entries:
+            route = entry[3]
+            # Добавляем маршрут в историю для фильтра
+            if route not in self.settings.settings.get("report_route_history", []):
+                self.settings.add_to_route_history(route)
+                # Обновляем комбобокс фильтра
+                self.update_route_filter_combobox()
         
-        # Добавляем в данные отчета
-        self.report_data.append(row_data)
+        self.pending_report_entries.extend(entries)
+        if not self.report_flush_scheduled:
+            self.report_flush_scheduled = True
+            self.root.after(self.REPORT_FLUSH_INTERVAL, self.flush_report_entries)
+    
+    def flush_report_entries(self):
+        """Вставка накопленных записей в начало отчета без перестроения таблицы"""
+        entries = self.pending_report_entries
+        self.pending_report_entries = []
+        self.report_flush_scheduled = False
+        if not entries:
+            return
         
-        # Сохраняем в базу данных
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.db_manager.add_record(timestamp, route, original_name, new_name, filepath)
+        filter_route, filter_date = self.get_report_filter()
+        today = datetime.now().strftime("%Y-%m-%d")
         
-        # Добавляем в таблицу
-        if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
-            self.report_sheet.set_sheet_data(self.report_data)
-        elif hasattr(self, 'report_tree'):
-            values = (number, create_time, route, new_name)  # УДАЛЕНА КОЛОНКА "original_name"
-            item_id = self.report_tree.insert("", tk.END, values=values)
+        new_rows = []
+        for original_name, new_name, create_time, route in entries:
+            # В таблицу попадают только записи, подходящие под текущие фильтры
+            if (filter_route and route != filter_route) or (filter_date and filter_date != today):
+                continue
+            
+            # Номер строки - порядковый номер записи, поэтому старые строки не перенумеровываются
+            self.report_total += 1
+            number = self.report_total
             
-            # Автоматически прокручиваем к последней записи
-            self.report_tree.see(item_id)
+            # Создаем строку данных (УДАЛЕНА КОЛОНКА "original_name")
+            new_rows.append([number, create_time, route, new_name])
+        
+        # Новые записи сверху, как и в загруженной из базы истории
+        new_rows.reverse()
+        self.insert_report_rows(new_rows, 0)
+        self.update_report_count_label()
         
         # Логируем добавление в отчет
-        logging.info(f"Добавлено в отчет: {original_name} -> {new_name}")
+        if len(entries) == 1:
+            logging.info(f"Добавлено в отчет: {entries[0][0]} -> {entries[0][1]}")
+        else:
+            logging.info(f"Добавлено в отчет: {len(entries)} файлов")
+    
+    def insert_report_rows(self, rows, index):
+        """Вставка строк в данные отчета и таблицу начиная с позиции index
+        
+        Данные хранит report_data: строки вставляются в него, и таблица
+        tksheet заново получает ссылку на этот список (без копирования строк).
+        """
+        if not rows:
+            return
+        
+        self.report_data[index:index] = rows
+        
+        if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
+            self.report_sheet.set_sheet_data(self.report_data, reset_col_positions=False, redraw=True)
+        elif hasattr(self, 'report_tree'):
+            for offset, row in enumerate(rows):
+                self.report_tree.insert("", index + offset, values=tuple(row))
     
     def is_record_from_today(self, timestamp):
         """Проверяет, относится ли запись к сегодняшней дате"""
@@ -1902,39 +1784,93 @@ class RenamerApp:
         except:
             return False
     
+    def get_report_filter(self):
+        """Текущие фильтры отчета в виде параметров запроса к базе"""
+        route = None if self.current_route_filter == "Все" else self.current_route_filter
+        return route, self.current_date_filter
+    
+    def record_to_report_row(self, number, record):
+        """Преобразование записи базы в строку отчета (УДАЛЕНА КОЛОНКА "original_name")"""
+        return [
+            number,
+            record['timestamp'].split(' ')[1] if ' ' in record['timestamp'] else record['timestamp'],
+            record['route'],
+            record['new_name']
+        ]
+    
     def load_report_history(self):
-        """Загрузка истории переименований из базы данных"""
+        """Загрузка первой страницы истории переименований с учетом фильтров"""
         try:
-            records = self.db_manager.get_records_by_date()
-            
-            # Преобразуем записи в формат для отчета (УДАЛЕНА КОЛОНКА "original_name")
+            route, target_date = self.get_report_filter()
+            self.report_total = self.db_manager.count_records(route, target_date)
             self.report_data = []
-            for i, record in enumerate(records):
-                row_data = [
-                    i + 1,
-                    record['timestamp'].split(' ')[1] if ' ' in record['timestamp'] else record['timestamp'],
-                    record['route'],
-                    record['new_name']  # УДАЛЕНА КОЛОНКА "original_name"
-                ]
-                self.report_data.append(row_data)
-            
-            # Обновляем таблицу
+            # Ожидающие записи уже в базе и попадут в первую страницу
+            self.pending_report_entries = []
+            
+            # Очищаем таблицу
             if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
                 self.report_sheet.set_sheet_data(self.report_data)
             elif hasattr(self, 'report_tree'):
                 for item in self.report_tree.get_children():
                     self.report_tree.delete(item)
-                
-                for row in self.report_data:
-                    self.report_tree.insert("", tk.END, values=tuple(row))
+            
+            self.load_next_report_page()
             
             # Обновляем список дат в фильтре
             self.update_date_filter()
             
-            logging.info(f"Загружено {len(records)} записей из истории")
+            logging.info(f"Загружено {len(self.report_data)} из {self.report_total} записей истории")
         except Exception as e:
             logging.error(f"Ошибка загрузки истории отчета: {e}")
     
+    def load_next_report_page(self):
+        """Подгрузка следующей страницы отчета из базы данных"""
+        # Новые записи уже в базе - вставляем их до расчета смещения страницы
+        if self.pending_report_entries:
+            self.flush_report_entries()
+        
+        offset = len(self.report_data)
+        if offset >= self.report_total:
+            return
+        
+        route, target_date = self.get_report_filter()
+        records = self.db_manager.get_records_page(route, target_date, self.REPORT_PAGE_SIZE, offset)
+        
+        # Новые записи сверху, номер строки - порядковый номер записи с начала истории
+        new_rows = [self.record_to_report_row(self.report_total - offset - i, record)
+                    for i, record in enumerate(records)]
+        self.insert_report_rows(new_rows, offset)
+        
+        self.update_report_count_label()
+    
+    def update_report_count_label(self):
+        """Обновление надписи с количеством показанных записей"""
+        if hasattr(self, 'report_count_var'):
+            self.report_count_var.set(f"Показано {len(self.report_data)} из {self.report_total}")
+    
+    def check_report_scroll(self):
+        """Подгрузка следующей страницы, когда таблица прокручена почти до конца
+        
+        Если версия tksheet не сообщает положение прокрутки (нет get_yview),
+        страницы подгружаются подряд, пока не будет загружен весь отчет.
+        """
+        try:
+            if len(self.report_data) < self.report_total:
+                if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
+                    get_yview = getattr(self.report_sheet, "get_yview", None)
+                    _, last = get_yview() if get_yview else (0, 1.0)
+                elif hasattr(self, 'report_tree'):
+                    _, last = self.report_tree.yview()
+                else:
+                    last = 0
+                
+                if last >= 0.9:
+                    self.load_next_report_page()
+        except Exception as e:
+            logging.error(f"Ошибка подгрузки отчета: {e}")
+        finally:
+            self.root.after(300, self.check_report_scroll)
+    
     def update_route_filter_combobox(self):
         """Обновление комбобокса фильтра по маршруту"""
         # Обновляем значения комбобокса фильтра
@@ -1966,14 +1902,13 @@ class RenamerApp:
             # Устанавливаем видимые колонки через свойство visible_columns
             try:
                 self.report_sheet.visible_columns = columns_to_show
-                # ОБНОВЛЯЕМ ДАННЫЕ В ТАБЛИЦЕ - ИСПРАВЛЕНИЕ БАГА
-                self.report_sheet.set_sheet_data(self.report_data)
             except AttributeError:
                 # Для старых версий tksheet
                 logging.warning("Свойство visible_columns недоступно, используется display_columns")
                 self.report_sheet.display_columns(columns_to_show)
-                # ОБНОВЛЯЕМ ДАННЫЕ В ТАБЛИЦЕ - ИСПРАВЛЕНИЕ БАГА
-                self.report_sheet.set_sheet_data(self.report_data)
+            
+            # Данные не менялись - достаточно перерисовать таблицу
+            self.report_sheet.refresh()
                 
         elif hasattr(self, 'report_tree'):
             # Для Treeview определяем видимые колонки в правильном порядке
@@ -2006,38 +1941,8 @@ class RenamerApp:
         self.apply_filters()
     
     def apply_filters(self):
-        """Применение всех активных фильтров"""
-        if TKSHEET_AVAILABLE and hasattr(self, 'report_sheet'):
-            # Для tksheet фильтруем данные
-            filtered_data = []
-            
-            for row in self.report_data:
-                route_match = (self.current_route_filter == "Все" or 
-                              (len(row) > 2 and row[2] == self.current_route_filter))
-                
-                # Для фильтрации по дате нам нужно получить полные данные из БД
-                # Пока пропускаем фильтрацию по дате для tksheet для простоты
-                if route_match:
-                    filtered_data.append(row)
-            
-            self.report_sheet.set_sheet_data(filtered_data)
-        elif hasattr(self, 'report_tree'):
-            # Для Treeview показываем/скрываем элементы в соответствии с фильтрами
-            all_items = self.report_tree.get_children()
-            
-            for item in all_items:
-                values = self.report_tree.item(item, "values")
-                if len(values) > 2:
-                    route = values[2]  # values[2] - колонка с маршрутом
-                    route_match = (self.current_route_filter == "Все" or route == self.current_route_filter)
-                    
-                    # Пока пропускаем фильтрацию по дате для Treeview для простоты
-                    if route_match:
-                        # Показываем элемент
-                        self.report_tree.attach(item, '', 'end')
-                    else:
-                        # Скрываем элемент (но не удаляем)
-                        self.report_tree.detach(item)
+        """Применение всех активных фильтров (фильтрация выполняется запросом к базе)"""
+        self.load_report_history()
         
         logging.info(f"Применены фильтры: маршрут={self.current_route_filter}, дата={self.current_date_filter or 'Все даты'}")
     
@@ -2186,6 +2091,139 @@ class RenamerApp:
         
         ttk.Button(main_frame, text="Сохранить", command=save_plugins).pack(pady=10)
     
+    def show_watch_profiles_dialog(self):
+        """Диалог дополнительных папок наблюдения со своим маршрутом и шаблоном"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Папки наблюдения")
+        dialog.geometry("760x420")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        main_frame = ttk.Frame(dialog, padding="10")
+        main_frame.pack(fill=tk.BOTH, expand=True)
+        
+        ttk.Label(
+            main_frame,
+            text="Дополнительные папки. Пустой маршрут или шаблон - как в основных настройках.",
+            font=('Arial', 9)
+        ).pack(anchor=tk.W, pady=(0, 5))
+        
+        profiles = [dict(profile) for profile in self.settings.settings.get("watch_profiles", [])]
+        
+        columns = ("folder", "recursive", "route", "template", "counter_namespace")
+        tree = ttk.Treeview(main_frame, columns=columns, show="headings", height=8, selectmode='browse')
+        for column, title, width in zip(columns, ("Папка", "Подпапки", "Маршрут", "Шаблон", "Счетчик"),
+                                        (250, 70, 80, 230, 80)):
+            tree.heading(column, text=title)
+            tree.column(column, width=width, stretch=column in ("folder", "template"))
+        tree.pack(fill=tk.BOTH, expand=True)
+        
+        def refresh_tree():
+            tree.delete(*tree.get_children())
+            for profile in profiles:
+                tree.insert("", tk.END, values=(
+                    profile["folder"], "да" if profile.get("recursive") else "нет",
+                    profile.get("route", ""), profile.get("template", ""),
+                    profile.get("counter_namespace", "")
+                ))
+        
+        # Поля выбранного профиля
+        form = ttk.Frame(main_frame)
+        form.pack(fill=tk.X, pady=5)
+        folder_var = tk.StringVar()
+        recursive_var = tk.BooleanVar(value=False)
+        route_var = tk.StringVar()
+        template_var = tk.StringVar()
+        namespace_var = tk.StringVar()
+        
+        ttk.Label(form, text="Папка:").grid(row=0, column=0, sticky=tk.W)
+        ttk.Entry(form, textvariable=folder_var, width=50).grid(row=0, column=1, columnspan=3, sticky=tk.EW, padx=5)
+        ttk.Button(form, text="Обзор",
+                   command=lambda: folder_var.set(filedialog.askdirectory() or folder_var.get())
+                   ).grid(row=0, column=4, padx=2)
+        ttk.Checkbutton(form, text="Подпапки", variable=recursive_var).grid(row=0, column=5, padx=5)
+        
+        ttk.Label(form, text="Маршрут:").grid(row=1, column=0, sticky=tk.W)
+        ttk.Combobox(form, textvariable=route_var, width=12,
+                     values=self.settings.settings.get("combobox_values", {}).get("route", [])
+                     ).grid(row=1, column=1, sticky=tk.W, padx=5)
+        ttk.Label(form, text="Шаблон:").grid(row=1, column=2, sticky=tk.E)
+        ttk.Combobox(form, textvariable=template_var, width=35,
+                     values=self.settings.settings.get("template_history", [])
+                     ).grid(row=1, column=3, sticky=tk.EW, padx=5)
+        ttk.Label(form, text="Счетчик:").grid(row=1, column=4, sticky=tk.E)
+        ttk.Entry(form, textvariable=namespace_var, width=10).grid(row=1, column=5, padx=5)
+        form.columnconfigure(3, weight=1)
+        
+        def read_form():
+            folder = folder_var.get().strip()
+            if not folder:
+                messagebox.showwarning("Внимание", "Укажите папку", parent=dialog)
+                return None
+            profile = {"folder": folder, "recursive": recursive_var.get()}
+            for key, var in (("route", route_var), ("template", template_var),
+                             ("counter_namespace", namespace_var)):
+                if var.get().strip():
+                    profile[key] = var.get().strip()
+            return profile
+        
+        def selected_index():
+            selection = tree.selection()
+            return tree.index(selection[0]) if selection else None
+        
+        def on_select(event=None):
+            index = selected_index()
+            if index is None:
+                return
+            profile = profiles[index]
+            folder_var.set(profile["folder"])
+            recursive_var.set(bool(profile.get("recursive")))
+            route_var.set(profile.get("route", ""))
+            template_var.set(profile.get("template", ""))
+            namespace_var.set(profile.get("counter_namespace", ""))
+        
+        def add_profile():
+            profile = read_form()
+            if profile:
+                profiles.append(profile)
+                refresh_tree()
+        
+        def update_profile():
+            index = selected_index()
+            profile = read_form()
+            if index is not None and profile:
+                profiles[index] = profile
+                refresh_tree()
+        
+        def remove_profile():
+            index = selected_index()
+            if index is not None:
+                del profiles[index]
+                refresh_tree()
+        
+        def save_profiles():
+            self.settings.update_setting("watch_profiles", profiles)
+            logging.info(f"Папки наблюдения сохранены: {len(profiles)} дополнительных")
+            dialog.destroy()
+            self.restart_monitoring()
+        
+        tree.bind('<<TreeviewSelect>>', on_select)
+        refresh_tree()
+        
+        button_frame = ttk.Frame(main_frame)
+        button_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(button_frame, text="Добавить", command=add_profile).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Изменить", command=update_profile).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Удалить", command=remove_profile).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="Сохранить", command=save_profiles).pack(side=tk.RIGHT, padx=2)
+    
+    def restart_monitoring(self):
+        """Перезапуск мониторинга после изменения папок наблюдения"""
+        self.reconcile_counters()
+        if self.monitor and self.monitor.is_monitoring:
+            self.monitor.stop_monitoring()
+            self.start_monitoring()
+    
     def on_folder_selected(self):
         """Обработка выбора папки из истории"""
         if "folder_var" in self.widgets:
@@ -2198,6 +2236,7 @@ class RenamerApp:
                 # Обновляем настройки
                 self.settings.update_setting("folder", folder)
                 self.settings.add_to_folder_history(folder)
+                self.reconcile_counters()
                 
                 # Перезапускаем мониторинг если он был активен
                 if self.settings.settings.get("monitoring_enabled", False):
@@ -2232,6 +2271,7 @@ class RenamerApp:
                 self.widgets["folder_var"].set(folder)
             self.settings.update_setting("folder", folder)
             self.settings.add_to_folder_history(folder)
+            self.reconcile_counters()
             
             # Перезапускаем мониторинг если он был активен
             if self.settings.settings.get("monitoring_enabled", False):
@@ -2243,13 +2283,139 @@ class RenamerApp:
         """Проверка шаблона"""
         try:
             example = self.generate_filename("example.jpg")
-            messagebox.showinfo("Проверка шаблона", f"Пример имени файла:\n{example}")
+            unknown = self.get_compiled_template().unknown_placeholders
+            if unknown:
+                messagebox.showwarning(
+                    "Проверка шаблона",
+                    f"Неизвестные переменные: {', '.join(unknown)}\n\nПример имени файла:\n{example}"
+                )
+            else:
+                messagebox.showinfo("Проверка шаблона", f"Пример имени файла:\n{example}")
             logging.info(f"Проверка шаблона: {example}")
         except Exception as e:
             error_msg = f"Ошибка в шаблоне: {e}"
             logging.error(error_msg)
             messagebox.showerror("Ошибка", error_msg)
     
+    def show_rename_preview(self):
+        """Предпросмотр переименования ожидающих файлов всех папок наблюдения"""
+        def build_plan():
+            items = self.rename_service.preview_all()
+            self.root.after(0, lambda: self.show_rename_plan_dialog(items))
+        
+        logging.info("Построение плана переименования...")
+        threading.Thread(target=build_plan, daemon=True).start()
+    
+    def show_rename_plan_dialog(self, items):
+        """Окно с планом переименования и кнопкой его применения"""
+        try:
+            conflicts = sum(1 for item in items if item.conflict)
+            
+            dialog = tk.Toplevel(self.root)
+            dialog.title("Предпросмотр переименования")
+            dialog.geometry("800x500")
+            dialog.transient(self.root)
+            
+            main_frame = ttk.Frame(dialog, padding="10")
+            main_frame.pack(fill=tk.BOTH, expand=True)
+            
+            ttk.Label(
+                main_frame,
+                text=f"Файлов к переименованию: {len(items)}, конфликтов имен: {conflicts}",
+                font=('Arial', 10, 'bold')
+            ).pack(anchor=tk.W, pady=(0, 10))
+            
+            table_frame = ttk.Frame(main_frame)
+            table_frame.pack(fill=tk.BOTH, expand=True)
+            
+            rows = list(RenamePlanItem.iter_rows(items))
+            if TKSHEET_AVAILABLE:
+                sheet = tksheet.Sheet(table_frame, data=rows, headers=list(RenamePlanItem.COLUMNS), show_row_index=False)
+                sheet.enable_bindings(("single_select", "drag_select", "column_width_resize", "copy"))
+                sheet.set_column_widths([50, 80, 250, 350, 110])
+                sheet.pack(fill=tk.BOTH, expand=True)
+            else:
+                tree = ttk.Treeview(table_frame, columns=RenamePlanItem.COLUMNS, show="headings")
+                for column, width in zip(RenamePlanItem.COLUMNS, (50, 80, 250, 350, 110)):
+                    tree.heading(column, text=column)
+                    tree.column(column, width=width, stretch=column == "Новое имя")
+                scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=tree.yview)
+                tree.configure(yscrollcommand=scrollbar.set)
+                for row in rows:
+                    tree.insert("", tk.END, values=row)
+                tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+                scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            
+            def apply_plan():
+                dialog.destroy()
+                threading.Thread(target=self.rename_service.apply_plan_all, args=(items,), daemon=True).start()
+            
+            button_frame = ttk.Frame(main_frame)
+            button_frame.pack(fill=tk.X, pady=(10, 0))
+            apply_button = ttk.Button(button_frame, text="Переименовать", command=apply_plan)
+            apply_button.pack(side=tk.LEFT, padx=5)
+            if not items:
+                apply_button.configure(state=tk.DISABLED)
+            ttk.Button(button_frame, text="Закрыть", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+        except Exception as e:
+            logging.error(f"Ошибка отображения плана переименования: {e}")
+    
+    def search_history(self):
+        """Поиск по истории переименований (исходное и новое имя, маршрут, путь)"""
+        text = self.search_var.get().strip()
+        if not text:
+            return
+        
+        def run_search():
+            records = self.db_manager.search_records(text, self.SEARCH_LIMIT)
+            self.root.after(0, lambda: self.show_search_results_dialog(text, records))
+        
+        threading.Thread(target=run_search, daemon=True).start()
+    
+    def show_search_results_dialog(self, text, records):
+        """Окно с результатами поиска по истории"""
+        try:
+            dialog = tk.Toplevel(self.root)
+            dialog.title(f"Поиск: {text}")
+            dialog.geometry("1000x450")
+            dialog.transient(self.root)
+            
+            main_frame = ttk.Frame(dialog, padding="10")
+            main_frame.pack(fill=tk.BOTH, expand=True)
+            
+            found = f"Найдено записей: {len(records)}"
+            if len(records) >= self.SEARCH_LIMIT:
+                found += f" (показаны последние {self.SEARCH_LIMIT}, уточните запрос)"
+            ttk.Label(main_frame, text=found, font=('Arial', 10, 'bold')).pack(anchor=tk.W, pady=(0, 10))
+            
+            table_frame = ttk.Frame(main_frame)
+            table_frame.pack(fill=tk.BOTH, expand=True)
+            
+            columns = (("timestamp", "Время", 130), ("route", "Маршрут", 70), ("original_name", "Исходное имя", 200),
+                       ("new_name", "Новое имя", 250), ("file_path", "Путь", 300))
+            rows = [[record[key] for key, _, _ in columns] for record in records]
+            if TKSHEET_AVAILABLE:
+                sheet = tksheet.Sheet(table_frame, data=rows, headers=[title for _, title, _ in columns],
+                                      show_row_index=False)
+                sheet.enable_bindings(("single_select", "drag_select", "column_width_resize", "copy"))
+                sheet.set_column_widths([width for _, _, width in columns])
+                sheet.pack(fill=tk.BOTH, expand=True)
+            else:
+                tree = ttk.Treeview(table_frame, columns=[key for key, _, _ in columns], show="headings")
+                for key, title, width in columns:
+                    tree.heading(key, text=title)
+                    tree.column(key, width=width)
+                scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=tree.yview)
+                tree.configure(yscrollcommand=scrollbar.set)
+                for row in rows:
+                    tree.insert("", tk.END, values=row)
+                tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+                scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            
+            ttk.Button(main_frame, text="Закрыть", command=dialog.destroy).pack(anchor=tk.W, pady=(10, 0))
+        except Exception as e:
+            logging.error(f"Ошибка отображения результатов поиска: {e}")
+    
     def update_combobox_value(self, key):
         """Обновление значения Combobox"""
         if f"{key}_var" in self.widgets:
@@ -2266,27 +2432,52 @@ class RenamerApp:
             logging.info(f"Настройка '{key}' изменена на: {value}")
     
     def save_settings(self):
-        """Сохранение настроек"""
+        """Сохранение настроек
+        
+        Все значения применяются одним update_settings: потоки переименования
+        получают новый снимок настроек целиком.
+        """
         try:
-            # Сохраняем значения из полей ввода
+            # Собираем значения из полей ввода
+            values = {}
             if "folder_var" in self.widgets:
-                folder = self.widgets["folder_var"].get()
-                self.settings.update_setting("folder", folder)
-                self.settings.add_to_folder_history(folder)
+                values["folder"] = self.widgets["folder_var"].get()
             
             if "ext_var" in self.widgets:
-                extensions = self.widgets["ext_var"].get()
-                self.settings.update_setting("extensions", extensions)
+                values["extensions"] = self.widgets["ext_var"].get()
             
             if "template_var" in self.widgets:
-                template = self.widgets["template_var"].get()
-                self.settings.update_setting("template", template)
-                self.settings.add_to_template_history(template)
+                values["template"] = self.widgets["template_var"].get()
             
             # Сохраняем настройку переименовывать только сегодняшние файлы
             if "rename_only_today_var" in self.widgets:
-                rename_only_today = self.widgets["rename_only_today_var"].get()
-                self.settings.update_setting("rename_only_today", rename_only_today)
+                values["rename_only_today"] = self.widgets["rename_only_today_var"].get()
+            
+            if "catch_up_on_start_var" in self.widgets:
+                values["catch_up_on_start"] = self.widgets["catch_up_on_start_var"].get()
+            
+            restart = False
+            if "recursive_watch_var" in self.widgets:
+                recursive_watch = self.widgets["recursive_watch_var"].get()
+                if recursive_watch != self.settings.settings.get("recursive_watch", False):
+                    values["recursive_watch"] = recursive_watch
+                    restart = True
+            
+            if "observer_mode_var" in self.widgets:
+                titles = {title: mode for mode, title in self.OBSERVER_MODES.items()}
+                observer_mode = titles.get(self.widgets["observer_mode_var"].get(), "auto")
+                if observer_mode != self.settings.settings.get("observer_mode", "auto"):
+                    values["observer_mode"] = observer_mode
+                    restart = True
+            
+            self.settings.update_settings(values)
+            if "folder" in values:
+                self.settings.add_to_folder_history(values["folder"])
+            if "template" in values:
+                self.settings.add_to_template_history(values["template"])
+            
+            if restart:
+                self.restart_monitoring()
             
             messagebox.showinfo("Успех", "Настройки сохранены!")
             logging.info("Настройки программы сохранены")
@@ -2317,7 +2508,7 @@ class RenamerApp:
         self.update_monitoring_button()
 
     def start_monitoring(self):
-        """Запуск мониторинга - ТЕПЕРЬ БЕЗ ПЕРЕИМЕНОВАНИЯ СУЩЕСТВУЮЩИХ ФАЙЛОВ"""
+        """Запуск мониторинга и догоняющее переименование пропущенных файлов"""
         if not self.monitor:
             self.monitor = FileMonitor(self.settings, self.rename_files)
         
@@ -2327,8 +2518,12 @@ class RenamerApp:
             # Сохраняем настройку
             self.settings.update_setting("monitoring_enabled", True)
             
-            # УБРАН ВЫЗОВ ПЕРЕИМЕНОВАНИЯ СУЩЕСТВУЮЩИХ ФАЙЛОВ
-            logging.info("Мониторинг запущен (без переименования существующих файлов)")
+            if self.settings.settings.get("catch_up_on_start", True):
+                # Файлы, появившиеся пока программа была закрыта или мониторинг выключен
+                threading.Thread(target=self.catch_up_scan, daemon=True).start()
+                logging.info("Мониторинг запущен")
+            else:
+                logging.info("Мониторинг запущен (без переименования существующих файлов)")
         else:
             logging.error("Не удалось запустить мониторинг")
             messagebox.showerror("Ошибка", "Не удалось запустить мониторинг")
@@ -2348,213 +2543,97 @@ class RenamerApp:
     
     def format_date_by_format(self, date_obj, date_format):
         """Форматирует дату по выбранному формату"""
-        format_mapping = {
-            "ДДММГГГГ": date_obj.strftime("%d%m%Y"),
-            "ДДММГГ": date_obj.strftime("%d%m%y"),
-            "ГГГГММДД": date_obj.strftime("%Y%m%d"),
-            "ДД.ММ.ГГГГ": date_obj.strftime("%d.%m.%Y"),
-            "ДД.ММ.ГГ": date_obj.strftime("%d.%m.%y"),
-            "ГГГГ.ММ.ДД": date_obj.strftime("%Y.%m.%d")
-        }
-        return format_mapping.get(date_format, date_obj.strftime("%Y%m%d"))
+        return FilenameTemplate.format_date(date_obj, date_format)
+    
+    def get_compiled_template(self):
+        """Скомпилированный шаблон для текущих настроек"""
+        return self.rename_service.get_compiled_template()
     
     def generate_filename(self, filepath, counter=None):
         """Генерация имени файла по шаблону"""
-        file_ext = Path(filepath).suffix.lower()[1:]  # Без точки
-        today = datetime.now()
-        
-        # Если счетчик не передан, вычисляем его
-        if counter is None:
-            counter = self.get_next_counter()
-        
-        # Форматируем номер
-        if self.settings.settings["number_format"] == "01":
-            counter_str = f"{counter:02d}"
-        elif self.settings.settings["number_format"] == "001":
-            counter_str = f"{counter:03d}"
-        else:
-            counter_str = str(counter)
-        
-        # Форматируем дату по выбранному формату
-        date_format = self.settings.settings.get("date_format", "ГГГГММДД")
-        formatted_date = self.format_date_by_format(today, date_format)
-        
-        # Заменяем переменные в шаблоне
-        filename = self.settings.settings["template"]
-        filename = filename.replace("{project}", self.settings.settings["project"])
-        filename = filename.replace("{CN}", self.settings.settings["cn_type"])
-        filename = filename.replace("{route}", self.settings.settings["route"])
-        filename = filename.replace("{date}", formatted_date)
-        filename = filename.replace("{counter}", counter_str)
-        filename = filename.replace("{extension}", file_ext)
-        filename = filename.replace("{1}", self.settings.settings["var1"])
-        filename = filename.replace("{2}", self.settings.settings["var2"])
-        filename = filename.replace("{3}", self.settings.settings["var3"])
-        
-        return f"{filename}.{file_ext}"
-
+        return self.rename_service.generate_filename(filepath, counter)
+    
+    def get_counter_pattern(self):
+        """Регулярное выражение для поиска номера в именах файлов по текущему шаблону"""
+        return self.rename_service.get_counter_pattern()
+    
     def get_next_counter(self):
-        """Получение следующего номера счетчика с учетом уже переименованных файлов и файлов в папке"""
-        folder = self.settings.settings["folder"]
-        today = datetime.now()
-        date_format = self.settings.settings.get("date_format", "ГГГГММДД")
-        formatted_date = self.format_date_by_format(today, date_format)
-        
-        if not os.path.exists(folder):
-            return 1
-        
-        # Создаем регулярное выражение для поиска файлов с текущей датой
-        # Экранируем специальные символы в отформатированной дате
-        escaped_date = re.escape(formatted_date)
-        
-        # Создаем шаблон для поиска файлов с текущей датой и форматом
-        pattern = re.compile(
-            f"{re.escape(self.settings.settings['project'])}_{escaped_date}_"
-            f"{re.escape(self.settings.settings['route'])}_(\\d+)_{re.escape(self.settings.settings['cn_type'])}"
-        )
-        
-        max_counter = 0
-        
-        for filename in os.listdir(folder):
-            match = pattern.match(filename)
-            if match:
-                counter = int(match.group(1))
-                max_counter = max(max_counter, counter)
-        
-        # Также проверяем историю переименований на случай, если файлы были удалены
-        # но мы хотим продолжить нумерацию с правильного номера
-        history_counter = self.get_max_counter_from_history()
-        
-        return max(max_counter, history_counter) + 1
-
-    def get_max_counter_from_history(self):
-        """Получение максимального номера из истории переименований"""
-        max_counter = 0
-        today = datetime.now()
-        date_format = self.settings.settings.get("date_format", "ГГГГММДД")
-        formatted_date = self.format_date_by_format(today, date_format)
-        
-        # Экранируем специальные символы в отформатированной дате
-        escaped_date = re.escape(formatted_date)
-        
-        # Создаем шаблон для поиска в именах файлов
-        pattern = re.compile(
-            f"{re.escape(self.settings.settings['project'])}_{escaped_date}_"
-            f"{re.escape(self.settings.settings['route'])}_(\\d+)_{re.escape(self.settings.settings['cn_type'])}"
-        )
-        
-        for record in self.report_data:
-            if len(record) > 3:  # Теперь 4 колонки вместо 5
-                new_name = record[3]  # Индекс изменился
-                match = pattern.match(new_name)
-                if match:
-                    counter = int(match.group(1))
-                    max_counter = max(max_counter, counter)
-        
-        return max_counter
-
+        """Получение следующего номера счетчика"""
+        return self.rename_service.get_next_counter()
+    
+    def reconcile_counters(self):
+        """Сверка индекса счетчиков с папкой и историей (при запуске и смене папки)"""
+        self.rename_service.reconcile_counters()
+    
     def rename_files(self, filepaths):
-        """Переименование файлов с исправленной обработкой GUI"""
-        try:
-            with self.rename_lock:
-                for filepath in filepaths:
-                    try:
-                        if not os.path.exists(filepath):
-                            logging.warning(f"Файл не существует: {filepath}")
-                            continue
-                        
-                        # Проверяем расширение файла
-                        file_ext = Path(filepath).suffix.lower().lstrip('.')
-                        extensions = [ext.strip().lower() for ext in self.settings.settings["extensions"].split(",")]
-                        
-                        if file_ext not in extensions:
-                            logging.info(f"Файл {filepath} пропущен - расширение {file_ext} не в списке разрешенных")
-                            continue
-                        
-                        # Проверяем, не был ли файл уже переименован программой
-                        if self.renamed_files_manager.is_file_renamed(filepath):
-                            logging.info(f"Файл {filepath} уже был переименован программой - пропускаем")
-                            continue
-                        
-                        # Проверяем, нужно ли переименовывать только сегодняшние файлы
-                        if self.settings.settings.get("rename_only_today", True):
-                            try:
-                                file_time = datetime.fromtimestamp(os.path.getctime(filepath))
-                                if file_time.date() != datetime.now().date():
-                                    logging.info(f"Файл {filepath} создан не сегодня - пропускаем")
-                                    continue
-                            except Exception as e:
-                                logging.error(f"Ошибка проверки времени файла {filepath}: {e}")
-                        
-                        # Получаем время создания файла
-                        try:
-                            create_time = datetime.fromtimestamp(os.path.getctime(filepath)).strftime('%H:%M:%S')
-                        except Exception as e:
-                            logging.error(f"Ошибка получения времени создания файла {filepath}: {e}")
-                            create_time = datetime.now().strftime('%H:%M:%S')
-                        
-                        # Генерируем новое имя
-                        new_name = self.generate_filename(filepath)
-                        new_path = os.path.join(os.path.dirname(filepath), new_name)
-                        
-                        # Проверяем, не существует ли уже файл с таким именем
-                        if os.path.exists(new_path):
-                            logging.warning(f"Файл с именем {new_name} уже существует - пропускаем переименование")
-                            continue
-                        
-                        # Переименовываем файл
-                        os.rename(filepath, new_path)
-                        
-                        # Добавляем в историю переименований
-                        self.renamed_files_manager.add_renamed_file(filepath)
-                        
-                        # ИСПРАВЛЕНИЕ БАГА: безопасный вызов добавления в отчет
-                        self.root.after(0, lambda: self.add_to_report(
-                            os.path.basename(filepath), new_name, new_path, create_time
-                        ))
-                        
-                        logging.info(f"Файл переименован: {os.path.basename(filepath)} -> {new_name}")
-                        
-                    except Exception as e:
-                        logging.error(f"Ошибка переименования файла {filepath}: {e}")
-                        continue
-        except Exception as e:
-            logging.error(f"Критическая ошибка в процессе переименования: {e}")
-
+        """Переименование пачки файлов (вызывается из потока мониторинга)
+        
+        Файлы распределяются по папкам наблюдения с их профилями."""
+        return self.rename_service.dispatch_files(filepaths)
+    
+    def catch_up_scan(self):
+        """Догоняющий проход по всем папкам наблюдения"""
+        return self.rename_service.catch_up_all()
+    
+    def on_files_renamed(self, report_entries):
+        """Пачка переименована - добавляем в отчет из потока GUI"""
+        # ИСПРАВЛЕНИЕ БАГА: безопасный вызов добавления в отчет - один на пачку
+        self.root.after(0, lambda: self.add_batch_to_report(report_entries))
+    
     def process_log_queue(self):
-        """Обработка сообщений из очереди логов"""
+        """Обработка сообщений из очереди логов
+        
+        За такт очередь разбирается не дольше LOG_DRAIN_TIME, все
+        сообщения выводятся одной вставкой в окно лога.
+        """
         try:
-            while True:
-                message = self.log_queue.get_nowait()
-                self.append_log(message)
-        except queue.Empty:
+            messages = []
+            deadline = time.monotonic() + self.LOG_DRAIN_TIME
+            while self.log_queue and time.monotonic() < deadline:
+                messages.append(self.log_queue.popleft())
+            if messages:
+                self.append_logs(messages)
+        except Exception:
             pass
         finally:
-            self.root.after(100, self.process_log_queue)
+            # Остаток очереди - в следующем такте без ожидания
+            self.root.after(1 if self.log_queue else self.LOG_FLUSH_INTERVAL, self.process_log_queue)
+
+    def get_log_tag(self, levelno):
+        """Цвет сообщения по уровню логирования"""
+        if levelno >= logging.ERROR:
+            return "error"
+        if levelno >= logging.WARNING:
+            return "warning"
+        if levelno >= logging.INFO:
+            return "info"
+        return "black"
 
-    def append_log(self, message):
+    def append_log(self, message, levelno=logging.INFO):
         """Добавление сообщения в лог"""
+        self.append_logs([(levelno, message)])
+
+    def append_logs(self, messages):
+        """Добавление пачки сообщений [(уровень, текст)] в лог одной вставкой"""
+        # Сообщения, которые все равно будут обрезаны, не выводим
+        messages = messages[-self.LOG_MAX_LINES:]
+        
+        chunks = []
+        for levelno, message in messages:
+            chunks.append(message + "\n")
+            chunks.append(self.get_log_tag(levelno))
+            self.log_line_counts.append(message.count("\n") + 1)
+        
+        # Строки самых старых сообщений сверх LOG_MAX_LINES
+        excess_lines = 0
+        while len(self.log_line_counts) > self.LOG_MAX_LINES:
+            excess_lines += self.log_line_counts.popleft()
+        
         try:
             self.log_text.config(state=tk.NORMAL)
-            
-            # Определяем цвет в зависимости от уровня логирования
-            if "ERROR" in message:
-                tag = "error"
-            elif "WARNING" in message:
-                tag = "warning"
-            elif "INFO" in message:
-                tag = "info"
-            else:
-                tag = "black"
-            
-            # Добавляем сообщение в лог
-            self.log_text.insert(tk.END, message + "\n", tag)
-            
-            # Ограничиваем количество строк в логе
-            self.log_line_counter += 1
-            if self.log_line_counter > 1000:  # Ограничение на 1000 строк
-                self.log_text.delete("1.0", "100.0")
-                self.log_line_counter = 900
+            self.log_text.insert(tk.END, *chunks)
+            if excess_lines:
+                self.log_text.delete("1.0", f"{excess_lines + 1}.0")
             
             # Автоматическая прокрутка к концу
             self.log_text.see(tk.END)
@@ -2635,6 +2714,12 @@ EGOK Renamer v{VERSION}
             
             # Сохраняем настройки
             self.save_settings()
+            self.settings.flush()
+            
+            self.history_maintenance.stop()
+            
+            # Закрываем соединения с базой данных
+            self.db_manager.close()
             
             logging.info("=" * 50)
             logging.info("ПРОГРАММА ЗАВЕРШЕНА")
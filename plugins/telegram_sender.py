@@ -9,6 +9,7 @@ from pathlib import Path
 import requests
 import json
 from datetime import datetime
+from renamer_core import DirectoryPoller
 
 class TelegramSenderPlugin:
     """Плагин для отправки файлов в Telegram канал с задержкой"""
@@ -164,8 +165,7 @@ class TelegramSenderPlugin:
                 "extensions": self.extensions_var.get()
             }
             
-            self.settings.settings["telegram_sender"] = self.plugin_settings
-            self.settings.save_settings()
+            self.settings.update_setting("telegram_sender", self.plugin_settings)
             
             messagebox.showinfo("Успех", "Настройки плагина сохранены!")
             self.add_log("Настройки сохранены")
@@ -220,60 +220,39 @@ class TelegramSenderPlugin:
         logging.info("Telegram мониторинг остановлен")
     
     def monitor_folder(self):
-        """Мониторинг папки на наличие новых файлов"""
+        """Мониторинг папки на наличие новых файлов (опрос снимками папки)"""
         monitored_folder = self.monitor_folder_var.get()
         extensions = [ext.strip().lower() for ext in self.extensions_var.get().split(",")]
         delay_seconds = int(self.delay_var.get())
         
         self.add_log(f"Начало мониторинга папки: {monitored_folder}")
         
-        # Получаем текущий список файлов
-        current_files = set()
-        if os.path.exists(monitored_folder):
-            for filename in os.listdir(monitored_folder):
-                filepath = os.path.join(monitored_folder, filename)
-                if os.path.isfile(filepath):
-                    file_ext = Path(filename).suffix.lower()[1:]
-                    if file_ext in extensions:
-                        current_files.add(filepath)
+        def on_new_file(filepath):
+            """Новый файл в папке - ставим в очередь отправки"""
+            file_ext = Path(filepath).suffix.lower()[1:]
+            if file_ext not in extensions or filepath in self.sent_files:
+                return
+            # Запускаем отправку с задержкой
+            threading.Thread(
+                target=self.send_file_with_delay,
+                args=(filepath, delay_seconds),
+                daemon=True
+            ).start()
+            self.add_log(f"Файл добавлен в очередь отправки: {Path(filepath).name}")
         
-        while self.is_monitoring and not self.stop_monitor:
-            try:
-                # Проверяем новые файлы
-                new_files = set()
-                if os.path.exists(monitored_folder):
-                    for filename in os.listdir(monitored_folder):
-                        filepath = os.path.join(monitored_folder, filename)
-                        if (os.path.isfile(filepath) and 
-                            filepath not in self.sent_files and
-                            filepath not in current_files):
-                            
-                            file_ext = Path(filename).suffix.lower()[1:]
-                            if file_ext in extensions:
-                                new_files.add(filepath)
-                
-                # Обрабатываем новые файлы
-                for filepath in new_files:
-                    if filepath not in self.sent_files:
-                        # Запускаем отправку с задержкой
-                        threading.Thread(
-                            target=self.send_file_with_delay,
-                            args=(filepath, delay_seconds),
-                            daemon=True
-                        ).start()
-                        
-                        self.add_log(f"Файл добавлен в очередь отправки: {Path(filepath).name}")
-                
-                # Обновляем текущий список файлов
-                current_files.update(new_files)
-                
-                # Небольшая пауза перед следующей проверкой
-                time.sleep(1)
-                
-            except Exception as e:
-                self.add_log(f"Ошибка мониторинга: {e}")
-                logging.error(f"Ошибка мониторинга Telegram: {e}")
-                time.sleep(5)
+        # Файлы, уже лежащие в папке, не отправляются; интервал опроса
+        # растет до 5 секунд, пока новых файлов нет
+        poller = DirectoryPoller([(monitored_folder, False)], on_new_file,
+                                 min_interval=1.0, max_interval=5.0)
+        try:
+            poller.start()
+            while self.is_monitoring and not self.stop_monitor:
+                time.sleep(0.5)
+        except Exception as e:
+            self.add_log(f"Ошибка мониторинга: {e}")
+            logging.error(f"Ошибка мониторинга Telegram: {e}")
+        finally:
+            poller.stop()
     
     def send_file_with_delay(self, filepath, delay_seconds):
         """Отправка файла с задержкой"""
@@ -1,5 +1,6 @@
 # plugins/telemetry_plugin.py
 import os
+import copy
 import json
 import zipfile
 import threading
@@ -26,7 +27,7 @@ class TelemetryPlugin:
     
     def setup_plugin_settings(self):
         """Инициализация настроек плагина"""
-        plugin_settings = self.settings.settings.get("telemetry_plugin", {})
+        plugin_settings = copy.deepcopy(self.settings.settings.get("telemetry_plugin", {}))
         
         # Настройки по умолчанию для плагина
         default_plugin_settings = {
@@ -126,8 +127,8 @@ class TelemetryPlugin:
         
     def save_plugin_settings(self):
         """Сохранение настроек плагина"""
-        self.settings.settings["telemetry_plugin"] = self.plugin_settings
-        self.settings.save_settings()
+        # Копия: self.plugin_settings дальше меняется на месте из вкладки плагина
+        self.settings.update_setting("telemetry_plugin", copy.deepcopy(self.plugin_settings))
     
     def get_tab_name(self):
         return "Телеметрия фото"
@@ -0,0 +1,324 @@
+# renamer_cli.py
+"""Консольный режим EGOK Renamer: переименование без графического интерфейса
+(сервер, служба Windows, планировщик заданий)."""
+import os
+import sys
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+from renamer_core import (
+    DatabaseManager, RenamedFilesManager, Settings, FileMonitor, RenameService, RenamePlanItem,
+    ReportExporter, HistoryMaintenance
+)
+
+
+def setup_logging(verbose=False):
+    """Настройка логирования в txt файл и консоль"""
+    log_dir = "logs"
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    log_filename = os.path.join(log_dir, f"renamer_cli_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+    level = logging.DEBUG if verbose else logging.INFO
+
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%H:%M:%S')
+
+    file_handler = logging.FileHandler(log_filename, encoding='utf-8')
+    file_handler.setLevel(level)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(level)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(console_handler)
+
+
+def create_service(args):
+    """Загрузка настроек и сборка ядра переименования
+
+    Параметры командной строки меняют настройки только в памяти -
+    settings.json окна программы не перезаписывается.
+    """
+    settings = Settings(args.settings)
+    if args.folder:
+        settings.settings["folder"] = os.path.abspath(args.folder)
+    if args.route:
+        settings.settings["route"] = args.route
+    if args.all_dates:
+        settings.settings["rename_only_today"] = False
+    if args.recursive:
+        settings.settings["recursive_watch"] = True
+    settings.rebuild_snapshot()
+
+    db_manager = DatabaseManager(args.db)
+    renamed_files_manager = RenamedFilesManager(
+        db_manager,
+        max_age_days=settings.settings.get("renamed_files_max_age_days", 30),
+        use_fingerprint=settings.settings.get("file_fingerprint", False)
+    )
+    service = RenameService(settings, db_manager, renamed_files_manager)
+    service.recover_journal()
+    return settings, db_manager, service
+
+
+def check_folder(settings):
+    """Проверка, что папка для переименования задана и существует"""
+    folder = settings.settings.get("folder", "")
+    if not folder or not os.path.isdir(folder):
+        logging.error(f"Папка не найдена: {folder or '(не задана)'}")
+        return False
+    return True
+
+
+def cmd_rename(args):
+    """Однократное переименование всех подходящих файлов в папке"""
+    settings, db_manager, service = create_service(args)
+    try:
+        if not check_folder(settings):
+            return 1
+
+        service.reconcile_counters()
+        renamed = service.catch_up_all()
+        logging.info(f"Переименовано файлов: {renamed}")
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_plan(args):
+    """Предпросмотр: таблица исходное имя -> новое имя без переименования
+
+    С --apply тот же план затем применяется.
+    """
+    settings, db_manager, service = create_service(args)
+    try:
+        if not check_folder(settings):
+            return 1
+
+        service.reconcile_counters()
+        items = service.preview_all()
+
+        out = sys.stdout
+        out.write("\t".join(RenamePlanItem.COLUMNS) + "\n")
+        for row in RenamePlanItem.iter_rows(items):
+            out.write("\t".join(str(value) for value in row) + "\n")
+        out.flush()
+
+        conflicts = sum(1 for item in items if item.conflict)
+        logging.info(f"Файлов в плане: {len(items)}, конфликтов: {conflicts}")
+
+        if args.apply:
+            renamed = service.apply_plan_all(items)
+            logging.info(f"Переименовано файлов: {len(renamed)}")
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_undo(args):
+    """Отмена переименований по дате, маршруту или пачке"""
+    settings, db_manager, service = create_service(args)
+    try:
+        if args.last:
+            undone = service.undo_last_batch()
+        elif args.date or args.undo_route or args.batch:
+            undone = service.undo(route=args.undo_route, target_date=args.date, batch_id=args.batch)
+        else:
+            logging.error("Укажите --last, --date, --route или --batch")
+            return 1
+        logging.info(f"Отменено переименований: {undone}")
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_export(args):
+    """Экспорт истории переименований в CSV, XLSX или Parquet"""
+    db_manager = DatabaseManager(args.db)
+    try:
+        ReportExporter(db_manager).export(
+            args.file, fmt=args.format, route=args.export_route, target_date=args.date,
+            date_from=args.date_from, date_to=args.date_to,
+            progress=lambda rows: logging.debug(f"Записано строк: {rows}")
+        )
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_stats(args):
+    """Статистика переименований по дням, маршрутам и часам (из сводных таблиц)"""
+    db_manager = DatabaseManager(args.db)
+    try:
+        if args.rebuild and not db_manager.rebuild_summaries():
+            return 1
+        summary = db_manager.get_summary(args.date_from, args.date_to, args.stats_route)
+        
+        out = sys.stdout
+        headers = {"days": "Дата", "routes": "Маршрут", "hours": "Час"}
+        for key in args.by or ("days", "routes", "hours"):
+            out.write(f"{headers[key]}\tПереименовано\n")
+            for name, count in summary[key]:
+                out.write(f"{name}\t{count}\n")
+            out.write("\n")
+        out.write(f"Всего\t{summary['total']}\n")
+        out.flush()
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_search(args):
+    """Поиск в истории: исходное имя <-> новое имя, маршрут, путь"""
+    db_manager = DatabaseManager(args.db)
+    try:
+        records = db_manager.search_records(args.text, args.limit)
+        
+        out = sys.stdout
+        columns = ["timestamp", "route", "original_name", "new_name", "file_path"]
+        out.write("\t".join(columns) + "\n")
+        for record in records:
+            out.write("\t".join(str(record[column]) for column in columns) + "\n")
+        out.flush()
+        logging.info(f"Найдено записей: {len(records)}")
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_archive(args):
+    """Перенос старой истории в архив по месяцам и освобождение места в базе"""
+    db_manager = DatabaseManager(args.db)
+    try:
+        if args.all:
+            before_date = None
+        else:
+            days = args.days
+            if days is None:
+                days = Settings(args.settings).settings.get("history_retention_days", 0)
+            if days <= 0:
+                logging.error("Укажите --days N, --all или history_retention_days в настройках")
+                return 1
+            before_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        
+        moved = db_manager.archive_records(before_date)
+        logging.info(f"Перенесено в архив записей: {moved} ({db_manager.archive_dir})")
+        if db_manager.enable_incremental_vacuum():
+            db_manager.incremental_vacuum()
+        return 0
+    finally:
+        db_manager.close()
+
+
+def cmd_watch(args):
+    """Постоянный мониторинг папки до Ctrl+C"""
+    settings, db_manager, service = create_service(args)
+    monitor = None
+    maintenance = HistoryMaintenance(db_manager, settings)
+    try:
+        if not check_folder(settings):
+            return 1
+
+        settings.settings["monitoring_enabled"] = True
+        settings.rebuild_snapshot()
+        service.reconcile_counters()
+
+        monitor = FileMonitor(settings, service.dispatch_files)
+        if not monitor.start_monitoring():
+            logging.error("Не удалось запустить мониторинг")
+            return 1
+
+        if settings.settings.get("catch_up_on_start", True):
+            service.catch_up_all()
+        maintenance.start()
+
+        logging.info("Мониторинг запущен, для остановки нажмите Ctrl+C")
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("Остановка по Ctrl+C")
+        return 0
+    finally:
+        if monitor:
+            monitor.stop_monitoring()
+        maintenance.stop()
+        db_manager.close()
+
+
+def build_parser():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(
+        prog="renamer_cli",
+        description="EGOK Renamer без графического интерфейса"
+    )
+    parser.add_argument("--settings", default="settings.json", help="файл настроек (как у окна программы)")
+    parser.add_argument("--db", default="rename_history.db", help="база истории переименований")
+    parser.add_argument("--folder", help="папка вместо указанной в настройках")
+    parser.add_argument("--route", help="маршрут вместо указанного в настройках")
+    parser.add_argument("--all-dates", action="store_true",
+                        help="переименовывать файлы, созданные не только сегодня")
+    parser.add_argument("--recursive", action="store_true", help="вместе с подпапками основной папки")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог")
+
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rename", help="переименовать файлы в папке один раз").set_defaults(func=cmd_rename)
+    plan_parser = commands.add_parser("plan", help="показать план переименования без изменений")
+    plan_parser.add_argument("--apply", action="store_true", help="применить показанный план")
+    plan_parser.set_defaults(func=cmd_plan)
+    undo_parser = commands.add_parser("undo", help="вернуть исходные имена файлам")
+    undo_parser.add_argument("--last", action="store_true", help="последняя пачка")
+    undo_parser.add_argument("--date", help="дата переименования ГГГГ-ММ-ДД")
+    undo_parser.add_argument("--route", dest="undo_route", help="маршрут")
+    undo_parser.add_argument("--batch", help="идентификатор пачки")
+    undo_parser.set_defaults(func=cmd_undo)
+    export_parser = commands.add_parser("export", help="выгрузить историю переименований в файл")
+    export_parser.add_argument("file", help="файл .csv, .xlsx или .parquet")
+    export_parser.add_argument("--format", choices=sorted(ReportExporter.FORMATS),
+                               help="формат (по умолчанию - по расширению файла)")
+    export_parser.add_argument("--date", help="дата ГГГГ-ММ-ДД")
+    export_parser.add_argument("--from", dest="date_from", help="начальная дата ГГГГ-ММ-ДД")
+    export_parser.add_argument("--to", dest="date_to", help="конечная дата ГГГГ-ММ-ДД")
+    export_parser.add_argument("--route", dest="export_route", help="маршрут")
+    export_parser.set_defaults(func=cmd_export)
+    stats_parser = commands.add_parser("stats", help="статистика переименований")
+    stats_parser.add_argument("--from", dest="date_from", help="начальная дата ГГГГ-ММ-ДД")
+    stats_parser.add_argument("--to", dest="date_to", help="конечная дата ГГГГ-ММ-ДД")
+    stats_parser.add_argument("--route", dest="stats_route", help="маршрут")
+    stats_parser.add_argument("--by", action="append", choices=["days", "routes", "hours"],
+                              help="раздел статистики (можно несколько, по умолчанию все)")
+    stats_parser.add_argument("--rebuild", action="store_true", help="пересчитать сводки по всей истории")
+    stats_parser.set_defaults(func=cmd_stats)
+    search_parser = commands.add_parser("search", help="найти файл в истории по исходному или новому имени")
+    search_parser.add_argument("text", help="имя файла или его начало, маршрут, путь")
+    search_parser.add_argument("--limit", type=int, default=200, help="не больше записей (по умолчанию 200)")
+    search_parser.set_defaults(func=cmd_search)
+    archive_parser = commands.add_parser("archive", help="перенести старую историю в архив по месяцам")
+    archive_parser.add_argument("--days", type=int, help="оставить в базе последние N дней "
+                                                         "(по умолчанию history_retention_days)")
+    archive_parser.add_argument("--all", action="store_true", help="перенести всю историю")
+    archive_parser.set_defaults(func=cmd_archive)
+    commands.add_parser("watch", help="следить за папкой до Ctrl+C").set_defaults(func=cmd_watch)
+    return parser
+
+
+def main(argv=None):
+    """Главная функция"""
+    args = build_parser().parse_args(argv)
+    setup_logging(args.verbose)
+    try:
+        return args.func(args)
+    except Exception as e:
+        logging.error(f"Критическая ошибка: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3043 @@
+# renamer_core.py
+"""Ядро EGOK Renamer без графического интерфейса: настройки, база истории,
+шаблон имени, мониторинг папки и переименование файлов."""
+import os
+import json
+import atexit
+import copy
+import logging
+import re
+import time
+import hashlib
+import threading
+import uuid
+import csv
+import sqlite3
+import importlib.util
+from collections import ChainMap
+from datetime import datetime, timedelta
+from pathlib import Path
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+class DatabaseManager:
+    """Менеджер базы данных для хранения истории переименований
+    
+    Соединения долгоживущие: у каждого потока (GUI, планировщик переименования)
+    свое соединение, открытое один раз в режиме WAL, поэтому читатели не
+    блокируют писателя. Запросы вынесены в константы класса, чтобы sqlite3
+    повторно использовал подготовленные выражения из кэша соединения.
+    
+    Журнал rename_journal хранит намерения: строки пачки пишутся до os.rename
+    и удаляются в той же транзакции, что и запись результата в историю.
+    Оставшиеся строки означают прерванную пачку (см. RenameService.recover_journal).
+    """
+    
+    # Действия в журнале переименований
+    JOURNAL_RENAME = "rename"
+    JOURNAL_UNDO = "undo"
+    
+    # Версия схемы базы (PRAGMA user_version), см. init_database
+    SCHEMA_VERSION = 3
+    
+    RECORD_COLUMNS = ['id', 'timestamp', 'create_date', 'route', 'original_name', 'new_name', 'file_path',
+                      'batch_id']
+    
+    SQL_INSERT_RECORD = '''
+        INSERT INTO rename_history 
+        (timestamp, create_date, route, original_name, new_name, file_path, batch_id, ts_epoch)
+        VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, CAST(strftime('%s', ?1, 'utc') AS INTEGER))
+    '''
+    SQL_INSERT_JOURNAL = '''
+        INSERT INTO rename_journal 
+        (batch_id, action, timestamp, old_path, new_path, route, counter_key, counter,
+         file_key, create_time, record_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    SQL_INSERT_COUNTER = '''
+        INSERT OR IGNORE INTO counter_index 
+        (project, date, route, cn_type, max_counter)
+        VALUES (?, ?, ?, ?, 0)
+    '''
+    SQL_UPDATE_COUNTER = '''
+        UPDATE counter_index 
+        SET max_counter = MAX(max_counter, ?)
+        WHERE project = ? AND date = ? AND route = ? AND cn_type = ?
+    '''
+    SQL_SELECT_COUNTER = '''
+        SELECT max_counter FROM counter_index 
+        WHERE project = ? AND date = ? AND route = ? AND cn_type = ?
+    '''
+    
+    # Сводные таблицы статистики: число переименований по дням/маршрутам и по часам
+    SQL_INSERT_SUMMARY_DAILY = '''
+        INSERT OR IGNORE INTO summary_daily (create_date, route, renamed)
+        VALUES (?, ?, 0)
+    '''
+    SQL_UPDATE_SUMMARY_DAILY = '''
+        UPDATE summary_daily SET renamed = renamed + ?
+        WHERE create_date = ? AND route = ?
+    '''
+    SQL_INSERT_SUMMARY_HOURLY = '''
+        INSERT OR IGNORE INTO summary_hourly (create_date, route, hour, renamed)
+        VALUES (?, ?, ?, 0)
+    '''
+    SQL_UPDATE_SUMMARY_HOURLY = '''
+        UPDATE summary_hourly SET renamed = renamed + ?
+        WHERE create_date = ? AND route = ? AND hour = ?
+    '''
+    
+    # Триггеры синхронизации полнотекстового индекса rename_search с историей
+    SQL_SEARCH_TRIGGERS = {
+        "rename_search_insert": '''
+            CREATE TRIGGER IF NOT EXISTS rename_search_insert AFTER INSERT ON rename_history BEGIN
+                INSERT INTO rename_search (rowid, original_name, new_name, route, file_path)
+                VALUES (new.id, new.original_name, new.new_name, new.route, new.file_path);
+            END
+        ''',
+        "rename_search_delete": '''
+            CREATE TRIGGER IF NOT EXISTS rename_search_delete AFTER DELETE ON rename_history BEGIN
+                INSERT INTO rename_search (rename_search, rowid, original_name, new_name, route, file_path)
+                VALUES ('delete', old.id, old.original_name, old.new_name, old.route, old.file_path);
+            END
+        ''',
+        "rename_search_update": '''
+            CREATE TRIGGER IF NOT EXISTS rename_search_update AFTER UPDATE ON rename_history BEGIN
+                INSERT INTO rename_search (rename_search, rowid, original_name, new_name, route, file_path)
+                VALUES ('delete', old.id, old.original_name, old.new_name, old.route, old.file_path);
+                INSERT INTO rename_search (rowid, original_name, new_name, route, file_path)
+                VALUES (new.id, new.original_name, new.new_name, new.route, new.file_path);
+            END
+        '''
+    }
+    
+    # Архив старой истории: файл на месяц в папке archive рядом с базой
+    ARCHIVE_COLUMNS = RECORD_COLUMNS + ['ts_epoch']
+    SQL_CREATE_ARCHIVE = '''
+        CREATE TABLE IF NOT EXISTS archive.rename_history (
+            id INTEGER PRIMARY KEY,
+            timestamp TEXT NOT NULL,
+            create_date TEXT NOT NULL,
+            route TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            new_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            batch_id TEXT,
+            ts_epoch INTEGER
+        )
+    '''
+    
+    # Страниц за один шаг incremental_vacuum (короткие блокировки записи)
+    VACUUM_STEP_PAGES = 1000
+    
+    def __init__(self, db_file="rename_history.db"):
+        self.db_file = db_file
+        self.local = threading.local()
+        # (поток, соединение) - для закрытия всех соединений при выходе
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # Есть ли таблица полнотекстового поиска (определяется при первом поиске)
+        self.search_available = None
+        self.archive_dir = os.path.join(os.path.dirname(os.path.abspath(db_file)), "archive")
+        self.init_database()
+    
+    def get_connection(self):
+        """Соединение текущего потока (создается при первом обращении)"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False,
+                                   cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-8000")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self.local.conn = conn
+            
+            with self.connections_lock:
+                # Закрываем соединения потоков, которые уже завершились
+                alive = []
+                for thread, other_conn in self.connections:
+                    if thread.is_alive():
+                        alive.append((thread, other_conn))
+                    else:
+                        try:
+                            other_conn.close()
+                        except Exception:
+                            pass
+                alive.append((threading.current_thread(), conn))
+                self.connections = alive
+        return conn
+    
+    def close(self):
+        """Закрытие всех соединений (при завершении программы)"""
+        with self.connections_lock:
+            for _, conn in self.connections:
+                try:
+                    conn.close()
+                except Exception as e:
+                    logging.error(f"Ошибка закрытия соединения с базой данных: {e}")
+            self.connections = []
+        self.local = threading.local()
+    
+    def init_database(self):
+        """Инициализация базы данных: миграции схемы до SCHEMA_VERSION
+        
+        Версия схемы хранится в PRAGMA user_version. Каждая миграция
+        выполняется в своей транзакции вместе с повышением версии, поэтому
+        старая база обновляется на месте и при сбое остается на прежней версии.
+        """
+        try:
+            conn = self.get_connection()
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            
+            for target in range(version + 1, self.SCHEMA_VERSION + 1):
+                with conn:
+                    conn.execute("BEGIN")
+                    getattr(self, f"_migrate_to_{target}")(conn)
+                    conn.execute(f"PRAGMA user_version = {target}")
+                logging.info(f"Схема базы данных обновлена до версии {target}")
+            
+            logging.info("База данных инициализирована успешно")
+            
+        except Exception as e:
+            logging.error(f"Ошибка инициализации базы данных: {e}")
+    
+    def _migrate_to_1(self, conn):
+        """Исходная схема (базы без версии могут уже содержать часть таблиц)"""
+        # Создаем таблицу для истории переименований
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rename_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                create_date TEXT NOT NULL,
+                route TEXT NOT NULL,
+                original_name TEXT NOT NULL,
+                new_name TEXT NOT NULL,
+                file_path TEXT NOT NULL
+            )
+        ''')
+        
+        # Создаем индекс для быстрого поиска по дате
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_date 
+            ON rename_history(create_date)
+        ''')
+        
+        # Создаем индекс для быстрого поиска по маршруту
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_route 
+            ON rename_history(route)
+        ''')
+        
+        # Индекс счетчиков: последний номер для (проект, дата, маршрут, ЦН)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS counter_index (
+                project TEXT NOT NULL,
+                date TEXT NOT NULL,
+                route TEXT NOT NULL,
+                cn_type TEXT NOT NULL,
+                max_counter INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (project, date, route, cn_type)
+            )
+        ''')
+        
+        # Индекс для поиска записи по новому имени файла
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_new_name 
+            ON rename_history(new_name)
+        ''')
+        
+        # Ключи файлов, уже переименованных программой (поиск по первичному ключу)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS renamed_files (
+                file_key TEXT PRIMARY KEY,
+                renamed_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        
+        # Индекс для удаления устаревших ключей
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_renamed_at 
+            ON renamed_files(renamed_at)
+        ''')
+        
+        # Пачка, в которой файл был переименован (для отмены пачки целиком)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(rename_history)")]
+        if "batch_id" not in columns:
+            conn.execute("ALTER TABLE rename_history ADD COLUMN batch_id TEXT")
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_batch 
+            ON rename_history(batch_id)
+        ''')
+        
+        # Журнал незавершенных переименований и отмен
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rename_journal (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id TEXT NOT NULL,
+                action TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                old_path TEXT NOT NULL,
+                new_path TEXT NOT NULL,
+                route TEXT,
+                counter_key TEXT,
+                counter INTEGER,
+                file_key TEXT,
+                create_time TEXT,
+                record_id INTEGER
+            )
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_journal_batch 
+            ON rename_journal(batch_id)
+        ''')
+        
+        # Сводные таблицы для статистики (обновляются вместе с историей)
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS summary_daily (
+                create_date TEXT NOT NULL,
+                route TEXT NOT NULL,
+                renamed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (create_date, route)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS summary_hourly (
+                create_date TEXT NOT NULL,
+                route TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                renamed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (create_date, route, hour)
+            ) WITHOUT ROWID
+        ''')
+        # Существующая история без сводок - сводки строятся один раз полным проходом
+        if "summary_daily" not in tables or "summary_hourly" not in tables:
+            self._rebuild_summaries(conn)
+    
+    def _migrate_to_2(self, conn):
+        """Время записи числом (ts_epoch) и составные индексы"""
+        # Секунды Unix вместо сравнения строк при сортировке по времени
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(rename_history)")]
+        if "ts_epoch" not in columns:
+            conn.execute("ALTER TABLE rename_history ADD COLUMN ts_epoch INTEGER")
+        conn.execute('''
+            UPDATE rename_history 
+            SET ts_epoch = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+            WHERE ts_epoch IS NULL
+        ''')
+        
+        # Фильтры отчета (дата, маршрут) и сортировка по времени - одним индексом;
+        # одиночные индексы по дате и маршруту покрываются составными
+        conn.execute("DROP INDEX IF EXISTS idx_date")
+        conn.execute("DROP INDEX IF EXISTS idx_route")
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_date_route_time 
+            ON rename_history(create_date, route, ts_epoch)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_route_time 
+            ON rename_history(route, ts_epoch)
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_time 
+            ON rename_history(ts_epoch)
+        ''')
+        
+        # Поиск по новому имени (и пути). Индекс не уникальный: имена повторяются
+        # у шаблонов без {date} и после очистки отчета, история хранит каждое переименование
+        conn.execute("DROP INDEX IF EXISTS idx_new_name")
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_new_name_path 
+            ON rename_history(new_name, file_path)
+        ''')
+    
+    def _migrate_to_3(self, conn):
+        """Полнотекстовый поиск по истории (FTS5), синхронизируется триггерами"""
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS rename_search USING fts5(
+                    original_name, new_name, route, file_path,
+                    content='rename_history', content_rowid='id'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            # SQLite собран без FTS5 - поиск работает через LIKE
+            logging.warning(f"Полнотекстовый поиск недоступен: {e}")
+            return
+        
+        for trigger_sql in self.SQL_SEARCH_TRIGGERS.values():
+            conn.execute(trigger_sql)
+        # Индекс по уже накопленной истории
+        conn.execute("INSERT INTO rename_search (rename_search) VALUES ('rebuild')")
+    
+    def add_record(self, timestamp, route, original_name, new_name, file_path,
+                   counter_key=None, counter=None):
+        """Добавление записи в базу данных (и обновление индекса счетчиков в той же транзакции)"""
+        return self.add_records([(timestamp, route, original_name, new_name, file_path, counter_key, counter)])
+    
+    def add_records(self, records, batch_id=None):
+        """Добавление пачки записей одной транзакцией
+        
+        records - список кортежей (timestamp, route, original_name, new_name, file_path, counter_key, counter).
+        Если указан batch_id, в той же транзакции закрываются строки пачки в журнале.
+        """
+        try:
+            conn = self.get_connection()
+            
+            with conn:
+                # Дата записи - дата переименования (timestamp в формате ГГГГ-ММ-ДД ЧЧ:ММ:СС)
+                conn.executemany(self.SQL_INSERT_RECORD, [
+                    (timestamp, timestamp[:10], route, original_name, new_name, file_path, batch_id)
+                    for timestamp, route, original_name, new_name, file_path, _, _ in records
+                ])
+                if batch_id is not None:
+                    conn.execute("DELETE FROM rename_journal WHERE batch_id = ?", (batch_id,))
+                
+                self._update_summaries(conn, [
+                    (timestamp[:10], route, timestamp) for timestamp, route, *_ in records
+                ])
+                
+                # Для индекса счетчиков достаточно максимального номера по каждому ключу
+                max_counters = {}
+                for *_, counter_key, counter in records:
+                    if counter_key is not None and counter is not None:
+                        max_counters[counter_key] = max(counter, max_counters.get(counter_key, 0))
+                for counter_key, counter in max_counters.items():
+                    self._update_counter(conn, counter_key, counter)
+            
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка добавления записей в базу данных: {e}")
+            return False
+    
+    def _update_counter(self, conn, counter_key, counter):
+        """Поднимает максимальный номер в индексе счетчиков (номер никогда не уменьшается)"""
+        conn.execute(self.SQL_INSERT_COUNTER, counter_key)
+        conn.execute(self.SQL_UPDATE_COUNTER, (counter, *counter_key))
+    
+    def get_counter(self, counter_key):
+        """Получение последнего номера для ключа (проект, дата, маршрут, ЦН)"""
+        try:
+            row = self.get_connection().execute(self.SQL_SELECT_COUNTER, counter_key).fetchone()
+            return row[0] if row else 0
+        except Exception as e:
+            logging.error(f"Ошибка получения счетчика из базы данных: {e}")
+            return 0
+    
+    def update_counter(self, counter_key, counter):
+        """Обновление индекса счетчиков (используется при сверке с папкой)"""
+        try:
+            conn = self.get_connection()
+            with conn:
+                self._update_counter(conn, counter_key, counter)
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка обновления счетчика в базе данных: {e}")
+            return False
+    
+    def get_new_names_by_date(self, target_date):
+        """Получение новых имен файлов, переименованных за определенную дату"""
+        try:
+            cursor = self.get_connection().execute('''
+                SELECT new_name FROM rename_history 
+                WHERE create_date = ?
+            ''', (target_date,))
+            
+            return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Ошибка получения имен из базы данных: {e}")
+            return []
+    
+    def add_renamed_file_keys(self, file_keys, renamed_at=None):
+        """Добавление ключей переименованных файлов одной транзакцией"""
+        try:
+            if renamed_at is None:
+                renamed_at = time.time()
+            conn = self.get_connection()
+            with conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO renamed_files (file_key, renamed_at)
+                    VALUES (?, ?)
+                ''', [(file_key, renamed_at) for file_key in file_keys])
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка добавления переименованных файлов в базу данных: {e}")
+            return False
+    
+    def has_renamed_file_key(self, file_key):
+        """Проверка наличия ключа переименованного файла"""
+        try:
+            row = self.get_connection().execute(
+                "SELECT 1 FROM renamed_files WHERE file_key = ?", (file_key,)
+            ).fetchone()
+            return row is not None
+        except Exception as e:
+            logging.error(f"Ошибка проверки переименованного файла в базе данных: {e}")
+            return False
+    
+    def count_renamed_file_keys(self):
+        """Количество ключей переименованных файлов"""
+        try:
+            return self.get_connection().execute("SELECT COUNT(*) FROM renamed_files").fetchone()[0]
+        except Exception as e:
+            logging.error(f"Ошибка подсчета переименованных файлов в базе данных: {e}")
+            return 0
+    
+    def evict_renamed_file_keys(self, older_than):
+        """Удаление ключей, добавленных раньше older_than (timestamp)"""
+        try:
+            conn = self.get_connection()
+            with conn:
+                cursor = conn.execute(
+                    "DELETE FROM renamed_files WHERE renamed_at < ?", (older_than,)
+                )
+            return cursor.rowcount
+        except Exception as e:
+            logging.error(f"Ошибка удаления устаревших переименованных файлов: {e}")
+            return 0
+    
+    def get_existing_new_names(self, names):
+        """Какие из переданных имен уже встречаются в истории как новые имена"""
+        existing = set()
+        try:
+            conn = self.get_connection()
+            names = list(names)
+            # Ограничение SQLite на количество параметров запроса
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = conn.execute(
+                    f"SELECT new_name FROM rename_history WHERE new_name IN ({placeholders})", chunk
+                )
+                existing.update(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            logging.error(f"Ошибка поиска имен в базе данных: {e}")
+        return existing
+    
+    def get_records_by_date(self, target_date=None):
+        """Получение записей за определенную дату"""
+        try:
+            conn = self.get_connection()
+            
+            if target_date:
+                cursor = conn.execute('''
+                    SELECT * FROM rename_history 
+                    WHERE create_date = ? 
+                    ORDER BY ts_epoch DESC, id DESC
+                ''', (target_date,))
+            else:
+                cursor = conn.execute('''
+                    SELECT * FROM rename_history 
+                    ORDER BY ts_epoch DESC, id DESC
+                ''')
+            
+            records = cursor.fetchall()
+            
+            # Преобразуем в список словарей
+            result = []
+            for record in records:
+                result.append(dict(zip(self.RECORD_COLUMNS, record)))
+            
+            return result
+        except Exception as e:
+            logging.error(f"Ошибка получения записей из базы данных: {e}")
+            return []
+    
+    def _build_filter(self, route=None, target_date=None, date_from=None, date_to=None):
+        """Условие WHERE по маршруту и дате или диапазону дат (составные индексы idx_date_route_time и idx_route_time)"""
+        conditions = []
+        params = []
+        if route:
+            conditions.append("route = ?")
+            params.append(route)
+        if target_date:
+            conditions.append("create_date = ?")
+            params.append(target_date)
+        if date_from:
+            conditions.append("create_date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("create_date <= ?")
+            params.append(date_to)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return where, params
+    
+    def get_records_page(self, route=None, target_date=None, limit=500, offset=0):
+        """Получение страницы записей с фильтрами по маршруту и дате (новые сверху)"""
+        try:
+            where, params = self._build_filter(route, target_date)
+            cursor = self.get_connection().execute(f'''
+                SELECT * FROM rename_history 
+                {where}
+                ORDER BY ts_epoch DESC, id DESC
+                LIMIT ? OFFSET ?
+            ''', (*params, limit, offset))
+            
+            return [dict(zip(self.RECORD_COLUMNS, record)) for record in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Ошибка получения страницы записей из базы данных: {e}")
+            return []
+    
+    def count_records(self, route=None, target_date=None):
+        """Количество записей с фильтрами по маршруту и дате"""
+        try:
+            where, params = self._build_filter(route, target_date)
+            row = self.get_connection().execute(
+                f"SELECT COUNT(*) FROM rename_history {where}", params
+            ).fetchone()
+            return row[0] if row else 0
+        except Exception as e:
+            logging.error(f"Ошибка подсчета записей в базе данных: {e}")
+            return 0
+    
+    def iter_record_chunks(self, route=None, target_date=None, date_from=None, date_to=None,
+                           chunk_size=5000):
+        """Записи с фильтрами частями по chunk_size строк (старые сверху)
+        
+        Генератор читает курсор через fetchmany, поэтому в памяти всегда
+        не больше одной части. Строки - кортежи в порядке RECORD_COLUMNS.
+        Ошибки базы данных не перехватываются - их обрабатывает вызывающий.
+        """
+        where, params = self._build_filter(route, target_date, date_from, date_to)
+        cursor = self.get_connection().execute(f'''
+            SELECT {', '.join(self.RECORD_COLUMNS)} FROM rename_history
+            {where}
+            ORDER BY ts_epoch, id
+        ''', params)
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+    
+    def has_search_index(self, conn):
+        """Есть ли в базе полнотекстовый индекс (миграция 3 при наличии FTS5)"""
+        if self.search_available is None:
+            self.search_available = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'rename_search'"
+            ).fetchone() is not None
+        return self.search_available
+    
+    def search_records(self, text, limit=200):
+        """Поиск записей по исходному и новому имени, маршруту и пути (новые сверху)
+        
+        Текст ищется как фраза, последнее слово - по началу, поэтому
+        подходят и полное имя файла, и его часть ("M2.1_37", "IMG_00").
+        Без FTS5 - поиск подстроки через LIKE (полный просмотр таблицы).
+        """
+        text = text.strip()
+        if not text:
+            return []
+        try:
+            conn = self.get_connection()
+            columns = ", ".join(f"h.{column}" for column in self.RECORD_COLUMNS)
+            if self.has_search_index(conn):
+                query = '"' + text.replace('"', '""') + '"*'
+                cursor = conn.execute(f'''
+                    SELECT {columns} FROM rename_search 
+                    JOIN rename_history h ON h.id = rename_search.rowid
+                    WHERE rename_search MATCH ?
+                    ORDER BY h.ts_epoch DESC, h.id DESC
+                    LIMIT ?
+                ''', (query, limit))
+            else:
+                pattern = "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                cursor = conn.execute(f'''
+                    SELECT {columns} FROM rename_history h
+                    WHERE h.original_name LIKE ?1 ESCAPE '\\' OR h.new_name LIKE ?1 ESCAPE '\\'
+                       OR h.route LIKE ?1 ESCAPE '\\' OR h.file_path LIKE ?1 ESCAPE '\\'
+                    ORDER BY h.ts_epoch DESC, h.id DESC
+                    LIMIT ?2
+                ''', (pattern, limit))
+            
+            return [dict(zip(self.RECORD_COLUMNS, record)) for record in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Ошибка поиска в истории переименований: {e}")
+            return []
+    
+    def get_all_dates(self):
+        """Получение всех уникальных дат из базы данных (без перенесенных в архив)"""
+        try:
+            cursor = self.get_connection().execute('''
+                SELECT DISTINCT create_date FROM summary_daily 
+                WHERE create_date >= (SELECT MIN(create_date) FROM rename_history)
+                ORDER BY create_date DESC
+            ''')
+            
+            return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"Ошибка получения дат из базы данных: {e}")
+            return []
+    
+    def begin_journal(self, batch_id, action, entries):
+        """Запись намерений пачки в журнал до переименования файлов
+        
+        entries - кортежи (timestamp, old_path, new_path, route, counter_key, counter,
+        file_key, create_time, record_id); counter_key - кортеж или None.
+        """
+        try:
+            conn = self.get_connection()
+            with conn:
+                conn.executemany(self.SQL_INSERT_JOURNAL, [
+                    (batch_id, action, timestamp, old_path, new_path, route,
+                     json.dumps(counter_key, ensure_ascii=False) if counter_key else None,
+                     counter, file_key, create_time, record_id)
+                    for (timestamp, old_path, new_path, route, counter_key, counter,
+                         file_key, create_time, record_id) in entries
+                ])
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка записи журнала переименований: {e}")
+            return False
+    
+    def discard_journal_entries(self, batch_id, new_paths=None):
+        """Удаление строк журнала пачки (всех или для указанных новых путей)"""
+        try:
+            conn = self.get_connection()
+            with conn:
+                if new_paths is None:
+                    conn.execute("DELETE FROM rename_journal WHERE batch_id = ?", (batch_id,))
+                else:
+                    conn.executemany(
+                        "DELETE FROM rename_journal WHERE batch_id = ? AND new_path = ?",
+                        [(batch_id, new_path) for new_path in new_paths]
+                    )
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка очистки журнала переименований: {e}")
+            return False
+    
+    def get_journal_entries(self):
+        """Незавершенные строки журнала в порядке записи (словари)"""
+        try:
+            cursor = self.get_connection().execute('''
+                SELECT batch_id, action, timestamp, old_path, new_path, route, counter_key,
+                       counter, file_key, create_time, record_id
+                FROM rename_journal ORDER BY id
+            ''')
+            columns = [description[0] for description in cursor.description]
+            entries = []
+            for row in cursor.fetchall():
+                entry = dict(zip(columns, row))
+                if entry["counter_key"]:
+                    entry["counter_key"] = tuple(json.loads(entry["counter_key"]))
+                entries.append(entry)
+            return entries
+        except Exception as e:
+            logging.error(f"Ошибка чтения журнала переименований: {e}")
+            return []
+    
+    def get_records_for_undo(self, route=None, target_date=None, batch_id=None):
+        """Записи для отмены (новые первыми) по маршруту, дате или пачке"""
+        try:
+            where, params = self._build_filter(route, target_date)
+            if batch_id:
+                where = f"{where} AND batch_id = ?" if where else "WHERE batch_id = ?"
+                params.append(batch_id)
+            cursor = self.get_connection().execute(f'''
+                SELECT id, original_name, new_name, file_path FROM rename_history 
+                {where}
+                ORDER BY id DESC
+            ''', params)
+            return cursor.fetchall()
+        except Exception as e:
+            logging.error(f"Ошибка получения записей для отмены: {e}")
+            return []
+    
+    def get_last_batch_id(self):
+        """Пачка последнего переименования"""
+        try:
+            row = self.get_connection().execute('''
+                SELECT batch_id FROM rename_history 
+                WHERE batch_id IS NOT NULL 
+                ORDER BY id DESC LIMIT 1
+            ''').fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logging.error(f"Ошибка получения последней пачки: {e}")
+            return None
+    
+    def delete_records(self, record_ids, batch_id=None):
+        """Удаление записей по id одной транзакцией (и строк журнала отмены batch_id)"""
+        try:
+            conn = self.get_connection()
+            with conn:
+                # Удаляемые записи вычитаются из сводок
+                removed = []
+                for record_id in record_ids:
+                    row = conn.execute("SELECT create_date, route, timestamp FROM rename_history WHERE id = ?",
+                                       (record_id,)).fetchone()
+                    if row:
+                        removed.append(row)
+                self._update_summaries(conn, removed, sign=-1)
+                conn.executemany("DELETE FROM rename_history WHERE id = ?",
+                                 [(record_id,) for record_id in record_ids])
+                if batch_id is not None:
+                    conn.execute("DELETE FROM rename_journal WHERE batch_id = ?", (batch_id,))
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка удаления записей из базы данных: {e}")
+            return False
+    
+    def clear_records_by_date(self, target_date):
+        """Удаление записей за определенную дату"""
+        try:
+            conn = self.get_connection()
+            
+            with conn:
+                cursor = conn.execute('''
+                    DELETE FROM rename_history 
+                    WHERE create_date = ?
+                ''', (target_date,))
+                conn.execute("DELETE FROM summary_daily WHERE create_date = ?", (target_date,))
+                conn.execute("DELETE FROM summary_hourly WHERE create_date = ?", (target_date,))
+            
+            return cursor.rowcount
+        except Exception as e:
+            logging.error(f"Ошибка удаления записей из базы данных: {e}")
+            return 0
+    
+    def clear_all_records(self, keep_summaries=False):
+        """Удаление всех записей
+        
+        Триггеры поиска на время удаления снимаются: DELETE без условия и
+        без триггеров SQLite выполняет очисткой таблицы, а не построчно.
+        Освободившееся место возвращает incremental_vacuum. keep_summaries -
+        сводки статистики не очищаются (история перенесена в архив).
+        """
+        try:
+            conn = self.get_connection()
+            search_index = self.has_search_index(conn)
+            
+            with conn:
+                conn.execute("BEGIN")
+                if search_index:
+                    for trigger_name in self.SQL_SEARCH_TRIGGERS:
+                        conn.execute(f"DROP TRIGGER IF EXISTS {trigger_name}")
+                conn.execute('DELETE FROM rename_history')
+                if search_index:
+                    conn.execute("INSERT INTO rename_search (rename_search) VALUES ('delete-all')")
+                    for trigger_sql in self.SQL_SEARCH_TRIGGERS.values():
+                        conn.execute(trigger_sql)
+                conn.execute('DELETE FROM counter_index')
+                if not keep_summaries:
+                    conn.execute('DELETE FROM summary_daily')
+                    conn.execute('DELETE FROM summary_hourly')
+            
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка очистки базы данных: {e}")
+            return False
+
+    def get_archive_path(self, month):
+        """Файл архива за месяц ГГГГ-ММ"""
+        return os.path.join(self.archive_dir, f"rename_history_{month}.db")
+    
+    def archive_records(self, before_date=None):
+        """Перенос записей старше before_date (ГГГГ-ММ-ДД, None - всех) в архивы по месяцам
+        
+        Каждый день переносится одной короткой транзакцией: копия в архив и
+        удаление из основной базы записей с id не больше последнего
+        скопированного, так что запись, добавленная другим потоком, не
+        удаляется без копии. Если запись осталась в обеих базах, при
+        следующем запуске она переносится повторно без дублей (INSERT OR
+        IGNORE по id). Сводки статистики не меняются.
+        Возвращает число перенесенных записей.
+        """
+        moved = 0
+        try:
+            conn = self.get_connection()
+            if before_date:
+                dates = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT create_date FROM rename_history WHERE create_date < ? ORDER BY create_date",
+                    (before_date,)
+                )]
+            else:
+                dates = [row[0] for row in conn.execute(
+                    "SELECT DISTINCT create_date FROM rename_history ORDER BY create_date"
+                )]
+            if not dates:
+                return 0
+            
+            os.makedirs(self.archive_dir, exist_ok=True)
+            columns = ", ".join(self.ARCHIVE_COLUMNS)
+            months = {}
+            for create_date in dates:
+                months.setdefault(create_date[:7], []).append(create_date)
+            
+            for month, month_dates in months.items():
+                conn.execute("ATTACH DATABASE ? AS archive", (self.get_archive_path(month),))
+                try:
+                    conn.execute(self.SQL_CREATE_ARCHIVE)
+                    for create_date in month_dates:
+                        with conn:
+                            conn.execute("BEGIN IMMEDIATE")
+                            last_id = conn.execute(
+                                "SELECT MAX(id) FROM main.rename_history WHERE create_date = ?",
+                                (create_date,)
+                            ).fetchone()[0]
+                            if last_id is None:
+                                continue
+                            conn.execute(f'''
+                                INSERT OR IGNORE INTO archive.rename_history ({columns})
+                                SELECT {columns} FROM main.rename_history
+                                WHERE create_date = ? AND id <= ?
+                            ''', (create_date, last_id))
+                            cursor = conn.execute(
+                                "DELETE FROM main.rename_history WHERE create_date = ? AND id <= ?",
+                                (create_date, last_id)
+                            )
+                        moved += cursor.rowcount
+                finally:
+                    conn.execute("DETACH DATABASE archive")
+                logging.info(f"История за {month} перенесена в архив: {self.get_archive_path(month)}")
+            
+            # Удаленные строки остаются в полнотекстовом индексе пометками до слияния сегментов
+            if moved and self.has_search_index(conn):
+                with conn:
+                    conn.execute("INSERT INTO rename_search (rename_search) VALUES ('optimize')")
+        except Exception as e:
+            logging.error(f"Ошибка переноса истории в архив: {e}")
+        return moved
+    
+    def enable_incremental_vacuum(self):
+        """Перевод базы в режим auto_vacuum=INCREMENTAL (однократный VACUUM)"""
+        try:
+            conn = self.get_connection()
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return True
+            logging.info("Перестройка базы данных для освобождения места (однократно)")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка включения incremental vacuum: {e}")
+            return False
+    
+    def incremental_vacuum(self, stop_event=None):
+        """Возврат свободных страниц файлу базы шагами по VACUUM_STEP_PAGES
+        
+        Между шагами другие потоки могут писать в базу. stop_event (threading.Event)
+        прерывает работу. Возвращает число освобожденных страниц.
+        """
+        freed = 0
+        try:
+            conn = self.get_connection()
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            while not (stop_event and stop_event.is_set()):
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if not free_pages:
+                    break
+                # executescript выполняет прагму до конца (execute освобождает одну страницу)
+                conn.executescript(f"PRAGMA incremental_vacuum({self.VACUUM_STEP_PAGES})")
+                freed += min(free_pages, self.VACUUM_STEP_PAGES)
+            if freed:
+                # Файл WAL с копиями освобожденных страниц тоже усекаем
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                logging.info(f"Освобождено страниц базы данных: {freed}")
+        except Exception as e:
+            logging.error(f"Ошибка incremental vacuum: {e}")
+        return freed
+    
+    @staticmethod
+    def get_hour(timestamp):
+        """Час из отметки времени ГГГГ-ММ-ДД ЧЧ:ММ:СС"""
+        hour = timestamp[11:13]
+        return int(hour) if hour.isdigit() else 0
+    
+    def _update_summaries(self, conn, rows, sign=1):
+        """Изменение сводок на записи rows [(дата, маршрут, timestamp)] в транзакции conn
+        
+        sign=1 - записи добавлены, sign=-1 - удалены.
+        """
+        daily = {}
+        hourly = {}
+        for create_date, route, timestamp in rows:
+            daily[(create_date, route)] = daily.get((create_date, route), 0) + 1
+            hour_key = (create_date, route, self.get_hour(timestamp))
+            hourly[hour_key] = hourly.get(hour_key, 0) + 1
+        
+        if sign > 0:
+            conn.executemany(self.SQL_INSERT_SUMMARY_DAILY, list(daily))
+            conn.executemany(self.SQL_INSERT_SUMMARY_HOURLY, list(hourly))
+        conn.executemany(self.SQL_UPDATE_SUMMARY_DAILY,
+                         [(sign * count, *key) for key, count in daily.items()])
+        conn.executemany(self.SQL_UPDATE_SUMMARY_HOURLY,
+                         [(sign * count, *key) for key, count in hourly.items()])
+        if sign < 0:
+            conn.execute("DELETE FROM summary_daily WHERE renamed <= 0")
+            conn.execute("DELETE FROM summary_hourly WHERE renamed <= 0")
+    
+    def _rebuild_summaries(self, conn):
+        """Пересчет сводок по всей истории (в транзакции conn)"""
+        conn.execute("DELETE FROM summary_daily")
+        conn.execute("DELETE FROM summary_hourly")
+        conn.execute('''
+            INSERT INTO summary_daily (create_date, route, renamed)
+            SELECT create_date, route, COUNT(*) FROM rename_history
+            GROUP BY create_date, route
+        ''')
+        conn.execute('''
+            INSERT INTO summary_hourly (create_date, route, hour, renamed)
+            SELECT create_date, route, CAST(substr(timestamp, 12, 2) AS INTEGER), COUNT(*)
+            FROM rename_history
+            GROUP BY 1, 2, 3
+        ''')
+    
+    def rebuild_summaries(self):
+        """Пересчет сводных таблиц статистики по всей истории"""
+        try:
+            conn = self.get_connection()
+            with conn:
+                self._rebuild_summaries(conn)
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка пересчета статистики: {e}")
+            return False
+    
+    def get_summary(self, date_from=None, date_to=None, route=None):
+        """Статистика переименований из сводных таблиц
+        
+        Возвращает словарь: days - [(дата, число)], routes - [(маршрут, число)],
+        hours - [(час, число)] и total - всего за период.
+        """
+        summary = {"days": [], "routes": [], "hours": [], "total": 0}
+        try:
+            where, params = self._build_filter(route, None, date_from, date_to)
+            conn = self.get_connection()
+            summary["days"] = conn.execute(f'''
+                SELECT create_date, SUM(renamed) FROM summary_daily {where}
+                GROUP BY create_date ORDER BY create_date
+            ''', params).fetchall()
+            summary["routes"] = conn.execute(f'''
+                SELECT route, SUM(renamed) FROM summary_daily {where}
+                GROUP BY route ORDER BY 2 DESC
+            ''', params).fetchall()
+            summary["hours"] = conn.execute(f'''
+                SELECT hour, SUM(renamed) FROM summary_hourly {where}
+                GROUP BY hour ORDER BY hour
+            ''', params).fetchall()
+            summary["total"] = sum(count for _, count in summary["days"])
+        except Exception as e:
+            logging.error(f"Ошибка получения статистики: {e}")
+        return summary
+
+class HistoryMaintenance:
+    """Фоновое обслуживание истории: перенос старых записей в архив и incremental vacuum
+    
+    Срок хранения - настройка history_retention_days (0 - хранить все в
+    основной базе). Первый проход выполняется через START_DELAY секунд
+    после запуска (когда закончены догоняющий проход и сверка счетчиков),
+    затем раз в INTERVAL секунд и по wake() (например, после очистки отчета).
+    База переводится в режим auto_vacuum=INCREMENTAL (однократный полный
+    VACUUM) только при включенном сроке хранения.
+    """
+    
+    INTERVAL = 3600
+    START_DELAY = 300
+    
+    def __init__(self, db_manager, settings, interval=INTERVAL, start_delay=START_DELAY):
+        self.db_manager = db_manager
+        self.settings = settings
+        self.interval = interval
+        self.start_delay = start_delay
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+    
+    def start(self):
+        """Запуск потока обслуживания"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Остановка потока обслуживания"""
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.thread = None
+    
+    def wake(self):
+        """Внеочередной проход обслуживания"""
+        self.wake_event.set()
+    
+    def run(self):
+        """Цикл обслуживания"""
+        self.wake_event.wait(self.start_delay)
+        while not self.stop_event.is_set():
+            self.wake_event.clear()
+            self.run_once()
+            self.wake_event.wait(self.interval)
+    
+    def run_once(self):
+        """Один проход: архив по сроку хранения, затем возврат свободного места
+        
+        Без срока хранения место возвращается, только если база уже в
+        режиме incremental (например, после команды archive).
+        """
+        try:
+            retention_days = self.settings.settings.get("history_retention_days", 0)
+            if retention_days > 0:
+                self.db_manager.enable_incremental_vacuum()
+                cutoff = (datetime.now() - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+                moved = self.db_manager.archive_records(cutoff)
+                if moved:
+                    logging.info(f"Перенесено в архив записей старше {cutoff}: {moved}")
+            self.db_manager.incremental_vacuum(self.stop_event)
+        except Exception as e:
+            logging.error(f"Ошибка обслуживания истории: {e}")
+
+# Форматы даты для переменной {date}
+DATE_FORMATS = {
+    "ДДММГГГГ": "%d%m%Y",
+    "ДДММГГ": "%d%m%y",
+    "ГГГГММДД": "%Y%m%d",
+    "ДД.ММ.ГГГГ": "%d.%m.%Y",
+    "ДД.ММ.ГГ": "%d.%m.%y",
+    "ГГГГ.ММ.ДД": "%Y.%m.%d"
+}
+
+class FilenameTemplate:
+    """Скомпилированный шаблон имени файла
+    
+    Шаблон разбирается один раз: постоянные переменные (проект, ЦН, маршрут,
+    дата, пользовательские) сразу подставляются, и при генерации имени
+    остается склеить готовые куски с номером и расширением за один проход.
+    """
+    
+    # Переменные, которые меняются от файла к файлу
+    DYNAMIC_PLACEHOLDERS = ("counter", "extension")
+    # Все известные переменные шаблона
+    PLACEHOLDERS = ("project", "CN", "route", "date", "1", "2", "3") + DYNAMIC_PLACEHOLDERS
+    PLACEHOLDER_RE = re.compile(r"\{([^{}]*)\}")
+    
+    def __init__(self, template, values):
+        """values - значения постоянных переменных: {"project": ..., "CN": ..., ...}"""
+        self.template = template
+        self.unknown_placeholders = []
+        # Куски имени: на четных местах готовый текст, на нечетных - "counter"/"extension"
+        self.segments = []
+        
+        static = []
+        position = 0
+        for match in self.PLACEHOLDER_RE.finditer(template):
+            static.append(template[position:match.start()])
+            position = match.end()
+            name = match.group(1)
+            
+            if name in self.DYNAMIC_PLACEHOLDERS:
+                self.segments.append("".join(static))
+                self.segments.append(name)
+                static = []
+            elif name in values:
+                static.append(values[name])
+            else:
+                # Неизвестная переменная остается в имени как есть
+                self.unknown_placeholders.append(match.group(0))
+                static.append(match.group(0))
+        static.append(template[position:])
+        self.segments.append("".join(static))
+        
+        self.has_counter = "counter" in self.segments[1::2]
+    
+    def render(self, counter_str, extension):
+        """Имя файла без расширения"""
+        dynamic = {"counter": counter_str, "extension": extension}
+        return "".join(
+            segment if i % 2 == 0 else dynamic[segment]
+            for i, segment in enumerate(self.segments)
+        )
+    
+    def counter_pattern(self):
+        """Регулярное выражение для номера в уже сгенерированных по шаблону именах
+        
+        Выражение описывает имя целиком вместе с расширением и применяется
+        через fullmatch: иначе при шаблоне, начинающемся с {counter}, любое
+        имя с цифрами в начале (20251017_1234.jpg) сочтется переименованным.
+        """
+        if not self.has_counter:
+            return None
+        
+        parts = []
+        counter_seen = False
+        for i, segment in enumerate(self.segments):
+            if i % 2 == 0:
+                parts.append(re.escape(segment))
+            elif segment == "counter" and not counter_seen:
+                parts.append(r"(\d+)")
+                counter_seen = True
+            elif segment == "counter":
+                parts.append(r"\d+")
+            else:
+                parts.append(r"[^.]*")
+        parts.append(r"\.[^.]+")
+        return re.compile("".join(parts))
+    
+    @staticmethod
+    def format_date(date_obj, date_format):
+        """Форматирует дату по выбранному формату"""
+        return date_obj.strftime(DATE_FORMATS.get(date_format, "%Y%m%d"))
+    
+    @staticmethod
+    def format_counter(counter, number_format):
+        """Форматирует номер по выбранному формату"""
+        if number_format == "01":
+            return f"{counter:02d}"
+        elif number_format == "001":
+            return f"{counter:03d}"
+        return str(counter)
+    
+    @classmethod
+    def from_settings(cls, template, settings, date_obj=None):
+        """Компиляция шаблона со значениями переменных из словаря настроек"""
+        if date_obj is None:
+            date_obj = datetime.now()
+        return cls(template, {
+            "project": settings["project"],
+            "CN": settings["cn_type"],
+            "route": settings["route"],
+            "date": cls.format_date(date_obj, settings.get("date_format", "ГГГГММДД")),
+            "1": settings["var1"],
+            "2": settings["var2"],
+            "3": settings["var3"]
+        })
+
+class SettingsSnapshot:
+    """Неизменяемый снимок настроек переименования для рабочих потоков
+    
+    Собирается заново только при изменении настроек (Settings.update_setting),
+    поэтому обработчик событий и переименование читают готовые значения без
+    блокировок: множество расширений, скомпилированный шаблон и регулярное
+    выражение номера. Новый снимок подменяет старый одним присваиванием -
+    пачка, начатая со старым снимком, целиком доделывается с ним.
+    """
+    
+    __slots__ = ("version", "project", "cn_type", "route", "number_format", "date_format",
+                 "var1", "var2", "var3", "folder", "template", "extensions", "watch_extensions",
+                 "watch_profiles", "monitoring_enabled", "rename_only_today", "recursive_watch",
+                 "counter_namespace", "observer_mode", "poll_interval_min_ms", "poll_interval_max_ms",
+                 "_compiled")
+    
+    def __init__(self, settings, version=0, watch_profiles=()):
+        """settings - словарь (или ChainMap профиля) настроек"""
+        set_value = object.__setattr__
+        set_value(self, "version", version)
+        for key in ("project", "cn_type", "route", "number_format", "folder", "template",
+                    "var1", "var2", "var3"):
+            set_value(self, key, settings[key])
+        set_value(self, "date_format", settings.get("date_format", "ГГГГММДД"))
+        set_value(self, "extensions", self.parse_extensions(settings["extensions"]))
+        set_value(self, "monitoring_enabled", settings.get("monitoring_enabled", True))
+        set_value(self, "rename_only_today", settings.get("rename_only_today", True))
+        set_value(self, "recursive_watch", settings.get("recursive_watch", False))
+        set_value(self, "counter_namespace", settings.get("counter_namespace") or "")
+        set_value(self, "observer_mode", settings.get("observer_mode", "auto"))
+        set_value(self, "poll_interval_min_ms", settings.get("poll_interval_min_ms", 250))
+        set_value(self, "poll_interval_max_ms", settings.get("poll_interval_max_ms", 5000))
+        
+        profiles = tuple(dict(profile) for profile in watch_profiles)
+        watch_extensions = set(self.extensions)
+        for profile in profiles:
+            if profile.get("extensions"):
+                watch_extensions |= self.parse_extensions(profile["extensions"])
+        set_value(self, "watch_profiles", profiles)
+        set_value(self, "watch_extensions", frozenset(watch_extensions))
+        # (дата, шаблон) - шаблон с подставленной датой пересобирается раз в сутки
+        set_value(self, "_compiled", None)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("SettingsSnapshot неизменяем")
+    
+    @staticmethod
+    def parse_extensions(extensions):
+        """Строка "png, JPG" -> frozenset({"png", "jpg"})"""
+        return frozenset(ext.strip().lower() for ext in extensions.split(",") if ext.strip())
+    
+    def get_template(self, date_obj=None):
+        """Скомпилированный шаблон для даты (по умолчанию - сегодня)"""
+        if date_obj is None:
+            date_obj = datetime.now()
+        date_str = FilenameTemplate.format_date(date_obj, self.date_format)
+        compiled = self._compiled
+        if compiled is None or compiled[0] != date_str:
+            template = FilenameTemplate(self.template, {
+                "project": self.project,
+                "CN": self.cn_type,
+                "route": self.route,
+                "date": date_str,
+                "1": self.var1,
+                "2": self.var2,
+                "3": self.var3
+            })
+            if template.unknown_placeholders:
+                logging.warning(
+                    f"Неизвестные переменные в шаблоне: {', '.join(template.unknown_placeholders)}"
+                )
+            # Кэш внутри снимка: гонка потоков безопасна, в худшем случае шаблон соберется дважды
+            compiled = (date_str, template, template.counter_pattern())
+            object.__setattr__(self, "_compiled", compiled)
+        return compiled[1]
+    
+    def get_counter_pattern(self):
+        """Регулярное выражение номера для сегодняшнего шаблона"""
+        self.get_template()
+        return self._compiled[2]
+    
+    def get_counter_key(self):
+        """Ключ индекса счетчиков: (проект, дата, маршрут, ЦН)
+        
+        Пространство счетчиков профиля (counter_namespace) добавляется к маршруту
+        через "#", чтобы папки с одинаковым маршрутом нумеровались отдельно.
+        """
+        route = f"{self.route}#{self.counter_namespace}" if self.counter_namespace else self.route
+        return (
+            self.project,
+            FilenameTemplate.format_date(datetime.now(), self.date_format),
+            route,
+            self.cn_type
+        )
+
+class RenamedFilesManager:
+    """Менеджер для хранения информации о переименованных файлах
+    
+    Ключи хранятся в таблице renamed_files базы истории: добавление - одна
+    вставка на пачку, проверка - поиск по первичному ключу. Ключи старше
+    max_age_days удаляются при запуске.
+    
+    Ключ файла не зависит от его имени: устройство + номер файла (inode, на
+    Windows - индекс файла NTFS), размер и время изменения. Переименование и
+    перемещение в пределах диска эти значения не меняют, поэтому файл
+    узнается и после переименования, и после перезапуска программы.
+    """
+    
+    # Размер блока в начале и в конце файла для отпечатка содержимого
+    FINGERPRINT_BLOCK = 4096
+    
+    def __init__(self, db_manager, history_file="renamed_files.json", max_age_days=30,
+                 use_fingerprint=False):
+        self.db_manager = db_manager
+        self.history_file = history_file
+        self.max_age_days = max_age_days
+        self.use_fingerprint = use_fingerprint
+        self.load_history()
+    
+    def load_history(self):
+        """Перенос старой истории из JSON в базу и удаление устаревших ключей"""
+        try:
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                legacy_keys = data.get("renamed_files", [])
+                file_keys = self.convert_legacy_keys(legacy_keys)
+                
+                # Время добавления неизвестно - считаем временем последней записи файла
+                if self.db_manager.add_renamed_file_keys(file_keys, os.path.getmtime(self.history_file)):
+                    os.replace(self.history_file, self.history_file + ".bak")
+                    logging.info(f"История переименований перенесена в базу данных: {len(file_keys)} файлов")
+                    if len(file_keys) < len(legacy_keys):
+                        logging.warning(
+                            f"Не перенесено записей старой истории переименований: "
+                            f"{len(legacy_keys) - len(file_keys)} (файлы не найдены) - "
+                            f"эти файлы не защищены от повторного переименования"
+                        )
+        except Exception as e:
+            logging.error(f"Ошибка переноса истории переименований: {e}")
+        
+        if self.max_age_days:
+            evicted = self.db_manager.evict_renamed_file_keys(time.time() - self.max_age_days * 86400)
+            if evicted:
+                logging.info(f"Удалено устаревших записей истории переименований: {evicted}")
+        
+        logging.info(f"Загружена история переименований: {self.db_manager.count_renamed_file_keys()} файлов")
+    
+    def convert_legacy_keys(self, legacy_keys):
+        """Перевод ключей старой истории (JSON) в ключи get_file_key
+        
+        Старый ключ - "имя_время создания" или, чаще, исходный путь файла
+        (ключ снимался уже после переименования). Исходный путь находится в
+        истории переименований, и ключ берется у файла с новым именем.
+        Ключи файлов, которых больше нет, не переносятся.
+        """
+        def normalize(path):
+            return os.path.normcase(os.path.normpath(path))
+        
+        renamed_paths = None
+        file_keys = set()
+        for legacy_key in legacy_keys:
+            path = legacy_key
+            if not os.path.isfile(path):
+                if renamed_paths is None:
+                    renamed_paths = {}
+                    for chunk in self.db_manager.iter_record_chunks():
+                        for _, _, _, _, original_name, _, file_path, _ in chunk:
+                            original_path = os.path.join(os.path.dirname(file_path), original_name)
+                            renamed_paths[normalize(original_path)] = file_path
+                path = renamed_paths.get(normalize(legacy_key))
+                if not path or not os.path.isfile(path):
+                    continue
+            file_key = self.get_file_key(path)
+            if file_key:
+                file_keys.add(file_key)
+        return list(file_keys)
+    
+    def add_renamed_file(self, filepath):
+        """Добавление файла в историю переименований"""
+        self.add_renamed_files([filepath])
+    
+    def add_renamed_files(self, filepaths):
+        """Добавление пачки файлов в историю одной транзакцией"""
+        self.add_file_keys([self.get_file_key(filepath) for filepath in filepaths])
+    
+    def add_file_keys(self, file_keys):
+        """Добавление заранее вычисленных ключей (например, снятых до переименования)"""
+        file_keys = [file_key for file_key in file_keys if file_key]
+        if file_keys:
+            self.db_manager.add_renamed_file_keys(file_keys)
+    
+    def is_file_renamed(self, filepath):
+        """Проверка, был ли файл уже переименован программой"""
+        return self.is_key_renamed(self.get_file_key(filepath))
+    
+    def is_key_renamed(self, file_key):
+        """Проверка ключа файла по истории переименований"""
+        return bool(file_key) and self.db_manager.has_renamed_file_key(file_key)
+    
+    def get_file_key(self, filepath, stat=None):
+        """Создание ключа файла; None, если файл недоступен"""
+        try:
+            if stat is None:
+                stat = os.stat(filepath)
+            file_key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+            
+            # Если файловая система не сообщает номер файла, без отпечатка ключ не уникален
+            if self.use_fingerprint or not stat.st_ino:
+                file_key += f":{self.get_fingerprint(filepath, stat.st_size)}"
+            
+            return file_key
+        except OSError as e:
+            logging.warning(f"Не удалось получить ключ файла {filepath}: {e}")
+            return None
+    
+    def get_fingerprint(self, filepath, size):
+        """Отпечаток содержимого по первому и последнему блоку файла"""
+        digest = hashlib.blake2b(digest_size=8)
+        with open(filepath, 'rb') as f:
+            digest.update(f.read(self.FINGERPRINT_BLOCK))
+            if size > self.FINGERPRINT_BLOCK:
+                f.seek(max(size - self.FINGERPRINT_BLOCK, self.FINGERPRINT_BLOCK))
+                digest.update(f.read(self.FINGERPRINT_BLOCK))
+        return digest.hexdigest()
+
+class Settings:
+    """Класс для работы с настройками
+    
+    Изменения сохраняются в файл отложенно: save_settings только отмечает
+    настройки измененными, запись выполняется не чаще раза в FLUSH_INTERVAL
+    секунд, а также при flush() (закрытие программы) и при выходе из процесса.
+    """
+    
+    # Минимальный интервал между записями settings.json (секунды)
+    FLUSH_INTERVAL = 1.0
+    
+    def __init__(self, filename="settings.json"):
+        self.filename = filename
+        
+        # Отложенное сохранение: флаг изменений и таймер записи
+        self.dirty = False
+        self.flush_timer = None
+        self.save_lock = threading.Lock()
+        atexit.register(self.flush)
+        
+        self.default_settings = {
+            "project": "Проект1",
+            "cn_type": "VK",
+            "route": "M2.1",
+            "number_format": "01",
+            "date_format": "ГГГГММДД",
+            "var1": "Значение1",
+            "var2": "Значение2",
+            "var3": "Значение3",
+            "folder": r"C:\video\violations",
+            "extensions": "png,jpg,jpeg",
+            "template": "{project}_{date}_{route}_{counter}_{CN}",
+            "monitoring_enabled": True,
+            "rename_only_today": True,
+            "catch_up_on_start": True,
+            "renamed_files_max_age_days": 30,
+            "file_fingerprint": False,
+            "recursive_watch": False,
+            "watch_profiles": [],
+            "observer_mode": "auto",
+            "poll_interval_min_ms": 250,
+            "poll_interval_max_ms": 5000,
+            "history_retention_days": 0,
+            "folder_history": [
+                r"C:\video\violations",
+                r"C:\temp\files",
+                r"D:\projects\images"
+            ],
+            "template_history": [
+                "{project}_{date}_{route}_{counter}_{CN}",
+                "{project}_{CN}_{date}_{counter}",
+                "{route}_{date}_{counter}_{project}"
+            ],
+            "enabled_plugins": ["example_plugin"],
+            "combobox_values": {
+                "project": ["Проект1", "Проект2"],
+                "cn_type": ["VK", "Другой"],
+                "route": ["M2.1", "M2.2", "M2.3"],
+                "number_format": ["1", "01", "001"],
+                "date_format": ["ДДММГГГГ", "ДДММГГ", "ГГГГММДД", "ДД.ММ.ГГГГ", "ДД.ММ.ГГ", "ГГГГ.ММ.ДД"],
+                "var1": ["Значение1", "Значение2"],
+                "var2": ["Значение1", "Значение2"],
+                "var3": ["Значение1", "Значение2"]
+            },
+            "report_route_history": [],
+            "column_order": ["number", "create_time", "route", "new_name"],
+            "column_visibility": {
+                "number": True,
+                "create_time": True,
+                "route": True,
+                "new_name": True
+            }
+        }
+        self.snapshot = None
+        self.load_settings()
+    
+    def load_settings(self):
+        """Загрузка настроек из файла"""
+        try:
+            if os.path.exists(self.filename):
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    loaded_settings = json.load(f)
+                    # Объединяем с настройками по умолчанию для совместимости
+                    # Обеспечиваем обратную совместимость: если есть старый tl_type, копируем его в cn_type
+                    if "tl_type" in loaded_settings and "cn_type" not in loaded_settings:
+                        loaded_settings["cn_type"] = loaded_settings["tl_type"]
+                    
+                    # Обновляем шаблоны в истории для обратной совместимости
+                    if "template_history" in loaded_settings:
+                        for i, template in enumerate(loaded_settings["template_history"]):
+                            if "{TL}" in template:
+                                loaded_settings["template_history"][i] = template.replace("{TL}", "{CN}")
+                    
+                    # Обновляем основной шаблон для обратной совместимости
+                    if "template" in loaded_settings and "{TL}" in loaded_settings["template"]:
+                        loaded_settings["template"] = loaded_settings["template"].replace("{TL}", "{CN}")
+                    
+                    # Добавляем новые поля если их нет
+                    if "report_route_history" not in loaded_settings:
+                        loaded_settings["report_route_history"] = []
+                    
+                    if "column_order" not in loaded_settings:
+                        loaded_settings["column_order"] = self.default_settings["column_order"]
+                    
+                    if "column_visibility" not in loaded_settings:
+                        loaded_settings["column_visibility"] = self.default_settings["column_visibility"]
+                    
+                    self.settings = {**self.default_settings, **loaded_settings}
+            else:
+                self.settings = self.default_settings
+                # Первый запуск - файл создается сразу, до изменений в памяти
+                self.save_settings()
+                self.flush()
+        except Exception as e:
+            logging.error(f"Ошибка загрузки настроек: {e}")
+            self.settings = self.default_settings
+        self.rebuild_snapshot()
+    
+    def rebuild_snapshot(self):
+        """Пересборка снимка настроек (после изменения self.settings в обход update_setting)"""
+        try:
+            version = self.snapshot.version + 1 if self.snapshot else 1
+            self.snapshot = SettingsSnapshot(self.settings, version,
+                                             self.get_watch_profiles()[1:])
+        except Exception as e:
+            logging.error(f"Ошибка сборки снимка настроек: {e}")
+    
+    def save_settings(self):
+        """Сохранение настроек в файл (отложенное)
+        
+        Серия изменений подряд записывается в файл одной записью через
+        FLUSH_INTERVAL секунд после первого изменения.
+        """
+        with self.save_lock:
+            self.dirty = True
+            if self.flush_timer is None:
+                self.schedule_flush()
+    
+    def schedule_flush(self):
+        """Запуск таймера записи (вызывается под save_lock)"""
+        self.flush_timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+    
+    def flush(self):
+        """Запись несохраненных изменений в файл
+        
+        Настройки пишутся во временный файл, который затем подменяет
+        settings.json через os.replace: при сбое посреди записи на диске
+        остается прежний целый файл. Сериализуется копия, снятая под
+        save_lock; если запись не удалась, она повторяется по таймеру.
+        """
+        with self.save_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.dirty:
+                return True
+            
+            temp_filename = f"{self.filename}.tmp"
+            try:
+                data = json.dumps(copy.deepcopy(self.settings), ensure_ascii=False, indent=2)
+                with open(temp_filename, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_filename, self.filename)
+                self.dirty = False
+                return True
+            except Exception as e:
+                logging.error(f"Ошибка сохранения настроек: {e}")
+                # Изменения остаются несохраненными - повторяем запись позже
+                self.schedule_flush()
+                return False
+    
+    def update_setting(self, key, value):
+        """Обновление значения настройки
+        
+        Все изменения self.settings (в том числе из плагинов) идут через
+        update_setting/update_settings: запись в файл идет из другого потока и
+        копирует словарь под save_lock. Вложенные словари и списки передаются
+        новыми объектами, а не меняются на месте.
+        """
+        with self.save_lock:
+            self.settings[key] = value
+        self.rebuild_snapshot()
+        self.save_settings()
+
+    def update_settings(self, values):
+        """Обновление нескольких настроек сразу
+
+        Снимок пересобирается один раз, поэтому потоки переименования не
+        увидят наполовину примененное изменение (новую папку со старым шаблоном).
+        """
+        with self.save_lock:
+            self.settings.update(values)
+        self.rebuild_snapshot()
+        self.save_settings()
+
+    def get_watch_profiles(self):
+        """Папки наблюдения: основная папка и дополнительные профили
+        
+        Профиль - словарь с папкой (folder), флагом подпапок (recursive),
+        необязательным пространством счетчиков (counter_namespace) и любыми
+        настройками переименования, которые заменяют общие (template, route...).
+        """
+        profiles = [{"folder": self.settings["folder"],
+                     "recursive": self.settings.get("recursive_watch", False)}]
+        for profile in self.settings.get("watch_profiles", []):
+            if profile.get("folder"):
+                profiles.append(profile)
+        return profiles
+    
+    def add_to_folder_history(self, folder):
+        """Добавление папки в историю"""
+        with self.save_lock:
+            if not folder or folder in self.settings["folder_history"]:
+                return
+            # Ограничиваем историю 10 элементами
+            self.settings["folder_history"] = [folder] + self.settings["folder_history"][:9]
+        self.save_settings()
+    
+    def add_to_template_history(self, template):
+        """Добавление шаблона в историю"""
+        with self.save_lock:
+            if not template or template in self.settings["template_history"]:
+                return
+            # Ограничиваем историю 10 элементами
+            self.settings["template_history"] = [template] + self.settings["template_history"][:9]
+        self.save_settings()
+    
+    def add_to_route_history(self, route):
+        """Добавление маршрута в историю для отчета"""
+        with self.save_lock:
+            if not route or route in self.settings["report_route_history"]:
+                return
+            self.settings["report_route_history"] = self.settings["report_route_history"] + [route]
+        self.save_settings()
+    
+    def add_to_combobox_values(self, key, value):
+        """Добавление значения в список значений комбобокса"""
+        with self.save_lock:
+            values = self.settings["combobox_values"].get(key)
+            if values is None or not value or value in values:
+                return
+            self.settings["combobox_values"] = {**self.settings["combobox_values"], key: values + [value]}
+        self.save_settings()
+
+class ProfileSettings:
+    """Настройки папки наблюдения: значения профиля поверх общих настроек
+    
+    Повторяет интерфейс Settings для чтения (атрибут settings), поэтому
+    RenameService работает с профилем так же, как с общими настройками.
+    Изменения общих настроек видны сразу.
+    """
+    
+    def __init__(self, settings, profile):
+        self.base = settings
+        self.profile = profile
+        overrides = dict(profile)
+        overrides["recursive_watch"] = overrides.pop("recursive", False)
+        self.settings = ChainMap(overrides, settings.settings)
+        self._snapshot = None
+    
+    @property
+    def snapshot(self):
+        """Снимок профиля, пересобирается вслед за снимком общих настроек"""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self.base.snapshot.version:
+            snapshot = SettingsSnapshot(self.settings, self.base.snapshot.version)
+            self._snapshot = snapshot
+        return snapshot
+
+def is_network_path(folder):
+    """Папка на сетевом или съемном диске, где события ОС ненадежны"""
+    try:
+        folder = os.path.abspath(folder)
+        if folder.startswith(("\\\\", "//")):
+            return True
+        
+        if os.name == "nt":
+            import ctypes
+            drive = os.path.splitdrive(folder)[0] + "\\"
+            # DRIVE_REMOVABLE = 2, DRIVE_REMOTE = 4
+            return ctypes.windll.kernel32.GetDriveTypeW(drive) in (2, 4)
+        
+        # Linux: тип файловой системы самой глубокой точки монтирования
+        if os.path.exists("/proc/mounts"):
+            best_mount, best_type = "", ""
+            with open("/proc/mounts", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) < 3:
+                        continue
+                    mount_point = parts[1].replace("\\040", " ")
+                    if (folder == mount_point or folder.startswith(os.path.join(mount_point, ""))) \
+                            and len(mount_point) > len(best_mount):
+                        best_mount, best_type = mount_point, parts[2]
+            return best_type in DirectoryPoller.NETWORK_FILESYSTEMS
+    except Exception as e:
+        logging.warning(f"Не удалось определить тип диска для {folder}: {e}")
+    return False
+
+class DirectoryPoller:
+    """Наблюдение за папками опросом (сетевые диски, кардридеры)
+    
+    Каждая папка хранится снимком: время изменения папки и ее файлы
+    (путь -> inode, время изменения). Папка, время изменения которой не
+    поменялось, повторно не читается; раз в FULL_RESCAN_EVERY опросов все
+    папки перечитываются целиком (на сетевых дисках время изменения папки
+    обновляется не всегда). Пока изменений нет, интервал опроса растет от
+    min_interval до max_interval, при новом файле сбрасывается.
+    
+    Статистика опроса (get_stats): длительность и процессорное время
+    сканирования, задержка обнаружения файла (от его времени изменения).
+    """
+    
+    # Файловые системы, для которых режим "auto" выбирает опрос
+    NETWORK_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p",
+                           "vfat", "exfat", "msdos", "fuseblk"}
+    FULL_RESCAN_EVERY = 20
+    # Множитель интервала опроса, пока изменений нет
+    BACKOFF = 1.5
+    # Как часто писать статистику опроса в лог (сек)
+    STATS_LOG_INTERVAL = 300
+    
+    def __init__(self, roots, on_new_file, min_interval=0.25, max_interval=5.0, ignore_renames=False):
+        """roots - [(папка, с подпапками)], on_new_file(path) вызывается для новых файлов
+        
+        ignore_renames - не сообщать о переименовании внутри папки с тем же
+        расширением (мониторингу не нужны файлы, которые он сам переименовал).
+        """
+        self.roots = roots
+        self.on_new_file = on_new_file
+        self.ignore_renames = ignore_renames
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min_interval
+        # папка -> (время изменения папки, {путь файла: (inode, время изменения)}, [подпапки])
+        self.snapshots = {}
+        self.scan_count = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = {"scans": 0, "scan_time": 0.0, "cpu_time": 0.0, "max_scan_time": 0.0,
+                      "detected": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self.stats_logged_at = time.monotonic()
+    
+    def start(self):
+        """Снимок текущего состояния (существующие файлы не считаются новыми) и запуск опроса"""
+        for folder, recursive in self.roots:
+            self.scan_root(folder, recursive, report=False)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.poll_loop, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Остановка потока опроса"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=self.max_interval + 2)
+            self.thread = None
+        self.log_stats()
+    
+    def poll_loop(self):
+        """Цикл опроса с адаптивным интервалом"""
+        while not self.stop_event.wait(self.interval):
+            try:
+                found = self.scan_once()
+                if found:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * self.BACKOFF, self.max_interval)
+                
+                if time.monotonic() - self.stats_logged_at >= self.STATS_LOG_INTERVAL:
+                    self.log_stats()
+            except Exception as e:
+                logging.error(f"Ошибка опроса папок: {e}")
+    
+    def scan_once(self):
+        """Один проход по всем папкам, возвращает количество новых файлов"""
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        self.scan_count += 1
+        full = self.scan_count % self.FULL_RESCAN_EVERY == 0
+        
+        found = 0
+        for folder, recursive in self.roots:
+            found += self.scan_root(folder, recursive, report=True, full=full)
+        
+        elapsed = time.perf_counter() - started
+        self.stats["scans"] += 1
+        self.stats["scan_time"] += elapsed
+        self.stats["cpu_time"] += time.thread_time() - cpu_started
+        self.stats["max_scan_time"] = max(self.stats["max_scan_time"], elapsed)
+        return found
+    
+    def scan_root(self, root, recursive, report=True, full=False):
+        """Обход папки (и подпапок) с перечитыванием только измененных папок"""
+        found = 0
+        stack = [root]
+        seen = set()
+        while stack:
+            folder = stack.pop()
+            seen.add(folder)
+            try:
+                dir_mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                self.snapshots.pop(folder, None)
+                continue
+            
+            previous = self.snapshots.get(folder)
+            if previous is not None and previous[0] == dir_mtime and not full:
+                if recursive:
+                    stack.extend(previous[2])
+                continue
+            
+            files = {}
+            subfolders = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file():
+                                stat = entry.stat()
+                                files[entry.path] = (stat.st_ino, stat.st_mtime_ns)
+                            elif recursive and entry.is_dir(follow_symlinks=False):
+                                subfolders.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                logging.warning(f"Не удалось прочитать папку {folder}: {e}")
+                continue
+            
+            # Для новой подпапки все ее файлы новые (корень без снимка - первичный снимок)
+            if report and (previous is not None or folder != root):
+                old_files = previous[1] if previous is not None else {}
+                old_inodes = {value[0]: old_path for old_path, value in old_files.items()}
+                now = time.time()
+                for path, (inode, mtime_ns) in files.items():
+                    # Новый путь или другой файл под тем же именем (сменился inode).
+                    # При ignore_renames переименование внутри папки с тем же
+                    # расширением новым файлом не считается, а
+                    # "файл.tmp" -> "файл.jpg" - считается
+                    old = old_files.get(path)
+                    if self.ignore_renames and old is None and inode and inode in old_inodes:
+                        if Path(old_inodes[inode]).suffix.lower() == Path(path).suffix.lower():
+                            continue
+                    if old is None or old[0] != inode:
+                        found += 1
+                        latency = max(0.0, now - mtime_ns / 1e9)
+                        self.stats["detected"] += 1
+                        self.stats["latency_total"] += latency
+                        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                        self.on_new_file(path)
+            
+            self.snapshots[folder] = (dir_mtime, files, subfolders)
+            if recursive:
+                stack.extend(subfolders)
+        
+        # Удаленные подпапки больше не храним
+        if recursive:
+            prefix = os.path.join(root, "")
+            for folder in [f for f in self.snapshots if f.startswith(prefix) and f not in seen]:
+                del self.snapshots[folder]
+        return found
+    
+    def get_stats(self):
+        """Статистика опроса: средние и максимальные значения в миллисекундах"""
+        scans = self.stats["scans"] or 1
+        detected = self.stats["detected"] or 1
+        return {
+            "scans": self.stats["scans"],
+            "interval_ms": round(self.interval * 1000),
+            "avg_scan_ms": round(self.stats["scan_time"] / scans * 1000, 2),
+            "max_scan_ms": round(self.stats["max_scan_time"] * 1000, 2),
+            "cpu_ms": round(self.stats["cpu_time"] * 1000, 1),
+            "detected": self.stats["detected"],
+            "avg_latency_ms": round(self.stats["latency_total"] / detected * 1000),
+            "max_latency_ms": round(self.stats["latency_max"] * 1000),
+        }
+    
+    def log_stats(self):
+        """Запись статистики опроса в лог"""
+        self.stats_logged_at = time.monotonic()
+        stats = self.get_stats()
+        logging.info(
+            f"Опрос папок: проходов {stats['scans']}, в среднем {stats['avg_scan_ms']} мс "
+            f"(макс. {stats['max_scan_ms']} мс), процессор {stats['cpu_ms']} мс, "
+            f"интервал {stats['interval_ms']} мс, новых файлов {stats['detected']}, "
+            f"задержка обнаружения {stats['avg_latency_ms']} мс (макс. {stats['max_latency_ms']} мс)"
+        )
+
+class FileMonitor:
+    """Класс для мониторинга файлов
+    
+    Папки наблюдаются через события ОС (watchdog) или опросом (DirectoryPoller).
+    Режим observer_mode: "native" - только события, "polling" - только опрос,
+    "auto" - опрос для сетевых и съемных дисков, а также для папок, где
+    подписка на события не удалась.
+    """
+    def __init__(self, settings, rename_callback):
+        self.settings = settings
+        self.rename_callback = rename_callback
+        self.observer = None
+        self.poller = None
+        self.event_handler = None
+        self.is_monitoring = False
+    
+    def start_monitoring(self):
+        """Запуск мониторинга"""
+        if self.is_monitoring:
+            return
+        
+        roots = self.get_watch_roots()
+        if not roots:
+            return False
+        
+        try:
+            snapshot = self.settings.snapshot
+            mode = snapshot.observer_mode
+            native_roots = []
+            polled_roots = []
+            for root in roots:
+                if mode == "polling" or (mode == "auto" and is_network_path(root[0])):
+                    polled_roots.append(root)
+                else:
+                    native_roots.append(root)
+            
+            # Один наблюдатель и один обработчик (с одним потоком-планировщиком) на все папки
+            self.event_handler = FileHandler(self.settings, self.rename_callback)
+            if native_roots:
+                self.observer = Observer()
+                for folder, recursive in native_roots:
+                    try:
+                        self.observer.schedule(self.event_handler, folder, recursive=recursive)
+                    except Exception as e:
+                        if mode == "native":
+                            raise
+                        logging.warning(f"События ОС недоступны для {folder} ({e}) - используется опрос")
+                        polled_roots.append((folder, recursive))
+                self.observer.start()
+            
+            if polled_roots:
+                self.poller = DirectoryPoller(
+                    polled_roots, self.event_handler.on_file_found,
+                    min_interval=snapshot.poll_interval_min_ms / 1000,
+                    max_interval=snapshot.poll_interval_max_ms / 1000,
+                    ignore_renames=True
+                )
+                self.poller.start()
+            
+            self.is_monitoring = True
+            for folder, recursive in roots:
+                method = "опрос" if (folder, recursive) in polled_roots else "события ОС"
+                logging.info(f"Мониторинг запущен: {folder}{' (с подпапками)' if recursive else ''}, {method}")
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка запуска мониторинга: {e}")
+            return False
+    
+    def get_watch_roots(self):
+        """Существующие папки наблюдения: [(папка, с подпапками)]
+        
+        Папка внутри другой папки, наблюдаемой с подпапками, отдельно не
+        подписывается - ее события и так приходят от родительской.
+        """
+        roots = {}
+        for profile in self.settings.get_watch_profiles():
+            folder = os.path.abspath(profile["folder"])
+            if not os.path.isdir(folder):
+                logging.error(f"Папка не существует: {folder}")
+                continue
+            roots[folder] = roots.get(folder, False) or bool(profile.get("recursive", False))
+        
+        recursive_roots = [folder for folder, recursive in roots.items() if recursive]
+        result = []
+        for folder, recursive in sorted(roots.items()):
+            if any(folder != parent and folder.startswith(os.path.join(parent, ""))
+                   for parent in recursive_roots):
+                continue
+            result.append((folder, recursive))
+        return result
+    
+    def stop_monitoring(self):
+        """Остановка мониторинга"""
+        if self.is_monitoring:
+            try:
+                if self.observer:
+                    self.observer.stop()
+                    self.observer.join()
+                    self.observer = None
+                if self.poller:
+                    self.poller.stop()
+                    self.poller = None
+                if self.event_handler:
+                    self.event_handler.stop()
+                self.is_monitoring = False
+                logging.info("Мониторинг остановлен")
+            except Exception as e:
+                logging.error(f"Ошибка остановки мониторинга: {e}")
+
+class FileHandler(FileSystemEventHandler):
+    """Обработчик событий файловой системы
+    
+    События создания, перемещения (в том числе переименования временного файла
+    в итоговое имя) и изменения сводятся к одному сигналу "файл появился":
+    файл попадает в одну очередь ожидания, повторные события для него не
+    проверяются заново. Очередь обслуживает единственный поток-планировщик:
+    файл передается на переименование, когда его размер и время изменения
+    перестают меняться.
+    """
+    
+    # Период опроса размера ожидающих файлов (сек)
+    POLL_INTERVAL = 0.2
+    # Сколько размер и время изменения должны оставаться неизменными (сек)
+    STABLE_TIME = 0.5
+    # Сколько помнить файлы, переданные на переименование (сек) - их
+    # перемещение программой не считается новым файлом
+    DELIVERED_TTL = 60
+    # Предел запоминаемых путей с неподходящим расширением
+    IGNORED_LIMIT = 10000
+    
+    def __init__(self, settings, rename_callback):
+        self.settings = settings
+        self.rename_callback = rename_callback
+        # путь -> [размер, время изменения, момент последнего изменения]
+        self.pending_files = {}
+        self.pending_condition = threading.Condition()
+        # путь -> момент передачи на переименование
+        self.delivered = {}
+        # пути с неподходящим расширением (проверяются один раз)
+        self.ignored = set()
+        self.stopped = False
+        self.scheduler_thread = threading.Thread(target=self.scheduler_loop, daemon=True)
+        self.scheduler_thread.start()
+    
+    def on_created(self, event):
+        """Обработка создания файла"""
+        if not event.is_directory:
+            self.on_file_found(event.src_path)
+    
+    def on_modified(self, event):
+        """Изменение файла (некоторые программы и сетевые диски не дают события создания)"""
+        if not event.is_directory:
+            self.on_file_found(event.src_path)
+    
+    def on_moved(self, event):
+        """Перемещение файла: файл появился под новым именем"""
+        if event.is_directory:
+            return
+        with self.pending_condition:
+            # Ожидавший файл переехал - ждем его под новым именем
+            self.pending_files.pop(event.src_path, None)
+            # Файл уже передан на переименование - это наше переименование
+            own_rename = event.src_path in self.delivered
+        if not own_rename:
+            self.on_file_found(event.dest_path)
+    
+    def on_file_found(self, filepath):
+        """Новый файл (событие ОС или опрос папки) с проверкой расширения
+        
+        Повторные события для ожидающего файла и для файла с неподходящим
+        расширением отбрасываются без повторных проверок.
+        """
+        snapshot = self.settings.snapshot
+        
+        # Проверяем, включен ли мониторинг
+        if not snapshot.monitoring_enabled:
+            return
+        
+        with self.pending_condition:
+            if filepath in self.pending_files or filepath in self.ignored:
+                return
+        
+        # Проверяем расширение файла (по всем папкам наблюдения)
+        file_ext = Path(filepath).suffix.lower().lstrip('.')
+        
+        if file_ext in snapshot.watch_extensions:
+            self.queue_file(filepath)
+        else:
+            with self.pending_condition:
+                if len(self.ignored) >= self.IGNORED_LIMIT:
+                    self.ignored.clear()
+                self.ignored.add(filepath)
+            logging.info(f"Файл {filepath} пропущен - расширение {file_ext} не в списке разрешенных")
+    
+    def queue_file(self, filepath):
+        """Постановка файла в очередь ожидания окончания записи"""
+        with self.pending_condition:
+            if filepath not in self.pending_files:
+                self.pending_files[filepath] = [None, None, time.monotonic()]
+                self.pending_condition.notify()
+    
+    def stop(self):
+        """Остановка потока-планировщика"""
+        with self.pending_condition:
+            self.stopped = True
+            self.pending_condition.notify()
+        self.scheduler_thread.join(timeout=2)
+    
+    def collect_ready_files(self):
+        """Проверка ожидающих файлов, возвращает готовые в порядке поступления"""
+        now = time.monotonic()
+        ready = []
+        
+        with self.pending_condition:
+            for filepath, state in list(self.pending_files.items()):
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    # Файл удален или переименован до окончания записи
+                    del self.pending_files[filepath]
+                    continue
+                
+                if state[0] == stat.st_size and state[1] == stat.st_mtime_ns:
+                    if now - state[2] >= self.STABLE_TIME:
+                        ready.append(filepath)
+                        del self.pending_files[filepath]
+                        self.delivered[filepath] = now
+                else:
+                    state[0] = stat.st_size
+                    state[1] = stat.st_mtime_ns
+                    state[2] = now
+            
+            if ready:
+                # Забываем давно переданные файлы
+                expired = now - self.DELIVERED_TTL
+                self.delivered = {path: at for path, at in self.delivered.items() if at >= expired}
+        
+        return ready
+    
+    def scheduler_loop(self):
+        """Цикл потока-планировщика"""
+        while True:
+            with self.pending_condition:
+                while not self.pending_files and not self.stopped:
+                    self.pending_condition.wait()
+                if self.stopped:
+                    return
+                self.pending_condition.wait(self.POLL_INTERVAL)
+                if self.stopped:
+                    return
+            
+            ready = self.collect_ready_files()
+            if ready:
+                self.safe_rename_callback(ready)
+    
+    def safe_rename_callback(self, filepaths):
+        """Безопасный вызов callback с обработкой исключений"""
+        try:
+            self.rename_callback(filepaths)
+        except Exception as e:
+            logging.error(f"Критическая ошибка в обработчике переименования: {e}")
+            # Не падаем, а просто логируем ошибку
+
+class RenamePlanItem:
+    """Пункт плана переименования: один файл и назначенное ему имя
+    
+    conflict - None, если имя свободно, CONFLICT_EXISTS, если файл с таким
+    именем уже есть в папке, CONFLICT_DUPLICATE, если то же имя назначено
+    другому файлу плана (шаблон без {counter}).
+    """
+    
+    CONFLICT_EXISTS = "exists"
+    CONFLICT_DUPLICATE = "duplicate"
+    
+    # Колонки таблицы плана для предпросмотра
+    COLUMNS = ("№", "Маршрут", "Исходное имя", "Новое имя", "Статус")
+    
+    __slots__ = ("filepath", "new_path", "counter_key", "counter", "route", "file_key", "create_time",
+                 "conflict", "batch_id")
+    
+    def __init__(self, filepath, new_path, counter_key, counter, route, file_key, create_time,
+                 conflict=None):
+        self.filepath = filepath
+        self.new_path = new_path
+        self.counter_key = counter_key
+        self.counter = counter
+        self.route = route
+        self.file_key = file_key
+        self.create_time = create_time
+        self.conflict = conflict
+        # Пачка журнала переименований (назначается при выполнении плана)
+        self.batch_id = None
+    
+    @property
+    def original_name(self):
+        return os.path.basename(self.filepath)
+    
+    @property
+    def new_name(self):
+        return os.path.basename(self.new_path)
+    
+    def to_record(self, timestamp):
+        """Запись для DatabaseManager.add_records"""
+        return (timestamp, self.route, self.original_name, self.new_name, self.new_path,
+                self.counter_key, self.counter)
+    
+    def to_journal_entry(self, timestamp):
+        """Строка журнала для DatabaseManager.begin_journal"""
+        return (timestamp, self.filepath, self.new_path, self.route, self.counter_key, self.counter,
+                self.file_key, self.create_time, None)
+    
+    def to_report_entry(self):
+        """Строка для отчета: (исходное имя, новое имя, время создания, маршрут)"""
+        return (self.original_name, self.new_name, self.create_time, self.route)
+    
+    @property
+    def status(self):
+        """Статус пункта для таблицы предпросмотра"""
+        if self.conflict == self.CONFLICT_EXISTS:
+            return "Имя занято"
+        if self.conflict == self.CONFLICT_DUPLICATE:
+            return "Повтор в плане"
+        return "OK"
+    
+    @classmethod
+    def iter_rows(cls, items):
+        """Построчная выдача плана в колонках COLUMNS (без копирования всего списка)"""
+        for number, item in enumerate(items, 1):
+            yield [number, item.route, item.original_name, item.new_name, item.status]
+
+class RenameService:
+    """Ядро переименования без графического интерфейса
+    
+    Счетчики, шаблон имени, проверки файла и само переименование с записью в
+    историю. Используется окном программы, консольным режимом (renamer_cli.py)
+    и плагинами (атрибут rename_service).
+    
+    Переименование идет в три шага: plan() назначает имена без изменений на
+    диске, apply() переименовывает файлы, record() пишет историю. preview()
+    и apply_plan() дают то же самое с предпросмотром плана между шагами.
+    
+    Дополнительные папки наблюдения (профили) обслуживают дочерние сервисы
+    (for_profile) с общей блокировкой и кэшем счетчиков; dispatch_files
+    распределяет файлы мониторинга по ним.
+    """
+    
+    # Размер пачки при догоняющем переименовании существующих файлов
+    CATCH_UP_BATCH_SIZE = 500
+    
+    def __init__(self, settings, db_manager, renamed_files_manager, on_renamed=None,
+                 on_history_changed=None, rename_lock=None, counter_cache=None):
+        """on_renamed(entries) вызывается после каждой переименованной пачки,
+        on_history_changed() - после отмены переименований.
+        rename_lock и counter_cache передаются сервисам профилей папок (for_profile)."""
+        self.settings = settings
+        self.db_manager = db_manager
+        self.renamed_files_manager = renamed_files_manager
+        self.on_renamed = on_renamed
+        self.on_history_changed = on_history_changed
+        
+        # Блокировка: пачки переименовываются строго по очереди (общая для всех папок)
+        self.rename_lock = rename_lock if rename_lock is not None else threading.Lock()
+        
+        # Кэш счетчиков: (проект, дата, маршрут, ЦН) -> последний выданный номер
+        self.counter_cache = counter_cache if counter_cache is not None else {}
+        
+        # Сервисы папок наблюдения: [(папка, с подпапками, сервис)] и версия снимка настроек
+        self.profile_services = []
+        self.profile_services_version = None
+        # Подпапки, которые обслуживают другие профили (не обходятся при сканировании)
+        self.excluded_folders = set()
+    
+    def format_date_by_format(self, date_obj, date_format):
+        """Форматирует дату по выбранному формату"""
+        return FilenameTemplate.format_date(date_obj, date_format)
+    
+    def get_compiled_template(self):
+        """Скомпилированный шаблон для текущих настроек (из снимка настроек)"""
+        return self.settings.snapshot.get_template()
+    
+    def generate_filename(self, filepath, counter=None):
+        """Генерация имени файла по шаблону"""
+        snapshot = self.settings.snapshot
+        file_ext = Path(filepath).suffix.lower()[1:]  # Без точки
+        
+        # Если счетчик не передан, вычисляем его
+        if counter is None:
+            counter = self.get_next_counter(snapshot)
+        
+        counter_str = FilenameTemplate.format_counter(counter, snapshot.number_format)
+        filename = snapshot.get_template().render(counter_str, file_ext)
+        
+        return f"{filename}.{file_ext}"
+
+    def get_counter_key(self):
+        """Ключ индекса счетчиков для текущих настроек: (проект, дата, маршрут, ЦН)"""
+        return self.settings.snapshot.get_counter_key()
+    
+    def get_counter_pattern(self):
+        """Регулярное выражение для поиска номера в именах файлов по текущему шаблону"""
+        return self.settings.snapshot.get_counter_pattern()
+    
+    def get_next_counter(self, snapshot=None):
+        """Получение следующего номера счетчика из индекса (без сканирования папки)"""
+        snapshot = snapshot or self.settings.snapshot
+        counter_key = snapshot.get_counter_key()
+        
+        # Ключ встречается впервые (новый день, маршрут и т.п.) - сверяем один раз
+        if counter_key not in self.counter_cache:
+            self.reconcile_counter(counter_key, snapshot)
+        
+        return self.counter_cache[counter_key] + 1
+    
+    def reconcile_counters(self):
+        """Сверка индекса счетчиков с папками и историей (при запуске и смене папки)"""
+        with self.rename_lock:
+            self.counter_cache.clear()
+            for _, _, service in self.get_profile_services():
+                service.reconcile_counter(service.get_counter_key())
+    
+    def reconcile_counter(self, counter_key, snapshot=None):
+        """Вычисление максимального номера для ключа по индексу, папке и истории"""
+        snapshot = snapshot or self.settings.snapshot
+        max_counter = self.db_manager.get_counter(counter_key)
+        pattern = snapshot.get_counter_pattern()
+        
+        folder = snapshot.folder
+        if pattern and os.path.exists(folder):
+            try:
+                for entry in self.iter_folder_files(folder, snapshot.recursive_watch, self.excluded_folders):
+                    match = pattern.fullmatch(entry.name)
+                    if match:
+                        max_counter = max(max_counter, int(match.group(1)))
+            except Exception as e:
+                logging.error(f"Ошибка сканирования папки {folder}: {e}")
+        
+        # Также проверяем историю переименований на случай, если файлы были удалены
+        # но мы хотим продолжить нумерацию с правильного номера
+        if pattern:
+            max_counter = max(max_counter, self.get_max_counter_from_history(pattern))
+        
+        self.counter_cache[counter_key] = max_counter
+        if max_counter:
+            self.db_manager.update_counter(counter_key, max_counter)
+        
+        logging.info(f"Счетчик для {'_'.join(counter_key)}: последний номер {max_counter}")
+        return max_counter
+
+    def get_max_counter_from_history(self, pattern):
+        """Получение максимального номера из сегодняшней истории переименований"""
+        max_counter = 0
+        today = datetime.now().strftime("%Y-%m-%d")
+        
+        for new_name in self.db_manager.get_new_names_by_date(today):
+            match = pattern.fullmatch(new_name)
+            if match:
+                max_counter = max(max_counter, int(match.group(1)))
+        
+        return max_counter
+
+    def plan(self, filepaths):
+        """Планирование переименования пачки без изменений на диске
+        
+        Проверяет существование, расширение, историю и дату файлов и назначает
+        номера подряд от следующего номера счетчика. Имена файлов папки читаются
+        один раз, номера, занятые существующими файлами, пропускаются. Для
+        шаблона без {counter} совпадения отмечаются в поле conflict.
+        Возвращает список RenamePlanItem.
+        Вызывать под rename_lock, если план будет сразу применен.
+        """
+        # Вся пачка планируется по одному снимку настроек
+        snapshot = self.settings.snapshot
+        counter_key = snapshot.get_counter_key()
+        counter = self.get_next_counter(snapshot)
+        template = snapshot.get_template()
+        pattern = snapshot.get_counter_pattern()
+        number_format = snapshot.number_format
+        route = snapshot.route
+        extensions = snapshot.extensions
+        only_today = snapshot.rename_only_today
+        today = datetime.now().date()
+        
+        # Занятые имена по папкам: содержимое папки и уже назначенные в плане
+        taken_names = {}
+        planned_names = set()
+        
+        items = []
+        for filepath in filepaths:
+            try:
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    logging.warning(f"Файл не существует: {filepath}")
+                    continue
+                
+                # Проверяем расширение файла
+                file_ext = Path(filepath).suffix.lower().lstrip('.')
+                
+                if file_ext not in extensions:
+                    logging.info(f"Файл {filepath} пропущен - расширение {file_ext} не в списке разрешенных")
+                    continue
+                
+                # Имя уже сформировано по текущему шаблону (например, событие
+                # изменения для только что переименованного файла)
+                if pattern and pattern.fullmatch(os.path.basename(filepath)):
+                    logging.debug(f"Файл {filepath} уже назван по шаблону - пропускаем")
+                    continue
+                
+                # Проверяем, не был ли файл уже переименован программой
+                # (ключ снимается до переименования и остается верным после него)
+                file_key = self.renamed_files_manager.get_file_key(filepath, stat)
+                if self.renamed_files_manager.is_key_renamed(file_key):
+                    logging.info(f"Файл {filepath} уже был переименован программой - пропускаем")
+                    continue
+                
+                # Проверяем, нужно ли переименовывать только сегодняшние файлы
+                file_time = datetime.fromtimestamp(stat.st_ctime)
+                if only_today and file_time.date() != today:
+                    logging.info(f"Файл {filepath} создан не сегодня - пропускаем")
+                    continue
+                
+                folder = os.path.dirname(filepath)
+                taken = taken_names.get(folder)
+                if taken is None:
+                    try:
+                        taken = set(os.listdir(folder))
+                    except OSError:
+                        taken = set()
+                    taken_names[folder] = taken
+                
+                new_name = f"{template.render(FilenameTemplate.format_counter(counter, number_format), file_ext)}.{file_ext}"
+                conflict = None
+                if template.has_counter:
+                    # Пропускаем номера, занятые существующими файлами
+                    while new_name in taken:
+                        logging.warning(f"Файл с именем {new_name} уже существует - номер {counter} пропущен")
+                        counter += 1
+                        new_name = f"{template.render(FilenameTemplate.format_counter(counter, number_format), file_ext)}.{file_ext}"
+                elif (folder, new_name) in planned_names:
+                    conflict = RenamePlanItem.CONFLICT_DUPLICATE
+                elif new_name in taken:
+                    conflict = RenamePlanItem.CONFLICT_EXISTS
+                
+                taken.add(new_name)
+                planned_names.add((folder, new_name))
+                items.append(RenamePlanItem(
+                    filepath, os.path.join(folder, new_name), counter_key, counter, route,
+                    file_key, file_time.strftime('%H:%M:%S'), conflict
+                ))
+                counter += 1
+            except Exception as e:
+                logging.error(f"Ошибка планирования переименования файла {filepath}: {e}")
+        
+        return items
+    
+    def preview(self, filepaths=None):
+        """План переименования для предпросмотра (по умолчанию - все ожидающие файлы папки)"""
+        if filepaths is None:
+            filepaths = self.find_pending_files()
+        with self.rename_lock:
+            items = self.plan(filepaths)
+        
+        conflicts = sum(1 for item in items if item.conflict)
+        logging.info(f"План переименования: {len(items)} файлов, конфликтов: {conflicts}")
+        return items
+    
+    def apply_plan(self, items):
+        """Применение готового плана (например, после предпросмотра)
+        
+        Имена из плана используются как есть. Если за это время счетчик ушел
+        вперед (мониторинг переименовал другие файлы) или сменились настройки,
+        план пересчитывается для тех же файлов.
+        Возвращает записи для отчета, как rename_files.
+        """
+        try:
+            with self.rename_lock:
+                if items and (
+                    items[0].counter_key != self.get_counter_key()
+                    or self.get_next_counter() > min(item.counter for item in items)
+                ):
+                    logging.info("План устарел - пересчитываем номера")
+                    items = self.plan([item.filepath for item in items])
+                return self.record(self.apply(items))
+        except Exception as e:
+            logging.error(f"Критическая ошибка в процессе переименования: {e}")
+            return []
+    
+    def apply(self, items):
+        """Выполнение плана: os.rename для каждого пункта
+        
+        Перед переименованием пачка записывается в журнал, поэтому после сбоя
+        recover_journal() восстановит историю. Возвращает успешно
+        переименованные пункты. Счетчик продвигается до последнего
+        запланированного номера, даже если часть файлов не удалось
+        переименовать, чтобы номера не выдавались повторно.
+        """
+        runnable = []
+        for item in items:
+            if item.conflict:
+                logging.warning(f"Файл {item.original_name} пропущен - конфликт имени {item.new_name}")
+            else:
+                runnable.append(item)
+        if not runnable:
+            return []
+        
+        batch_id = uuid.uuid4().hex
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for item in runnable:
+            item.batch_id = batch_id
+        if not self.db_manager.begin_journal(batch_id, DatabaseManager.JOURNAL_RENAME,
+                                             [item.to_journal_entry(timestamp) for item in runnable]):
+            logging.error("Пачка не переименована: не удалось записать журнал")
+            return []
+        
+        applied = []
+        failed = []
+        for item in runnable:
+            try:
+                if os.path.exists(item.new_path):
+                    logging.warning(f"Файл с именем {item.new_name} уже существует - пропускаем переименование")
+                    failed.append(item.new_path)
+                    continue
+                
+                os.rename(item.filepath, item.new_path)
+                applied.append(item)
+                logging.info(f"Файл переименован: {item.original_name} -> {item.new_name}")
+            except Exception as e:
+                failed.append(item.new_path)
+                logging.error(f"Ошибка переименования файла {item.filepath}: {e}")
+            finally:
+                if item.counter > self.counter_cache.get(item.counter_key, 0):
+                    self.counter_cache[item.counter_key] = item.counter
+        
+        # Непереименованные файлы восстанавливать не нужно
+        if failed:
+            self.db_manager.discard_journal_entries(batch_id, failed)
+        
+        return applied
+    
+    def record(self, applied):
+        """Запись выполненных переименований в историю одной транзакцией БД
+        
+        В той же транзакции закрывается пачка в журнале.
+        Возвращает записи для отчета: (исходное имя, новое имя, время создания, маршрут).
+        """
+        if not applied:
+            return []
+        
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Добавляем в историю переименований
+        self.renamed_files_manager.add_file_keys([item.file_key for item in applied])
+        
+        # Сохраняем в базу данных вместе с индексом счетчиков
+        self.db_manager.add_records([item.to_record(timestamp) for item in applied],
+                                    batch_id=applied[0].batch_id)
+        
+        report_entries = [item.to_report_entry() for item in applied]
+        
+        # Один вызов обработчика на пачку (в GUI - одно обновление отчета)
+        if self.on_renamed:
+            self.on_renamed(report_entries)
+        
+        return report_entries
+    
+    def recover_journal(self):
+        """Восстановление после сбоя по журналу (при запуске)
+        
+        Строка журнала считается выполненной, если файл уже лежит по новому
+        пути, а старого пути нет. Выполненные переименования записываются в
+        историю, выполненные отмены удаляют записи; остальное отбрасывается.
+        Возвращает количество восстановленных операций.
+        """
+        try:
+            entries = self.db_manager.get_journal_entries()
+            if not entries:
+                return 0
+            
+            batches = {}
+            for entry in entries:
+                batches.setdefault(entry["batch_id"], []).append(entry)
+            
+            recovered = 0
+            for batch_id, batch in batches.items():
+                done = [entry for entry in batch
+                        if os.path.exists(entry["new_path"]) and not os.path.exists(entry["old_path"])]
+                action = batch[0]["action"]
+                
+                if action == DatabaseManager.JOURNAL_RENAME:
+                    if done:
+                        self.renamed_files_manager.add_file_keys(
+                            [entry["file_key"] for entry in done if entry["file_key"]]
+                        )
+                    records = [(entry["timestamp"], entry["route"], os.path.basename(entry["old_path"]),
+                                os.path.basename(entry["new_path"]), entry["new_path"],
+                                entry["counter_key"], entry["counter"]) for entry in done]
+                    self.db_manager.add_records(records, batch_id=batch_id)
+                elif action == DatabaseManager.JOURNAL_UNDO:
+                    self.db_manager.delete_records([entry["record_id"] for entry in done], batch_id=batch_id)
+                else:
+                    self.db_manager.discard_journal_entries(batch_id)
+                
+                recovered += len(done)
+                logging.warning(
+                    f"Восстановлена прерванная пачка {batch_id} ({action}): "
+                    f"выполнено {len(done)} из {len(batch)}"
+                )
+            
+            # Номера могли измениться - сверяем счетчики заново
+            self.counter_cache.clear()
+            return recovered
+        except Exception as e:
+            logging.error(f"Ошибка восстановления по журналу переименований: {e}")
+            return 0
+    
+    def undo(self, route=None, target_date=None, batch_id=None):
+        """Отмена переименований по маршруту, дате или пачке
+        
+        Файлы получают исходные имена в той же папке, записи удаляются из
+        истории. Ключи файлов остаются в списке переименованных, иначе
+        мониторинг или догоняющий проход сразу переименуют их снова.
+        Отмена идет через журнал, как и переименование.
+        Номера счетчика не освобождаются. Без фильтра (маршрут, дата или
+        пачка) ничего не отменяется - вся история откатывается только явно,
+        по датам или маршрутам. Возвращает количество отмененных.
+        """
+        if not (route or target_date or batch_id):
+            logging.error("Отмена переименований без маршрута, даты или пачки не выполняется")
+            return 0
+        try:
+            with self.rename_lock:
+                records = self.db_manager.get_records_for_undo(route, target_date, batch_id)
+                if not records:
+                    logging.info("Нет переименований для отмены")
+                    return 0
+                
+                undo_batch = uuid.uuid4().hex
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                entries = []
+                for record_id, original_name, new_name, file_path in records:
+                    target = os.path.join(os.path.dirname(file_path), original_name)
+                    if not os.path.exists(file_path):
+                        logging.warning(f"Файл {new_name} не найден - отмена невозможна")
+                        continue
+                    if os.path.exists(target):
+                        logging.warning(f"Файл {original_name} уже существует - отмена {new_name} пропущена")
+                        continue
+                    file_key = self.renamed_files_manager.get_file_key(file_path)
+                    entries.append((timestamp, file_path, target, None, None, None,
+                                    file_key, None, record_id))
+                
+                if not entries or not self.db_manager.begin_journal(
+                        undo_batch, DatabaseManager.JOURNAL_UNDO, entries):
+                    return 0
+                
+                undone_ids = []
+                failed = []
+                for _, file_path, target, *_, record_id in entries:
+                    try:
+                        os.rename(file_path, target)
+                        undone_ids.append(record_id)
+                        logging.info(f"Переименование отменено: {os.path.basename(file_path)} -> "
+                                     f"{os.path.basename(target)}")
+                    except Exception as e:
+                        failed.append(target)
+                        logging.error(f"Ошибка отмены переименования {file_path}: {e}")
+                
+                if failed:
+                    self.db_manager.discard_journal_entries(undo_batch, failed)
+                self.db_manager.delete_records(undone_ids, batch_id=undo_batch)
+                
+                logging.info(f"Отменено переименований: {len(undone_ids)} из {len(records)}")
+                if self.on_history_changed:
+                    self.on_history_changed()
+                return len(undone_ids)
+        except Exception as e:
+            logging.error(f"Критическая ошибка отмены переименований: {e}")
+            return 0
+    
+    def undo_last_batch(self):
+        """Отмена последней пачки переименований"""
+        batch_id = self.db_manager.get_last_batch_id()
+        if not batch_id:
+            logging.info("Нет переименований для отмены")
+            return 0
+        return self.undo(batch_id=batch_id)
+    
+    def rename_files(self, filepaths):
+        """Пакетное переименование файлов: план, выполнение и запись в историю
+        
+        Возвращает записи для отчета: (исходное имя, новое имя, время создания, маршрут).
+        """
+        try:
+            with self.rename_lock:
+                return self.record(self.apply(self.plan(filepaths)))
+        except Exception as e:
+            logging.error(f"Критическая ошибка в процессе переименования: {e}")
+            return []
+
+    @staticmethod
+    def iter_folder_files(folder, recursive=False, excluded=()):
+        """Файлы папки (os.DirEntry), с подпапками - обходом без рекурсии вызовов
+        
+        Подпапки из excluded (абсолютные пути) пропускаются.
+        """
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_file():
+                                yield entry
+                            elif (recursive and entry.is_dir(follow_symlinks=False)
+                                  and os.path.abspath(entry.path) not in excluded):
+                                stack.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                if current == folder:
+                    raise
+                logging.warning(f"Не удалось прочитать папку {current}: {e}")
+    
+    def for_profile(self, profile):
+        """Сервис для профиля папки наблюдения
+        
+        Шаблон и настройки - свои, блокировка, кэш счетчиков, база и
+        обработчики - общие с основным сервисом.
+        """
+        return RenameService(
+            ProfileSettings(self.settings, profile), self.db_manager, self.renamed_files_manager,
+            on_renamed=self.on_renamed, on_history_changed=self.on_history_changed,
+            rename_lock=self.rename_lock, counter_cache=self.counter_cache
+        )
+    
+    def get_profile_services(self):
+        """Сервисы всех папок наблюдения: [(папка, с подпапками, сервис)]
+        
+        Первой идет основная папка (этот же сервис). Список пересобирается
+        только при изменении папок или профилей в настройках.
+        """
+        if not hasattr(self.settings, "get_watch_profiles"):
+            # Сервис профиля - папка одна
+            snapshot = self.settings.snapshot
+            return [(os.path.abspath(snapshot.folder), snapshot.recursive_watch, self)]
+        
+        snapshot = self.settings.snapshot
+        if self.profile_services_version != snapshot.version:
+            services = [(os.path.abspath(snapshot.folder), snapshot.recursive_watch, self)]
+            for profile in snapshot.watch_profiles:
+                services.append((os.path.abspath(profile["folder"]), bool(profile.get("recursive")),
+                                 self.for_profile(profile)))
+            for folder, _, service in services:
+                service.excluded_folders = {
+                    other for other, _, _ in services
+                    if other != folder and other.startswith(os.path.join(folder, ""))
+                }
+            self.profile_services = services
+            self.profile_services_version = snapshot.version
+        return self.profile_services
+    
+    def service_for_path(self, filepath):
+        """Сервис папки, к которой относится файл (самая глубокая подходящая папка)"""
+        directory = os.path.dirname(os.path.abspath(filepath))
+        best = None
+        for folder, recursive, service in self.get_profile_services():
+            if directory == folder or (recursive and directory.startswith(os.path.join(folder, ""))):
+                if best is None or len(folder) > len(best[0]):
+                    best = (folder, service)
+        return best[1] if best else None
+    
+    def dispatch_files(self, filepaths):
+        """Переименование файлов из разных папок наблюдения (обработчик мониторинга)
+        
+        Файлы группируются по профилям, каждая группа - отдельная пачка.
+        """
+        groups = {}
+        for filepath in filepaths:
+            service = self.service_for_path(filepath)
+            if service is None:
+                logging.warning(f"Файл {filepath} не относится ни к одной папке наблюдения")
+                continue
+            groups.setdefault(id(service), (service, []))[1].append(filepath)
+        
+        report_entries = []
+        for service, group in groups.values():
+            report_entries.extend(service.rename_files(group))
+        return report_entries
+    
+    def catch_up_all(self):
+        """Догоняющий проход по всем папкам наблюдения"""
+        return sum(service.catch_up_scan() for _, _, service in self.get_profile_services())
+    
+    def preview_all(self):
+        """План переименования ожидающих файлов всех папок наблюдения (для предпросмотра)
+        
+        Каждая папка планируется своим сервисом профиля, со своими шаблоном,
+        маршрутом и счетчиком.
+        """
+        items = []
+        for _, _, service in self.get_profile_services():
+            filepaths = service.find_pending_files()
+            if filepaths:
+                with self.rename_lock:
+                    items.extend(service.plan(filepaths))
+        
+        conflicts = sum(1 for item in items if item.conflict)
+        logging.info(f"План переименования: {len(items)} файлов, конфликтов: {conflicts}")
+        return items
+    
+    def apply_plan_all(self, items):
+        """Применение плана preview_all: пункты группируются по папкам наблюдения"""
+        groups = {}
+        for item in items:
+            service = self.service_for_path(item.filepath) or self
+            groups.setdefault(id(service), (service, []))[1].append(item)
+        
+        report_entries = []
+        for service, group in groups.values():
+            report_entries.extend(service.apply_plan(group))
+        return report_entries
+    
+    def find_pending_files(self):
+        """Файлы папки, которые еще не переименованы программой
+        
+        Папка читается через os.scandir, уже переименованные файлы отсеиваются
+        по истории (ключ файла и новое имя). Порядок - по времени создания,
+        поэтому номера идут по порядку.
+        """
+        try:
+            snapshot = self.settings.snapshot
+            folder = snapshot.folder
+            extensions = snapshot.extensions
+            only_today = snapshot.rename_only_today
+            today = datetime.now().date()
+            pattern = snapshot.get_counter_pattern()
+            
+            recursive = snapshot.recursive_watch
+            
+            candidates = []
+            for entry in self.iter_folder_files(folder, recursive, self.excluded_folders):
+                if Path(entry.name).suffix.lower().lstrip('.') not in extensions:
+                    continue
+                # Имя уже сформировано по текущему шаблону
+                if pattern and pattern.fullmatch(entry.name):
+                    continue
+                try:
+                    ctime = entry.stat().st_ctime
+                except OSError:
+                    continue
+                if only_today and datetime.fromtimestamp(ctime).date() != today:
+                    continue
+                candidates.append((ctime, entry.name, entry.path))
+            
+            # Отсеиваем файлы, уже известные истории
+            known_names = self.db_manager.get_existing_new_names([name for _, name, _ in candidates])
+            pending = []
+            for ctime, name, path in sorted(candidates):
+                if name in known_names:
+                    continue
+                if self.renamed_files_manager.is_file_renamed(path):
+                    continue
+                pending.append(path)
+            
+            return pending
+        except Exception as e:
+            logging.error(f"Ошибка поиска непереименованных файлов: {e}")
+            return []
+    
+    def catch_up_scan(self):
+        """Догоняющий проход: переименование файлов, созданных без мониторинга
+        
+        Непереименованные файлы (find_pending_files) передаются в rename_files
+        пачками по CATCH_UP_BATCH_SIZE.
+        """
+        try:
+            pending = self.find_pending_files()
+            if not pending:
+                logging.info("Догоняющий проход: новых файлов нет")
+                return 0
+            
+            logging.info(f"Догоняющий проход: найдено {len(pending)} непереименованных файлов")
+            renamed = 0
+            for start in range(0, len(pending), self.CATCH_UP_BATCH_SIZE):
+                renamed += len(self.rename_files(pending[start:start + self.CATCH_UP_BATCH_SIZE]))
+            return renamed
+        except Exception as e:
+            logging.error(f"Ошибка догоняющего прохода по папке: {e}")
+            return 0
+
+class ReportExporter:
+    """Потоковый экспорт истории переименований в CSV, XLSX и Parquet
+    
+    Строки читаются из rename_history частями (fetchmany) и сразу пишутся
+    в файл, поэтому экспорт за месяц идет в постоянной памяти и не
+    затрагивает таблицу отчета. Файл пишется во временный и подменяется
+    целиком - при ошибке прежний файл не портится.
+    """
+    
+    # Формат -> (описание, расширение)
+    FORMATS = {
+        "csv": ("CSV", ".csv"),
+        "xlsx": ("Excel", ".xlsx"),
+        "parquet": ("Parquet", ".parquet")
+    }
+    CHUNK_SIZE = 5000
+    # Формат -> необязательная библиотека (импортируется только при экспорте,
+    # чтобы не замедлять запуск)
+    LIBRARIES = {
+        "xlsx": "openpyxl",
+        "parquet": "pyarrow"
+    }
+    
+    def __init__(self, db_manager, chunk_size=CHUNK_SIZE):
+        self.db_manager = db_manager
+        self.chunk_size = chunk_size
+    
+    @classmethod
+    def available_formats(cls):
+        """Форматы, для которых установлены нужные библиотеки"""
+        return [fmt for fmt in cls.FORMATS
+                if fmt not in cls.LIBRARIES or importlib.util.find_spec(cls.LIBRARIES[fmt])]
+    
+    @classmethod
+    def format_for_path(cls, file_path):
+        """Формат по расширению файла (по умолчанию CSV)"""
+        extension = Path(file_path).suffix.lower()
+        for fmt, (_, fmt_extension) in cls.FORMATS.items():
+            if extension == fmt_extension:
+                return fmt
+        return "csv"
+    
+    def export(self, file_path, fmt=None, route=None, target_date=None, date_from=None,
+               date_to=None, progress=None):
+        """Экспорт записей с фильтрами в файл, возвращает число строк
+        
+        progress(rows) вызывается после каждой записанной части.
+        Неизвестный или недоступный формат - ValueError.
+        """
+        fmt = fmt or self.format_for_path(file_path)
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+        if fmt not in self.available_formats():
+            raise ValueError(f"Для экспорта в {self.FORMATS[fmt][0]} установите: "
+                             f"pip install {self.LIBRARIES[fmt]}")
+        
+        chunks = self.db_manager.iter_record_chunks(route, target_date, date_from, date_to,
+                                                    self.chunk_size)
+        writer = getattr(self, f"write_{fmt}")
+        temp_path = f"{file_path}.tmp"
+        try:
+            rows = writer(temp_path, chunks, progress)
+            os.replace(temp_path, file_path)
+        finally:
+            chunks.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        logging.info(f"Экспортировано записей: {rows} -> {file_path}")
+        return rows
+    
+    def write_csv(self, file_path, chunks, progress=None):
+        """CSV в UTF-8 с BOM (открывается в Excel без смены кодировки)"""
+        rows = 0
+        with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(DatabaseManager.RECORD_COLUMNS)
+            for chunk in chunks:
+                writer.writerows(chunk)
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+        return rows
+    
+    def write_xlsx(self, file_path, chunks, progress=None):
+        """XLSX в режиме write_only (строки не накапливаются в памяти)"""
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Отчет")
+        sheet.append(DatabaseManager.RECORD_COLUMNS)
+        rows = 0
+        for chunk in chunks:
+            for row in chunk:
+                sheet.append(row)
+            rows += len(chunk)
+            if progress:
+                progress(rows)
+        workbook.save(file_path)
+        return rows
+    
+    def write_parquet(self, file_path, chunks, progress=None):
+        """Parquet: каждая часть - отдельная группа строк"""
+        import pyarrow
+        import pyarrow.parquet
+        schema = pyarrow.schema([
+            (column, pyarrow.int64() if column == "id" else pyarrow.string())
+            for column in DatabaseManager.RECORD_COLUMNS
+        ])
+        rows = 0
+        with pyarrow.parquet.ParquetWriter(file_path, schema) as writer:
+            for chunk in chunks:
+                columns = list(zip(*chunk))
+                writer.write_table(pyarrow.Table.from_arrays(
+                    [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema
+                ))
+                rows += len(chunk)
+                if progress:
+                    progress(rows)
+        return rows